@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""analytics.py
+
+Attendance analytics served from a periodic columnar snapshot.
+
+A task chain copies every Conference and Session, SNAPSHOT_BATCH entities
+per task, into compressed NumPy .npz parts stored as children of an
+AnalyticsSnapshot. Reports concatenate the parts and aggregate them with
+vectorized bincounts, so they never iterate ndb entities.
+
+"""
+
+import hashlib
+import io
+
+import numpy as np
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from largevalue import getLargeValue
+from largevalue import setLargeValue
+from models import AnalyticsSnapshot
+from models import AnalyticsSnapshotPart
+from models import Conference
+from models import Session
+from models import SessionType
+
+SNAPSHOT_BATCH = 5000
+SNAPSHOTS_KEPT = 2
+MEMCACHE_STATS_PREFIX = "CONFERENCE_STATS:"
+SESSION_TYPES = sorted(SessionType.names())
+_KINDS = {'conference': Conference, 'session': Session}
+
+
+def startSnapshot():
+    """Create a new snapshot and queue its first batch."""
+    snap_key = AnalyticsSnapshot().put()
+    enqueueSnapshotTask(snap_key, 'conference')
+    return snap_key
+
+
+def enqueueSnapshotTask(snap_key, kind, cursor=None):
+    params = {'snapshot': snap_key.urlsafe(), 'kind': kind}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    taskqueue.add(url='/tasks/analytics_snapshot', params=params)
+
+
+def _conferenceColumns(confs):
+    return {
+        'city': np.array([conf.city or '' for conf in confs]),
+        'month': np.array([conf.month or 0 for conf in confs], dtype=np.int8),
+        'capacity': np.array([conf.maxAttendees or 0 for conf in confs],
+                             dtype=np.int32),
+        'seats': np.array([conf.seatsAvailable or 0 for conf in confs],
+                          dtype=np.int32),
+        'live': np.array([conf.isLive is not False for conf in confs],
+                         dtype=np.bool_),
+    }
+
+
+def _sessionColumns(sessions):
+    codes = dict((name, i) for i, name in enumerate(SESSION_TYPES))
+    not_specified = codes['NOT_SPECIFIED']
+    return {
+        'type': np.array([codes.get(s.typeOfSession, not_specified)
+                          for s in sessions], dtype=np.int8),
+        'duration': np.array([s.duration if s.duration is not None
+                              else np.nan for s in sessions],
+                             dtype=np.float32),
+    }
+
+
+def _pack(columns):
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **columns)
+    return buf.getvalue()
+
+
+def _unpack(data):
+    archive = np.load(io.BytesIO(data))
+    return dict((name, archive[name]) for name in archive.files)
+
+
+def snapshotBatch(snapshot, kind, cursor=None):
+    """Copy one batch of `kind` into the snapshot and chain the next."""
+    snap_key = ndb.Key(urlsafe=snapshot)
+    model = _KINDS[kind]
+    entities, next_cursor, more = model.query().fetch_page(
+        SNAPSHOT_BATCH, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    if entities:
+        columns = (_conferenceColumns if kind == 'conference'
+                   else _sessionColumns)(entities)
+        # named after the batch, so a retried task overwrites its part
+        # instead of adding a second copy
+        part_id = '%s-%s' % (kind, hashlib.sha1(cursor or '').hexdigest())
+        AnalyticsSnapshotPart(parent=snap_key, id=part_id, kind=kind,
+                              data=_pack(columns)).put()
+    if more and next_cursor:
+        enqueueSnapshotTask(snap_key, kind, next_cursor)
+    elif kind == 'conference':
+        enqueueSnapshotTask(snap_key, 'session')
+    else:
+        snap = snap_key.get()
+        snap.complete = True
+        snap.put()
+        _purgeOldSnapshots()
+
+
+def _purgeOldSnapshots():
+    old = AnalyticsSnapshot.query(AnalyticsSnapshot.complete == True).order(
+        -AnalyticsSnapshot.createdAt).fetch(offset=SNAPSHOTS_KEPT,
+                                            keys_only=True)
+    for snap_key in old:
+        ndb.delete_multi(AnalyticsSnapshotPart.query(
+            ancestor=snap_key).fetch(keys_only=True) + [snap_key])
+
+
+def latestSnapshot():
+    return AnalyticsSnapshot.query(AnalyticsSnapshot.complete == True).order(
+        -AnalyticsSnapshot.createdAt).get()
+
+
+def loadColumns(snap_key):
+    """Return {'conference': {column: array}, 'session': {...}}."""
+    parts = {'conference': [], 'session': []}
+    for part in AnalyticsSnapshotPart.query(ancestor=snap_key):
+        parts[part.kind].append(_unpack(part.data))
+    empty = {'conference': _conferenceColumns([]),
+             'session': _sessionColumns([])}
+    columns = {}
+    for kind, batches in parts.items():
+        if not batches:
+            columns[kind] = empty[kind]
+            continue
+        columns[kind] = dict(
+            (name, np.concatenate([batch[name] for batch in batches]))
+            for name in batches[0])
+    return columns
+
+
+def _grouped(dimension, labels, idx, capacity, registrations):
+    """Aggregate conference columns by an integer group index."""
+    if not len(idx):
+        return []
+    n = len(labels)
+    counts = np.bincount(idx, minlength=n)
+    cap = np.bincount(idx, weights=capacity, minlength=n)
+    regs = np.bincount(idx, weights=registrations, minlength=n)
+    fill = regs / np.maximum(cap, 1)
+    return [{'dimension': dimension, 'value': str(labels[i]),
+             'conferences': int(counts[i]), 'capacity': int(cap[i]),
+             'registrations': int(regs[i]), 'fillRate': float(fill[i])}
+            for i in np.nonzero(counts)[0]]
+
+
+def computeStats(columns):
+    """Return overall and grouped attendance aggregates as plain dicts."""
+    conf = columns['conference']
+    capacity = conf['capacity'].astype(np.int64)
+    registrations = np.clip(capacity - conf['seats'], 0, None)
+    # conferences without a size limit have no meaningful fill rate
+    registrations[capacity <= 0] = 0
+
+    cities, city_idx = np.unique(conf['city'], return_inverse=True)
+    rows = _grouped('city', cities, city_idx, capacity, registrations)
+    rows += _grouped('month', range(13), conf['month'].astype(np.intp),
+                     capacity, registrations)
+
+    sess = columns['session']
+    if len(sess['type']):
+        n = len(SESSION_TYPES)
+        types = sess['type'].astype(np.intp)
+        counts = np.bincount(types, minlength=n)
+        timed = ~np.isnan(sess['duration'])
+        hours = np.bincount(types[timed], weights=sess['duration'][timed],
+                            minlength=n)
+        timed_counts = np.bincount(types[timed], minlength=n)
+        avg = hours / np.maximum(timed_counts, 1)
+        rows += [{'dimension': 'sessionType', 'value': SESSION_TYPES[i],
+                  'sessions': int(counts[i]), 'avgDuration': float(avg[i])}
+                 for i in np.nonzero(counts)[0]]
+
+    total_cap = int(capacity.sum())
+    total_regs = int(registrations.sum())
+    return {
+        'conferences': len(capacity),
+        'capacity': total_cap,
+        'registrations': total_regs,
+        'fillRate': float(total_regs) / total_cap if total_cap else 0.0,
+        'sessions': len(sess['type']),
+        'rows': rows,
+    }
+
+
+def getConferenceStats():
+    """Return (snapshot, stats) for the newest complete snapshot."""
+    snap = latestSnapshot()
+    if snap is None:
+        return None, None
+    cache_key = MEMCACHE_STATS_PREFIX + snap.key.urlsafe()
+    stats = getLargeValue(cache_key)
+    if stats is None:
+        stats = computeStats(loadColumns(snap.key))
+        setLargeValue(cache_key, stats)
+    return snap, stats
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""announcements.py
+
+Announcement and featured speaker caching, shared by the Endpoints API
+and the cron/task handlers in main.py. Kept apart from conference.py so
+those handlers do not import Endpoints and the whole API definition.
+
+"""
+
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from hotcache import hot_cache
+from largevalue import getLargeValue
+from models import Conference
+from models import Session
+from models import Speaker
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_FEATUREDSPEAKER_KEY = "FEATUREDSPEAKER"
+MEMCACHE_FEATUREDSPEAKER_SUPPRESSED_KEY = "FEATUREDSPEAKER_SUPPRESSED"
+# featured speaker recomputations for the same (conference, speaker) that
+# are requested within one bucket collapse into a single named task
+FEATURED_SPEAKER_BUCKET_SECS = 30
+# a pending task this close to its ETA may already be reading sessions
+FEATURED_SPEAKER_ETA_MARGIN_SECS = 2
+
+
+def cacheAnnouncement():
+    """Create Announcement & assign to memcache; used by
+    memcache cron job & putAnnouncement().
+    """
+    confs = Conference.query(ndb.AND(
+        Conference.isLive == True,
+        Conference.seatsAvailable <= 5,
+        Conference.seatsAvailable > 0)
+    ).fetch(projection=[Conference.name])
+
+    if confs:
+        # If there are almost sold out conferences,
+        # format announcement and set it in memcache
+        announcement = '%s %s' % (
+            'Last chance to attend! The following conferences '
+            'are nearly sold out:',
+            ', '.join(conf.name for conf in confs))
+        hot_cache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    else:
+        # If there are no sold out conferences,
+        # delete the memcache announcements entry
+        announcement = ""
+        hot_cache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+
+    return announcement
+
+
+def cacheFeaturedSpeaker(speaker_email, wsck):
+    """
+     If there is more than one session by this speaker at this conference, 
+        then assign the Featured Speaker to memcache
+    Args: 
+        speaker_email: The speaker's email
+        wsck: the aimed conference's web safe url key
+    """
+    # Fetch a list of Sessions at the provided Conference
+    # that the Speaker is speaking at.
+    s_key = ndb.Key(Speaker, speaker_email)
+    speaker = s_key.get()
+    c_key = ndb.Key(urlsafe=wsck)
+    q = Session.query(ancestor=c_key)
+    sessions = q.filter(Session.speaker == speaker_email).fetch()
+    # if sesions count <= 1 break the function.
+    if len(sessions) <= 1:
+        return
+    # Set the featured string for the speaker.
+    featuredInfo = "| %s's sessions: %s" %(speaker.name ,','.join(session.name for session in sessions))
+    # read memcache directly; the instance-local copy may be stale
+    cacheInfo = getLargeValue(MEMCACHE_FEATUREDSPEAKER_KEY)
+    featuredStr = ""
+    # This tag is used to check if speaker is already in the memcache
+    isChanged = False
+    if not cacheInfo:
+        featuredStr = "Featured Speakers:" + featuredInfo
+        isChanged = True
+    else:
+        infos = cacheInfo.split('|',1)
+        for (i, info) in enumerate(infos):
+            if i == 0:
+                continue
+            if speaker.name in info:
+                isChanged=True
+                infos[i] = featuredInfo[1:]
+        featuredStr = '|'.join(infos)
+    # If the speaker's info is not in the memcache, then append this str.
+    if not isChanged:
+        featuredStr += featuredInfo
+    # Set memcache
+    hot_cache.set(MEMCACHE_FEATUREDSPEAKER_KEY, featuredStr)
+
+def scheduleFeaturedSpeaker(speaker_email, wsck, now=None):
+    """
+     Enqueue a debounced featured speaker recomputation. Tasks are named
+        per (conference, speaker, time bucket) and held back until the
+        bucket closes, so a burst of createSession calls runs it once.
+    Args:
+        speaker_email: The speaker's email
+        wsck: the aimed conference's web safe url key
+        now: current unix time, defaults to time.time()
+    Returns:
+        True if a task was enqueued, False if an equivalent one is pending
+    """
+    if now is None:
+        now = time.time()
+    digest = hashlib.md5('%s|%s' % (wsck, speaker_email)).hexdigest()
+    bucket = int(now // FEATURED_SPEAKER_BUCKET_SECS)
+    countdown = (bucket + 1) * FEATURED_SPEAKER_BUCKET_SECS - now
+    params = {'speaker_email': speaker_email, 'wsck': wsck}
+    attempt = bucket
+    while True:
+        try:
+            taskqueue.add(name='featured-%s-%d' % (digest, attempt),
+                          params=params, countdown=countdown,
+                          url='/tasks/set_featured_speaker')
+            return True
+        except taskqueue.TaskAlreadyExistsError:
+            if countdown > FEATURED_SPEAKER_ETA_MARGIN_SECS:
+                # a task for this bucket is still pending and will pick
+                # up the session we just created
+                break
+            # the task may be running already (clock skew), or ran and
+            # is not tombstoned yet; do not rely on it
+        except taskqueue.TombstonedTaskError:
+            # this bucket's task already ran (clock skew), so nothing
+            # pending covers this session
+            pass
+        # move to the following bucket
+        attempt += 1
+        countdown += FEATURED_SPEAKER_BUCKET_SECS
+        if attempt > bucket + 1:
+            # skewed past that too: run unnamed rather than lose it
+            taskqueue.add(params=params, countdown=countdown,
+                          url='/tasks/set_featured_speaker')
+            return True
+    memcache.incr(MEMCACHE_FEATUREDSPEAKER_SUPPRESSED_KEY, initial_value=0)
+    logging.debug('featured speaker task suppressed for %s in %s',
+                  speaker_email, wsck)
+    return False
+
+
+def getAnnouncement():
+    """Return the cached announcement or an empty string."""
+    return hot_cache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or ""
+
+
+def getFeaturedSpeaker():
+    """Return the cached featured speaker string or an empty string."""
+    return hot_cache.get(MEMCACHE_FEATUREDSPEAKER_KEY) or ""
@@ -2,4 +2,9 @@ def webapp_add_wsgi_middleware(app):
   from google.appengine.ext.appstats import recording
   app = recording.appstats_wsgi_middleware(app)
   appstats_CALC_RPC_COSTS = True
-  return app
\ No newline at end of file
+  # opt-in sampling of Endpoints calls for load replay
+  from settings import CAPTURE_SAMPLE_RATE
+  if CAPTURE_SAMPLE_RATE:
+    from trafficcapture import CaptureMiddleware
+    app = CaptureMiddleware(app)
+  return app
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""archive.py
+
+Moves conferences whose endDate has passed, and their sessions, out of
+the hot query path by clearing their indexed isLive flag. Browse queries
+filter on isLive == True, so their cost follows the live data rather
+than the whole history.
+
+The work runs as a chain of tasks, each handling one batch and passing
+its query cursor on to the next.
+
+"""
+
+from datetime import date
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from facets import conferenceFacets
+from facets import enqueueFacetDelta
+from facets import facetDelta
+from homepage import invalidateHomePage
+from models import Conference
+from models import Session
+
+ARCHIVE_BATCH = 100
+
+
+def isLiveConference(conf, today=None):
+    """Return False if the conference has already ended."""
+    if not conf.endDate:
+        return True
+    return conf.endDate >= (today or date.today())
+
+
+def enqueueArchiveTask(cursor=None, full=False):
+    """Queue the next link of the archive task chain."""
+    params = {'full': '1' if full else ''}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    taskqueue.add(url='/tasks/archive_conferences', params=params)
+
+
+@ndb.transactional()
+def _setLive(c_key, live):
+    """Flip isLive on a conference and all of its sessions."""
+    conf = c_key.get()
+    if conf is None:
+        return
+    sessions = Session.query(ancestor=c_key).fetch()
+    changed = [entity for entity in [conf] + sessions
+               if entity.isLive != live]
+    old_facets = conferenceFacets(conf)
+    for entity in changed:
+        entity.isLive = live
+    ndb.put_multi(changed)
+    # facet counts cover live conferences only
+    enqueueFacetDelta(facetDelta(old_facets, conferenceFacets(conf)))
+
+
+def archiveConferences(cursor=None, full=False, today=None):
+    """Archive one batch of ended conferences and chain the next batch.
+
+    With full=True every conference is visited and isLive is set either
+    way; run it once to backfill entities written before isLive existed
+    or after endDate was changed by hand.
+
+    Returns the number of conferences changed in this batch.
+    """
+    today = today or date.today()
+    if full:
+        q = Conference.query().order(Conference.key)
+    else:
+        q = Conference.query(Conference.isLive == True,
+                             Conference.endDate < today)
+    confs, next_cursor, more = q.fetch_page(
+        ARCHIVE_BATCH, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    changed = 0
+    for conf in confs:
+        live = isLiveConference(conf, today)
+        if full or conf.isLive != live:
+            _setLive(conf.key, live)
+            changed += 1
+    if changed:
+        # archived conferences leave the home page list
+        invalidateHomePage()
+    if more and next_cursor:
+        enqueueArchiveTask(next_cursor, full)
+    return changed
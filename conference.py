@@ -14,17 +14,23 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
 from datetime import datetime, time
+import hashlib
+import logging
+import operator
+import time as _time
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
+from protorpc import protojson
 
-from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
-from models import ConflictException
+from errors import ConflictException
+from errors import SoldOutException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
@@ -34,6 +40,10 @@ from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import ConferenceFacetForm
+from models import ConferenceFacetForms
+from models import ConferenceStatsForm
+from models import StatsRowForm
 from models import TeeShirtSize
 from models import Session
 from models import SessionForm
@@ -46,19 +56,66 @@ from models import SpeakerQueryForms
 from models import SessionType
 from models import SessionHighlightsForm
 from models import SessionSpeakerFieldForm
+from models import SessionSearchForms
+from models import SessionDateRangeForm
+from models import SyncForm
+from models import MultiGetForm
+from models import ConferenceResultForm
+from models import ConferenceResultForms
+from models import SessionResultForm
+from models import SessionResultForms
+from models import SpeakerResultForm
+from models import SpeakerResultForms
+from models import SyncRemovedForm
+from models import Recommendation
 
 from utils import getUserId
+from utils import isAdmin
+
+from mailqueue import enqueueConfirmationEmail
+from converters import copyConferenceToForm
+from converters import copySessionToForm
+from announcements import getAnnouncement
+from announcements import getFeaturedSpeaker
+from announcements import scheduleFeaturedSpeaker
+from facets import conferenceFacets
+from facets import enqueueFacetDelta
+from facets import facetDelta
+from facets import getFacetCounts
+from queryshapes import recordQueryShape
+from archive import isLiveConference
+from waitlist import hasWaiters
+from waitlist import joinWaitlist
+from waitlist import leaveWaitlist
+from waitlist import scheduleWaitlistWorker
+from waitlist import takeAdmissionToken
+from idempotency import idempotent
+from ratelimit import rateLimited
+from profiler import profiled
+from speakerdirectory import bumpVersion as bumpSpeakerDirectory
+from speakerdirectory import searchSpeakers
+from highlightsearch import searchHighlights
+from homepage import invalidateHomePage
+from sync import collectChanges
+from sync import scopeChange
+from dateranges import bucketFilter
+from deadline import RequestBudget
+from deadline import boundedQuery
+from deadline import decodeCursor
+from dateranges import overlaps
+from dateranges import parseDate
+from dateranges import parseTime
 
 from settings import WEB_CLIENT_ID
 
-from google.appengine.api import memcache
-
 from models import StringMessage
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-MEMCACHE_FEATUREDSPEAKER_KEY = "FEATUREDSPEAKER"
+# most keys a getConferencesByKeys-style call resolves at once
+MULTI_GET_MAX_KEYS = 300
+# wishlist changes within one bucket share a recommendation refresh
+RECOMMENDATION_REFRESH_SECS = 10
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -78,11 +135,23 @@ OPERATORS = {
             'NE':   '!='
             }
 
+# OPERATORS applied in memory, to filters left out of a query
+COMPARISONS = {
+            '=':  operator.eq,
+            '>':  operator.gt,
+            '>=': operator.ge,
+            '<':  operator.lt,
+            '<=': operator.le,
+            '!=': operator.ne,
+            }
+
 FIELDS =    {
             'CITY': 'city',
             'TOPIC': 'topics',
             'MONTH': 'month',
             'MAX_ATTENDEES': 'maxAttendees',
+            'START_DATE': 'startDate',
+            'END_DATE': 'endDate',
             }
 
 CONF_GET_REQUEST = endpoints.ResourceContainer(
@@ -95,6 +164,23 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+# requestId lets clients retry mutating calls safely (see idempotency.py)
+CONF_CREATE_REQUEST = endpoints.ResourceContainer(
+    ConferenceForm,
+    requestId=messages.StringField(1),
+)
+
+CONF_REGISTER_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    requestId=messages.StringField(2),
+)
+
+SYNC_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    syncToken=messages.StringField(1),
+)
+
 SPEAKERDEFAULTS = {
     "company": "NOT_SPECIFIED",
     "sex": "Male",
@@ -104,6 +190,7 @@ SPEAKERDEFAULTS = {
 SESSION_CREATE_REQUEST = endpoints.ResourceContainer(
     SessionForm,
     websafeConferenceKey=messages.StringField(1),
+    requestId=messages.StringField(2),
 )
 
 CON_SESSION_GET_REQUEST = endpoints.ResourceContainer(
@@ -120,6 +207,13 @@ CON_SES_TYPE_GET_REQUEST = endpoints.ResourceContainer(
 SES_SEPAKER_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
+    cursor=messages.StringField(2),
+)
+
+# cursor: nextCursor of a partial answer (see deadline.py)
+TASK3_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    cursor=messages.StringField(1),
 )
 
 SESSION_DEFAULTS = {
@@ -137,6 +231,8 @@ SES_REQUEST = endpoints.ResourceContainer(
 @endpoints.api(name='conference', version='v1', 
     allowed_client_ids=[WEB_CLIENT_ID, API_EXPLORER_CLIENT_ID],
     scopes=[EMAIL_SCOPE])
+@rateLimited
+@profiled
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
@@ -144,20 +240,7 @@ class ConferenceApi(remote.Service):
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        return copyConferenceToForm(conf, displayName)
 
 
     def _createConferenceObject(self, request):
@@ -175,6 +258,7 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        data.pop('requestId', None)
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -204,12 +288,21 @@ class ConferenceApi(remote.Service):
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        # TODO 2: add confirmation email sending task to queue
-        taskqueue.add(params={'email': user.email(), 'conferenceInfo': repr(request)},
-                    url = '/tasks/send_confirmation_email')
+        self._putConferenceAndNotify(Conference(**data), user.email())
+        invalidateHomePage()
 
-        return request
+        # request may be a CONF_CREATE_REQUEST container; answer with a
+        # plain ConferenceForm
+        return ConferenceForm(**{field.name: getattr(request, field.name)
+                                 for field in ConferenceForm.all_fields()})
+
+
+    @ndb.transactional()
+    def _putConferenceAndNotify(self, conf, email):
+        """Put Conference and queue its confirmation email atomically."""
+        conf.put()
+        enqueueConfirmationEmail(email, conf, transactional=True)
+        enqueueFacetDelta(facetDelta([], conferenceFacets(conf)))
 
 
     @ndb.transactional()
@@ -234,6 +327,7 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        old_facets = conferenceFacets(conf)
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
@@ -247,13 +341,23 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        # a moved endDate may bring an archived conference back (or end it)
+        live = isLiveConference(conf)
+        if conf.isLive != live:
+            conf.isLive = live
+            sessions = Session.query(ancestor=conf.key).fetch()
+            for session in sessions:
+                session.isLive = live
+            ndb.put_multi(sessions)
         conf.put()
+        enqueueFacetDelta(facetDelta(old_facets, conferenceFacets(conf)))
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
-    @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
+    @endpoints.method(CONF_CREATE_REQUEST, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @idempotent(ConferenceForm)
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -264,7 +368,9 @@ class ConferenceApi(remote.Service):
             http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        cf = self._updateConferenceObject(request)
+        invalidateHomePage()
+        return cf
 
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
@@ -272,14 +378,73 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        return self._getConferenceAsync(request).get_result()
+
+
+    @ndb.tasklet
+    def _getConferenceAsync(self, request):
+        """Fetch Conference and its organizer Profile in parallel."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # the organizer Profile is the Conference's parent, so both
+        # gets can be issued at once instead of one after the other
+        conf, prof = yield c_key.get_async(), c_key.parent().get_async()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        raise ndb.Return(
+            self._copyConferenceToForm(conf, getattr(prof, 'displayName')))
+
+
+    @staticmethod
+    def _keysFromWebsafe(websafe_keys, kind, parent_kind):
+        """Decode websafe keys of the given kind; None for invalid ones.
+
+        A key must belong to this app and namespace and have a parent of
+        parent_kind, so every valid key and its parent can be fetched.
+        """
+        if len(websafe_keys) > MULTI_GET_MAX_KEYS:
+            raise endpoints.BadRequestException(
+                'At most %d keys per call.' % MULTI_GET_MAX_KEYS)
+        # ndb's own default, which carries the partition prefix ("s~")
+        # that app_identity.get_application_id() leaves out
+        app = ndb.Key(kind, 1).app()
+        namespace = namespace_manager.get_namespace()
+        keys = []
+        for websafe_key in websafe_keys:
+            try:
+                key = ndb.Key(urlsafe=websafe_key)
+            except Exception:
+                # malformed keys are reported as not found
+                key = None
+            if key is not None and (
+                    key.kind() != kind or key.app() != app or
+                    key.namespace() != namespace or key.parent() is None or
+                    key.parent().kind() != parent_kind):
+                key = None
+            keys.append(key)
+        return keys
+
+
+    @endpoints.method(MultiGetForm, ConferenceResultForms,
+            path='conferences/get', http_method='POST',
+            name='getConferencesByKeys')
+    def getConferencesByKeys(self, request):
+        """Return conferences for a list of websafe keys, in request order."""
+        c_keys = self._keysFromWebsafe(request.keys, 'Conference', 'Profile')
+        valid = [key for key in c_keys if key]
+        # organizers are the conferences' parents, so one batch gets both
+        entities = ndb.get_multi(valid + [key.parent() for key in valid])
+        found = dict(zip(valid, zip(entities[:len(valid)],
+                                    entities[len(valid):])))
+        items = []
+        for websafe_key, c_key in zip(request.keys, c_keys):
+            conf, prof = found.get(c_key, (None, None))
+            items.append(ConferenceResultForm(
+                key=websafe_key, found=conf is not None,
+                conference=self._copyConferenceToForm(
+                    conf, getattr(prof, 'displayName', None)) if conf else None))
+        return ConferenceResultForms(items=items)
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -301,24 +466,86 @@ class ConferenceApi(remote.Service):
         )
 
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
+    def _activeWindow(self, request):
+        """Return the (first, last) days of activeFrom/activeTo, or None."""
+        if not request.activeFrom and not request.activeTo:
+            return None
+        try:
+            first = parseDate(request.activeFrom or request.activeTo)
+            last = parseDate(request.activeTo or request.activeFrom)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "activeFrom and activeTo must be YYYY-MM-DD dates.")
+        return first, last
+
+
+    def _getQuery(self, request, window=None):
+        """Return formatted query from the submitted filters, its shape
+        (equality fields, inequality field, orders) for the query shape
+        registry, and the filters left for the caller to apply in memory.
+        window restricts it to conferences whose bucketed days meet
+        (first, last); the caller checks the exact overlap."""
         q = Conference.query()
         inequality_filter, filters = self._formatFilters(request.filters)
+        in_memory = []
+        # ended conferences are archived; leave them out unless asked for.
+        # includePast still filters on isLive so that every query can use
+        # the isLive-prefixed composite indexes
+        if request.includePast:
+            q = q.filter(Conference.isLive.IN([True, False]))
+        else:
+            q = q.filter(Conference.isLive == True)
+        equalities = ['isLive']
+        if window:
+            try:
+                bucket_field, buckets = bucketFilter(*window)
+            except ValueError as e:
+                raise endpoints.BadRequestException(str(e))
+            q = q.filter(ndb.GenericProperty(bucket_field).IN(buckets))
+            equalities.append(bucket_field)
+            # topics is repeated like the buckets, and an index on both
+            # would be exploding; check topics after the fetch instead
+            in_memory = [f for f in filters if f["field"] == "topics"]
+            filters = [f for f in filters if f["field"] != "topics"]
+            if inequality_filter == "topics":
+                inequality_filter = None
 
         # If exists, sort on inequality filter first
         if not inequality_filter:
             q = q.order(Conference.name)
+            orders = ['name']
         else:
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
+            orders = [inequality_filter, 'name']
 
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
                 filtr["value"] = int(filtr["value"])
+            elif filtr["field"] in ["startDate", "endDate"]:
+                try:
+                    filtr["value"] = parseDate(filtr["value"])
+                except ValueError:
+                    raise endpoints.BadRequestException(
+                        "Date filters take YYYY-MM-DD values.")
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
-        return q
+        equalities += [filtr["field"] for filtr in filters if filtr["operator"] == "="]
+        return q, (equalities, inequality_filter, orders), in_memory
+
+
+    @staticmethod
+    def _matchesFilters(conf, filters):
+        """Apply formatted filters to a Conference, with datastore
+        semantics: a repeated property matches if any value does."""
+        for filtr in filters:
+            values = getattr(conf, filtr["field"])
+            if not isinstance(values, list):
+                values = [values]
+            compare = COMPARISONS[filtr["operator"]]
+            if not any(compare(value, filtr["value"]) for value in values):
+                return False
+        return True
 
 
     def _formatFilters(self, filters):
@@ -354,8 +581,26 @@ class ConferenceApi(remote.Service):
             http_method='POST',
             name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences.
+
+        Stops reading before the request deadline; see deadline.py.
+        """
+        budget = RequestBudget()
+        cursor = self._decodeCursor(request.cursor)
+        window = self._activeWindow(request)
+        q, shape, in_memory = self._getQuery(request, window)
+        keep = None
+        if window:
+            # buckets are whole weeks or months
+            keep = lambda conf: (
+                overlaps(conf.startDate, conf.endDate, *window) and
+                self._matchesFilters(conf, in_memory))
+        start = _time.time()
+        # IN queries can resume from a cursor only with a key order
+        conferences, next_cursor, partial = boundedQuery(
+            'queryConferences', q.order(Conference.key), budget, cursor, keep)
+        recordQueryShape('Conference', *shape,
+                         elapsed_ms=(_time.time() - start) * 1000)
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
@@ -370,10 +615,55 @@ class ConferenceApi(remote.Service):
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
                 items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+                conferences],
+                nextCursor=next_cursor, partial=partial
         )
 
 
+    @staticmethod
+    def _decodeCursor(websafe_cursor):
+        """Return the Cursor of a partial answer's nextCursor, or None."""
+        try:
+            return decodeCursor(websafe_cursor)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+
+    @endpoints.method(message_types.VoidMessage, ConferenceFacetForms,
+            path='conference/facets',
+            http_method='GET', name='getConferenceFacets')
+    def getConferenceFacets(self, request):
+        """Return number of conferences per city, topic, month and size."""
+        items = []
+        for facet, count in getFacetCounts().items():
+            name, value = facet.split(':', 1)
+            items.append(ConferenceFacetForm(facet=name, value=value, count=count))
+        items.sort(key=lambda item: (item.facet, -item.count, item.value))
+        return ConferenceFacetForms(items=items)
+
+
+    @endpoints.method(message_types.VoidMessage, ConferenceStatsForm,
+            path='admin/stats',
+            http_method='GET', name='getConferenceStats')
+    def getConferenceStats(self, request):
+        """Return attendance analytics from the latest snapshot (admin only)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if not isAdmin(user):
+            raise endpoints.ForbiddenException('Admin access required.')
+        # numpy is only needed here; keep it off the import path of
+        # every other API call
+        from analytics import getConferenceStats
+        snap, stats = getConferenceStats()
+        if snap is None:
+            raise endpoints.NotFoundException('No analytics snapshot yet.')
+        return ConferenceStatsForm(
+            snapshotAt=str(snap.createdAt),
+            rows=[StatsRowForm(**row) for row in stats['rows']],
+            **dict((k, v) for k, v in stats.items() if k != 'rows'))
+
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
@@ -393,6 +683,12 @@ class ConferenceApi(remote.Service):
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
+        return self._getProfileFromUserAsync().get_result()
+
+
+    @ndb.tasklet
+    def _getProfileFromUserAsync(self):
+        """Tasklet version of _getProfileFromUser()."""
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
@@ -401,7 +697,7 @@ class ConferenceApi(remote.Service):
         # get Profile from datastore
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = yield p_key.get_async()
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -410,9 +706,9 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            yield profile.put_async()
 
-        return profile      # return Profile
+        raise ndb.Return(profile)      # return Profile
 
 
     def _doProfile(self, save_request=None):
@@ -432,6 +728,8 @@ class ConferenceApi(remote.Service):
                         #else:
                         #    setattr(prof, field, val)
             prof.put()
+            # the home page shows organizer display names
+            invalidateHomePage()
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -467,6 +765,8 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        old_facets = conferenceFacets(conf)
+
         # register
         if reg:
             # check if user already registered otherwise add
@@ -474,9 +774,9 @@ class ConferenceApi(remote.Service):
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
+            # check if seats avail; waiters are served first, in order
+            if conf.seatsAvailable <= 0 or hasWaiters(conf.key):
+                raise SoldOutException(
                     "There are no seats available.")
 
             # register user, take away one seat
@@ -493,12 +793,20 @@ class ConferenceApi(remote.Service):
                 prof.conferenceKeysToAttend.remove(wsck)
                 conf.seatsAvailable += 1
                 retval = True
+                # hand the freed seat to the next waiter
+                if hasWaiters(conf.key):
+                    scheduleWaitlistWorker(wsck, transactional=True)
             else:
                 retval = False
 
         # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        if retval:
+            ndb.put_multi([prof, conf,
+                           scopeChange(prof.key, conf.key, removed=not reg)])
+        else:
+            prof.put()
+            conf.put()
+        enqueueFacetDelta(facetDelta(old_facets, conferenceFacets(conf)))
         return BooleanMessage(data=retval)
 
 
@@ -526,50 +834,57 @@ class ConferenceApi(remote.Service):
         )
 
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @endpoints.method(CONF_REGISTER_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @idempotent(BooleanMessage)
     def registerForConference(self, request):
-        """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        """Register user for selected conference.
 
-
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+        Returns false if the registration was queued during a traffic
+        spike; the user is admitted by the waitlist worker shortly after.
+        """
+        wsck = request.websafeConferenceKey
+        # created outside the registration transaction, so a sold out
+        # conference does not roll back a first-time caller's Profile
+        prof = self._getProfileFromUser()
+        if not takeAdmissionToken(wsck):
+            if wsck in prof.conferenceKeysToAttend:
+                raise ConflictException(
+                    "You have already registered for this conference")
+            joinWaitlist(ndb.Key(urlsafe=wsck), prof.key.id())
+            scheduleWaitlistWorker(wsck)
+            return BooleanMessage(data=False)
+        try:
+            result = self._conferenceRegistration(request)
+        except SoldOutException:
+            position = joinWaitlist(ndb.Key(urlsafe=wsck), prof.key.id())
+            # seats may be free with others waiting ahead of this caller
+            scheduleWaitlistWorker(wsck)
+            raise ConflictException(
+                "There are no seats available. You are number %d on the "
+                "waitlist." % position)
+        invalidateHomePage()
+        return result
+
+
+    @endpoints.method(CONF_REGISTER_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @idempotent(BooleanMessage)
     def unregisterFromConference(self, request):
-        """Unregister user for selected conference."""
-        return self._conferenceRegistration(request, reg=False)
-
-
-# - - - Announcements - - - - - - - - - - - - - - - - - - - -
-    @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+        """Unregister user for selected conference (or leave its waitlist)."""
+        result = self._conferenceRegistration(request, reg=False)
+        if result.data:
+            invalidateHomePage()
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
+            user_id = getUserId(endpoints.get_current_user())
+            result.data = leaveWaitlist(
+                ndb.Key(urlsafe=request.websafeConferenceKey), user_id)
+        return result
 
 
+# - - - Announcements - - - - - - - - - - - - - - - - - - - -
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
@@ -577,10 +892,7 @@ class ConferenceApi(remote.Service):
         """Return Announcement from memcache."""
         # TODO 1
         # return an existing announcement from Memcache or an empty string.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ""
-        return StringMessage(data=announcement)
+        return StringMessage(data=getAnnouncement())
 
 # - - - TASK1: Speaker - - - - - - - - - - - - - - - - - - - -
     def _createSpeakerObject(self, request):
@@ -606,6 +918,7 @@ class ConferenceApi(remote.Service):
         data['key'] = s_key
 
         Speaker(**data).put()
+        bumpSpeakerDirectory(s_key)
 
         return request
 
@@ -619,39 +932,57 @@ class ConferenceApi(remote.Service):
         return speaker_form
 
 
+    @endpoints.method(MultiGetForm, SpeakerResultForms,
+            path='speakers/get', http_method='POST',
+            name='getSpeakersByEmails')
+    def getSpeakersByEmails(self, request):
+        '''Return speakers for a list of emails, in request order'''
+        if len(request.keys) > MULTI_GET_MAX_KEYS:
+            raise endpoints.BadRequestException(
+                'At most %d keys per call.' % MULTI_GET_MAX_KEYS)
+        emails = [email for email in request.keys if email]
+        found = dict(zip(emails, ndb.get_multi(
+            [ndb.Key(Speaker, email) for email in emails])))
+        items = []
+        for email in request.keys:
+            speaker = found.get(email)
+            items.append(SpeakerResultForm(
+                key=email, found=speaker is not None,
+                speaker=self._copySpeakerToForm(speaker) if speaker else None))
+        return SpeakerResultForms(items=items)
+
     @endpoints.method(SpeakerForm, SpeakerForm, path='speaker',
             http_method='POST', name='createSpeaker')
     def createSpeaker(self, request):
         '''Create new speaker and upadte speaker.'''
         return self._createSpeakerObject(request)
 
-    def _queryForSpeakers(self, filters):
+    def _queryForSpeakers(self, request):
         """
-        Using the filter to query for speakers.
+        Search the speaker directory.
         Returns:
-          Query results for the filters.
+          Matching speakers as (name, email, company, sex, field) tuples,
+          ordered by name.
         Args:
-          filters: the SpeakerQueryForms's filters.
+          request: the SpeakerQueryForms.
         """
-        formatted_filters = []
-        for f in filters:
-            filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
-            formatted_filters.append(filtr)
-        q = Speaker.query()
-        q = q.order(Speaker.name)
-        for filtr in formatted_filters:
-            query = ndb.query.FilterNode(filtr['field'], "=", filtr['value'])
-            q = q.filter(query)
-        return q
+        filters = [(f.field, f.value) for f in request.filters]
+        try:
+            return searchSpeakers(filters, prefix=request.namePrefix,
+                                  limit=request.limit)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
 
     @endpoints.method(SpeakerQueryForms, SpeakerForms,
             path='querySpeakers', http_method='POST',
             name='querySpeakers')
     def querySpeakers(self, request):
         '''Query for speakers'''
-        speakers = self._queryForSpeakers(request.filters)
-
-        return SpeakerForms(items=[self._copySpeakerToForm(speaker) for speaker in speakers])
+        speakers = self._queryForSpeakers(request)
+        return SpeakerForms(items=[
+            SpeakerForm(name=name, email=email, company=company, sex=sex,
+                        field=list(field))
+            for name, email, company, sex, field in speakers])
 
 # - - - TASK1:Session - - - - - - - - - - - - - - - - - - - -
     def _createSessionObject(self, request):
@@ -662,13 +993,31 @@ class ConferenceApi(remote.Service):
         Args:
           SESSION_CREATE_REQUEST request container
         """
+        return self._createSessionObjectAsync(request).get_result()
+
+    @ndb.tasklet
+    def _createSessionObjectAsync(self, request):
+        """
+        Tasklet version of _createSessionObject(). The conference get,
+        the speaker get and the id allocation are independent, so they
+        are issued together in a single round-trip.
+        """
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
-        c_key = ndb.Key(urlsafe=request.websafeConferenceKey) 
-        conf = c_key.get()
+        if not request.name:
+            raise endpoints.BadRequestException("Session 'name' field required")
+
+        if not request.speaker:
+            raise endpoints.BadRequestException("Session 'speaker' field required")
+
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        speaker_key = ndb.Key(Speaker, request.speaker)
+        conf, speaker, s_ids = yield (c_key.get_async(),
+                                      speaker_key.get_async(),
+                                      Session.allocate_ids_async(size=1, parent=c_key))
 
         if not conf:
             raise endpoints.NotFoundException(
@@ -678,20 +1027,14 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can create the session.')
 
-        if not request.name:
-            raise endpoints.BadRequestException("Session 'name' field required")
-
-        if not request.speaker:
-            raise endpoints.BadRequestException("Session 'speaker' field required")
-
-        speaker_key = ndb.Key(Speaker, request.speaker)
-        if not speaker_key.get():
+        if not speaker:
             raise endpoints.NotFoundException(
                 'No speaker found with id: %s' % request.speaker)
 
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeConferenceKey']
         del data['websafeKey']
+        del data['requestId']
 
         for df in SESSION_DEFAULTS:
             if data[df] in (None, []):
@@ -711,33 +1054,40 @@ class ConferenceApi(remote.Service):
         else:
             data['typeOfSession'] = str(SessionType.NOT_SPECIFIED)
 
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=c_key)
+        s_key = ndb.Key(Session, s_ids[0], parent=c_key)
         data['key'] = s_key
-        Session(**data).put()
+        data['isLive'] = conf.isLive
+        session = Session(**data)
+        yield session.put_async()
 
-        taskqueue.add(params={'speaker_email': request.speaker, 
-            'wsck': request.websafeConferenceKey}, url = '/tasks/set_featured_speaker')
-        return self._copySessionToForm(s_key.get())
+        scheduleFeaturedSpeaker(request.speaker, request.websafeConferenceKey)
+        # the entity we just wrote is complete; no need to read it back
+        raise ndb.Return(self._copySessionToForm(session))
 
     def _copySessionToForm(self, session):
         '''Copy relevant fields from Session to SessionForm.'''
-        s_form = SessionForm()
-        for field in s_form.all_fields():
-            if hasattr(session, field.name):
-                if field.name in ['date', 'startTime']:
-                    setattr(s_form, field.name, str(getattr(session, field.name)))
-                elif field.name == 'typeOfSession':
-                    setattr(s_form, field.name, getattr(SessionType, getattr(session, field.name)))
-                else:
-                    setattr(s_form, field.name, getattr(session, field.name))
-        setattr(s_form, 'websafeKey', session.key.urlsafe())
-        s_form.check_initialized()
-        return s_form
-
+        return copySessionToForm(session)
+
+
+    @endpoints.method(MultiGetForm, SessionResultForms,
+            path='sessions/get', http_method='POST',
+            name='getSessionsByKeys')
+    def getSessionsByKeys(self, request):
+        '''Return sessions for a list of websafe keys, in request order'''
+        s_keys = self._keysFromWebsafe(request.keys, 'Session', 'Conference')
+        valid = [key for key in s_keys if key]
+        found = dict(zip(valid, ndb.get_multi(valid)))
+        items = []
+        for websafe_key, s_key in zip(request.keys, s_keys):
+            session = found.get(s_key)
+            items.append(SessionResultForm(
+                key=websafe_key, found=session is not None,
+                session=self._copySessionToForm(session) if session else None))
+        return SessionResultForms(items=items)
 
     @endpoints.method(SESSION_CREATE_REQUEST, SessionForm,
             path='session', http_method='POST', name='createSession')
+    @idempotent(SessionForm)
     def createSession(self, request):
         '''Create new session'''
         return self._createSessionObject(request)
@@ -774,19 +1124,62 @@ class ConferenceApi(remote.Service):
             items=[self._copySessionToForm(session) for session in q]
         )
 
+    @endpoints.method(SessionDateRangeForm, SessionForms,
+            path='sessions/daterange', http_method='GET',
+            name='getSessionsByDateRange')
+    def getSessionsByDateRange(self, request):
+        '''Return sessions between two dates, optionally by start time'''
+        try:
+            first = parseDate(request.startDate or request.endDate)
+            last = parseDate(request.endDate or request.startDate)
+            time_from = (parseTime(request.startTimeFrom)
+                         if request.startTimeFrom else None)
+            time_to = (parseTime(request.startTimeTo)
+                       if request.startTimeTo else None)
+        except (TypeError, ValueError):
+            raise endpoints.BadRequestException(
+                'startDate/endDate (YYYY-MM-DD) are required; start times '
+                'are HH:MM.')
+        if request.websafeConferenceKey:
+            q = Session.query(
+                ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        else:
+            q = Session.query(Session.isLive == True)
+        if first == last:
+            # one day: the start time range can use the index too
+            q = q.filter(Session.date == first)
+            if time_from:
+                q = q.filter(Session.startTime >= time_from)
+            if time_to:
+                q = q.filter(Session.startTime <= time_to)
+            sessions = q.order(Session.startTime)
+        else:
+            q = q.filter(Session.date >= first, Session.date <= last)
+            sessions = [s for s in q.order(Session.date, Session.startTime)
+                        if (not time_from or (s.startTime and s.startTime >= time_from))
+                        and (not time_to or (s.startTime and s.startTime <= time_to))]
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions]
+        )
+
     @endpoints.method(SES_SEPAKER_GET_REQUEST, SessionForms,
             path='session/querybuspeaker', http_method='POST',
             name='getSessionsBySpeaker')
     def getSessionsBySpeaker(self, request):
         '''Return all sessions of the speaker'''
+        budget = RequestBudget()
+        cursor = self._decodeCursor(request.cursor)
         speaker_key = ndb.Key(Speaker, request.speaker)
         if not speaker_key.get():
             raise endpoints.NotFoundException(
                 'No speaker found with id: %s' % request.speaker)
-        q = Session.query()
+        q = Session.query(Session.isLive == True)
         q = q.filter(Session.speaker == request.speaker)
+        sessions, next_cursor, partial = boundedQuery(
+            'getSessionsBySpeaker', q, budget, cursor)
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in q]
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextCursor=next_cursor, partial=partial
         )
 
 # - - - TASK2:Wishlist - - - - - - - - - - - - - - - - - - - -
@@ -800,9 +1193,16 @@ class ConferenceApi(remote.Service):
           request: SES_REQUEST
           add: Bool, if is true add to wishlist else remove.
         """
-        prof = self._getProfileFromUser()
+        return self._wishlistHandleAsync(request, add).get_result()
+
+    @ndb.tasklet
+    def _wishlistHandleAsync(self, request, add=True):
+        """
+        Tasklet version of _wishlistHandle(); the Profile and the Session
+        are fetched in parallel.
+        """
         s_key = ndb.Key(urlsafe=request.sessionKey)
-        session = s_key.get()
+        prof, session = yield self._getProfileFromUserAsync(), s_key.get_async()
         retval = None
         if not session:
             raise endpoints.NotFoundException(
@@ -824,8 +1224,31 @@ class ConferenceApi(remote.Service):
             else:
                 retval = False
 
-        prof.put()
-        return BooleanMessage(data=retval)
+        if retval:
+            yield ndb.put_multi_async([prof, scopeChange(
+                prof.key, s_key, removed=not add)])
+            self._scheduleRecommendationRefresh(prof.key.id())
+        else:
+            yield prof.put_async()
+        raise ndb.Return(BooleanMessage(data=retval))
+
+    @staticmethod
+    def _scheduleRecommendationRefresh(user_id):
+        '''
+         Queue a debounced refresh of the user's recommended sessions
+            after their wishlist changed.
+        Args:
+            user_id: the Profile id
+        '''
+        bucket = int(_time.time() // RECOMMENDATION_REFRESH_SECS)
+        try:
+            taskqueue.add(name='recommend-%s-%d' % (
+                              hashlib.md5(user_id).hexdigest(), bucket),
+                          params={'user_id': user_id},
+                          countdown=RECOMMENDATION_REFRESH_SECS,
+                          url='/tasks/refresh_recommendations')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
 
     @endpoints.method(SES_REQUEST, BooleanMessage,
             path='session/add_whishlist', http_method='POST',
@@ -841,6 +1264,46 @@ class ConferenceApi(remote.Service):
         '''Removes the session from the user's whislist'''
         return self._wishlistHandle(request, add=False)
 
+    @endpoints.method(message_types.VoidMessage, SessionForms,
+            path='session/recommended', http_method='GET',
+            name='getRecommendedSessions')
+    def getRecommendedSessions(self, request):
+        '''Get precomputed recommended sessions for the user'''
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        rec = ndb.Key(Recommendation, getUserId(user)).get()
+        if not rec or not rec.forms:
+            return SessionForms(items=[])
+        return protojson.decode_message(SessionForms, rec.forms)
+
+    @endpoints.method(SYNC_REQUEST, SyncForm,
+            path='sync', http_method='GET', name='sync')
+    def sync(self, request):
+        '''Return what changed in the user's data since syncToken'''
+        prof = self._getProfileFromUser()
+        try:
+            changes = collectChanges(prof, request.syncToken)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        confs = changes['conferences']
+        organisers = ndb.get_multi(list(set(
+            ndb.Key(Profile, conf.organizerUserId) for conf in confs)))
+        names = dict((p.key.id(), p.displayName) for p in organisers if p)
+        return SyncForm(
+            profile=(self._copyProfileToForm(changes['profile'])
+                     if changes['profile'] else None),
+            conferences=[self._copyConferenceToForm(
+                conf, names.get(conf.organizerUserId)) for conf in confs],
+            sessions=[self._copySessionToForm(s) for s in changes['sessions']],
+            speakers=[self._copySpeakerToForm(s) for s in changes['speakers']],
+            removed=[SyncRemovedForm(kind=kind, websafeKey=key)
+                     for kind, key in changes['removed']],
+            syncToken=changes['token'],
+            more=changes['more'],
+            reset=changes['reset'],
+        )
+
     @endpoints.method(message_types.VoidMessage, SessionForms,
             path='wishlist', http_method='GET', name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
@@ -856,14 +1319,24 @@ class ConferenceApi(remote.Service):
 
 
 # - - - TASK2: Two additional queries - - - - - - - - - - - - - - - - - - - -
-    @endpoints.method(SessionHighlightsForm, SessionForms,
+    @endpoints.method(SessionHighlightsForm, SessionSearchForms,
             path='session/highlights', http_method='GET', 
             name='getSessionsWithHighlights')
     def getSessionsWithHighlights(self, request):
-        '''Get sessions in the list of highlights'''
-        q = Session.query(Session.highlights.IN(request.highlights))
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in q]
+        '''Get sessions with the most matching highlights, newest first'''
+        try:
+            s_keys, next_cursor = searchHighlights(
+                request.highlights,
+                conference=request.websafeConferenceKey or None,
+                cursor=request.cursor, limit=request.limit)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        # the index can lag behind archiving
+        sessions = [s for s in ndb.get_multi(s_keys)
+                    if s and s.isLive is not False]
+        return SessionSearchForms(
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextCursor=next_cursor
         )
 
     @endpoints.method(SessionSpeakerFieldForm, SessionForms,
@@ -871,88 +1344,53 @@ class ConferenceApi(remote.Service):
             name='getSessionsWithSpeakerField')
     def getSessionsWithSpeakerField(self, request):
         '''Get sessions with the speaker's fields'''
+        budget = RequestBudget()
+        cursor = self._decodeCursor(request.cursor)
         speakers = Speaker.query(Speaker.field.IN(request.fields)).fetch()
         if speakers == []:
             return SessionForms(items=[])
         speakers_email = [speaker.email for speaker in speakers]
-        sessions = Session.query(Session.speaker.IN(speakers_email))
+        # IN queries can resume from a cursor only with a key order
+        q = Session.query(Session.isLive == True,
+                          Session.speaker.IN(speakers_email)).order(Session.key)
+        sessions, next_cursor, partial = boundedQuery(
+            'getSessionsWithSpeakerField', q, budget, cursor)
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextCursor=next_cursor, partial=partial
         )
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(TASK3_REQUEST, SessionForms,
             path='session/task3', http_method='POST',
             name='task3')
     def task3(self, request):
         '''
             This query is for the task3:Query Problem
             Args:
-                have no input info
+                cursor: nextCursor of a partial answer
             Return:
                 a list of sessions in which each session 
                     is not workshop and start before 7:00pm
         '''
+        budget = RequestBudget()
+        cursor = self._decodeCursor(request.cursor)
         aim_time = time(19)
-        sessions = Session.query(Session.startTime < aim_time)
-        result_sessions = []
-        result_sessions = [session for session in sessions if 
-                                session.typeOfSession != 'WORKSHOP' and
-                                session.startTime != None]
+        sessions = Session.query(Session.isLive == True,
+                                 Session.startTime < aim_time)
+        result_sessions, next_cursor, partial = boundedQuery(
+            'task3', sessions, budget, cursor,
+            keep=lambda session: session.typeOfSession != 'WORKSHOP' and
+                                 session.startTime != None)
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in result_sessions]
+            items=[self._copySessionToForm(session) for session in result_sessions],
+            nextCursor=next_cursor, partial=partial
         )
 
 # - - - TASK4: Add a Task - - - - - - - - - - - - - - - - - - - -
-    @staticmethod
-    def _cacheFeaturedSpeaker(speaker_email, wsck):
-        '''
-         If there is more than one session by this speaker at this conference, 
-            then assign the Featured Speaker to memcache
-        Args: 
-            speaker_email: The speaker's email
-            wsck: the aimed conference's web safe url key
-        '''
-        # Fetch a list of Sessions at the provided Conference
-        # that the Speaker is speaking at.
-        s_key = ndb.Key(Speaker, speaker_email)
-        speaker = s_key.get()
-        c_key = ndb.Key(urlsafe=wsck)
-        q = Session.query(ancestor=c_key)
-        sessions = q.filter(Session.speaker == speaker_email).fetch()
-        # if sesions count <= 1 break the function.
-        if len(sessions) <= 1:
-            return
-        # Set the featured string for the speaker.
-        featuredInfo = "| %s's sessions: %s" %(speaker.name ,','.join(session.name for session in sessions))
-        cacheInfo = memcache.get(MEMCACHE_FEATUREDSPEAKER_KEY)
-        featuredStr = ""
-        # This tag is used to check if speaker is already in the memcache
-        isChanged = False
-        if not cacheInfo:
-            featuredStr = "Featured Speakers:" + featuredInfo
-            isChanged = True
-        else:
-            infos = cacheInfo.split('|',1)
-            for (i, info) in enumerate(infos):
-                if i == 0:
-                    continue
-                if speaker.name in info:
-                    isChanged=True
-                    infos[i] = featuredInfo[1:]
-            featuredStr = '|'.join(infos)
-        # If the speaker's info is not in the memcache, then append this str.
-        if not isChanged:
-            featuredStr += featuredInfo
-        # Set memcache
-        memcache.set(MEMCACHE_FEATUREDSPEAKER_KEY, featuredStr)
-
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='featuredspeaker', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
         '''Get featured speaker info'''
-        featuredInfo = memcache.get(MEMCACHE_FEATUREDSPEAKER_KEY)
-        if not featuredInfo:
-            featuredInfo = ""
-        return StringMessage(data=featuredInfo)
+        return StringMessage(data=getFeaturedSpeaker())
 
 api = endpoints.api_server([ConferenceApi]) # register API
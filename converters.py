@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Entity -> ProtoRPC form converters that do not need the Endpoints API.
+The recommendation task handlers render sessions, and the home page
+handler conferences, with them without importing conference.py.
+
+"""
+
+import threading
+
+from models import ConferenceForm
+from models import Session
+from models import SessionForm
+from models import SessionType
+
+# (field name, conversion) pairs, computed once per instance; warmup
+# builds them before the first request arrives
+_sessionFields = []
+_sessionFieldsLock = threading.Lock()
+
+
+def buildConverters():
+    """Precompute the SessionForm fields copied from a Session."""
+    if _sessionFields:
+        return _sessionFields
+    with _sessionFieldsLock:
+        if not _sessionFields:
+            fields = []
+            for field in SessionForm.all_fields():
+                if field.name in ('date', 'startTime'):
+                    fields.append((field.name, str))
+                elif field.name == 'typeOfSession':
+                    fields.append((field.name,
+                                   lambda value: getattr(SessionType, value)))
+                elif field.name in Session._properties:
+                    fields.append((field.name, None))
+            # one slice assignment: other threads never see a partial list
+            _sessionFields[:] = fields
+    return _sessionFields
+
+
+def copySessionToForm(session):
+    """Copy relevant fields from Session to SessionForm."""
+    s_form = SessionForm()
+    for name, convert in buildConverters():
+        value = getattr(session, name)
+        setattr(s_form, name, convert(value) if convert else value)
+    s_form.websafeKey = session.key.urlsafe()
+    s_form.check_initialized()
+    return s_form
+
+
+def copyConferenceToForm(conf, displayName):
+    """Copy relevant fields from Conference to ConferenceForm."""
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            # convert Date to date string; just copy others
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
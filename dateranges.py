@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""dateranges.py
+
+Bucketed-day index for "active between A and B" conference queries.
+
+Datastore queries allow inequality filters on one property only, so
+"startDate <= B and endDate >= A" cannot be a single query. Instead,
+every Conference stores the week and month buckets its days fall in
+(Conference.activeWeeks / activeMonths, computed on put). An overlap
+query becomes an equality IN over the buckets of [A, B]. It uses the
+finest level that needs at most MAX_BUCKETS values, and the exact
+overlap is then checked on the fetched conferences.
+
+"""
+
+from datetime import datetime
+
+# IN is expanded into one subquery per value and ndb allows 30 in all;
+# queryConferences may also IN over isLive
+MAX_BUCKETS = 15
+DATE_FORMAT = '%Y-%m-%d'
+TIME_FORMAT = '%H:%M'
+
+
+def parseDate(value):
+    """Parse YYYY-MM-DD; ValueError if malformed."""
+    return datetime.strptime(value[:10], DATE_FORMAT).date()
+
+
+def parseTime(value):
+    """Parse HH:MM; ValueError if malformed."""
+    return datetime.strptime(value[:5], TIME_FORMAT).time()
+
+
+def weekBucket(day):
+    return day.toordinal() // 7
+
+
+def monthBucket(day):
+    return day.year * 12 + day.month - 1
+
+
+def _span(start, end):
+    """Return the (first, last) day of a date range, tolerating gaps."""
+    if start is None:
+        return None
+    if end is None or end < start:
+        end = start
+    return start, end
+
+
+def activeWeeks(start, end):
+    """Week buckets covered by [start, end]; empty without a start date."""
+    span = _span(start, end)
+    if span is None:
+        return []
+    return range(weekBucket(span[0]), weekBucket(span[1]) + 1)
+
+
+def activeMonths(start, end):
+    """Month buckets covered by [start, end]; empty without a start date."""
+    span = _span(start, end)
+    if span is None:
+        return []
+    return range(monthBucket(span[0]), monthBucket(span[1]) + 1)
+
+
+def bucketFilter(first, last):
+    """Return (property name, bucket values) covering [first, last].
+
+    Raises ValueError if the range is reversed or too wide.
+    """
+    if last < first:
+        raise ValueError('activeTo is before activeFrom.')
+    weeks = activeWeeks(first, last)
+    if len(weeks) <= MAX_BUCKETS:
+        return 'activeWeeks', weeks
+    months = activeMonths(first, last)
+    if len(months) <= MAX_BUCKETS:
+        return 'activeMonths', months
+    raise ValueError('Date ranges are limited to %d months.' % MAX_BUCKETS)
+
+
+def overlaps(start, end, first, last):
+    """True if the entity range [start, end] meets [first, last]."""
+    span = _span(start, end)
+    return span is not None and span[0] <= last and span[1] >= first
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""deadline.py
+
+Deadline-aware query execution.
+
+An API request is cut off after 60 seconds, and everything it read is
+lost. boundedQuery() iterates a query only while the request's budget
+lasts. When the budget runs out, or a datastore RPC times out, it
+returns the entities read so far with a cursor to continue from and
+partial=True. The client can then show them and ask for the rest.
+
+Every run and every truncation is counted per method in memcache;
+truncationStats() reports the ratios at /admin/query_truncations.
+
+"""
+
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+
+from settings import QUERY_BATCH_SIZE
+from settings import QUERY_BUDGET_SECS
+
+MEMCACHE_QUERY_RUNS_PREFIX = "QUERY_RUNS:"
+MEMCACHE_QUERY_TRUNCATED_PREFIX = "QUERY_TRUNCATED:"
+# API methods that run their queries through boundedQuery()
+BOUNDED_METHODS = ('queryConferences', 'getSessionsBySpeaker',
+                   'getSessionsWithSpeakerField', 'task3')
+
+
+class RequestBudget(object):
+    """Time left for the datastore work of one request."""
+
+    def __init__(self, seconds=QUERY_BUDGET_SECS, clock=time.time):
+        self._clock = clock
+        self.deadline = clock() + seconds
+
+    def remaining(self):
+        return self.deadline - self._clock()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def _record(method, truncated):
+    counters = {MEMCACHE_QUERY_RUNS_PREFIX + method: 1}
+    if truncated:
+        counters[MEMCACHE_QUERY_TRUNCATED_PREFIX + method] = 1
+        logging.warning('%s returned partial results at the request '
+                        'deadline', method)
+    memcache.offset_multi(counters, initial_value=0)
+
+
+def decodeCursor(websafe_cursor):
+    """Return the Cursor for a client's continuation, or None.
+
+    Raises ValueError if it is malformed.
+    """
+    if not websafe_cursor:
+        return None
+    try:
+        return Cursor(urlsafe=websafe_cursor)
+    except (datastore_errors.BadValueError, TypeError):
+        raise ValueError('Invalid cursor: %s' % websafe_cursor)
+
+
+def _resumeCursor(it, cursor):
+    """Return the position after the last entity read, or cursor."""
+    try:
+        return it.cursor_after()
+    except datastore_errors.BadArgumentError:
+        # no entity read yet
+        return cursor
+
+
+def boundedQuery(method, query, budget=None, cursor=None, keep=None):
+    """Iterate query until it ends or the request budget runs out.
+
+    cursor is where a previous partial run stopped; keep, if given,
+    filters entities in memory. Returns (entities, next websafe cursor,
+    partial); the cursor is None when the query was read to the end.
+    """
+    budget = budget or RequestBudget()
+    results = []
+    it = query.iter(start_cursor=cursor, produce_cursors=True,
+                    batch_size=QUERY_BATCH_SIZE,
+                    deadline=max(budget.remaining(), 1))
+    next_cursor, partial = None, False
+    try:
+        while not budget.expired():
+            if not it.has_next():
+                break
+            entity = it.next()
+            if keep is None or keep(entity):
+                results.append(entity)
+        else:
+            next_cursor, partial = _resumeCursor(it, cursor), True
+    except datastore_errors.Timeout:
+        next_cursor, partial = _resumeCursor(it, cursor), True
+        if next_cursor is None:
+            # nothing to return and nowhere to resume from
+            raise
+    _record(method, partial)
+    return results, next_cursor.urlsafe() if next_cursor else None, partial
+
+
+def truncationStats():
+    """Return {method: {runs, truncated, ratio}} for BOUNDED_METHODS."""
+    keys = []
+    for method in BOUNDED_METHODS:
+        keys += [MEMCACHE_QUERY_RUNS_PREFIX + method,
+                 MEMCACHE_QUERY_TRUNCATED_PREFIX + method]
+    counters = memcache.get_multi(keys)
+    stats = {}
+    for method in BOUNDED_METHODS:
+        runs = int(counters.get(MEMCACHE_QUERY_RUNS_PREFIX + method) or 0)
+        truncated = int(
+            counters.get(MEMCACHE_QUERY_TRUNCATED_PREFIX + method) or 0)
+        stats[method] = {'runs': runs, 'truncated': truncated,
+                         'ratio': float(truncated) / runs if runs else 0.0}
+    return stats
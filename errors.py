@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+"""errors.py
+
+Endpoints exceptions used by ConferenceApi and its decorators. Kept out
+of models.py so that task handlers importing models do not load the
+Endpoints library.
+
+"""
+
+import httplib
+
+import endpoints
+
+
+class ConflictException(endpoints.ServiceException):
+    """ConflictException -- exception mapped to HTTP 409 response"""
+    http_status = httplib.CONFLICT
+
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- rate limit hit, mapped to HTTP 403
+
+    The Endpoints v1 frontend does not pass 429 through; 403 with a
+    rateLimitExceeded message is what Google APIs answer as well.
+    """
+    http_status = httplib.FORBIDDEN
+
+class SoldOutException(ConflictException):
+    """SoldOutException -- registration attempted with no seats left"""
+    pass
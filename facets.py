@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""facets.py
+
+Incrementally maintained facet counts for the conference browser.
+
+Each write path computes the facet values of a Conference before and
+after the change and queues the difference (transactionally, when called
+inside the write's transaction). /tasks/update_facets applies it to one
+ConferenceFacetShard picked by hashing the task name, so concurrent
+writers rarely touch the same entity group. The shard remembers the
+names of the tasks it applied, so a retried task is not counted twice.
+Readers sum all shards with one get_multi and keep the total in the
+two-tier cache.
+
+Only live conferences are counted, matching the browse queries; the
+archive task removes a conference's facets when it clears isLive.
+rebuildFacetCounts() recounts from scratch in a chain of tasks.
+
+"""
+
+import collections
+import hashlib
+import json
+import random
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from hotcache import hot_cache
+from models import Conference
+from models import ConferenceFacetShard
+
+FACET_SHARDS = 20
+MEMCACHE_FACETS_KEY = "CONFERENCE_FACETS"
+# applied task names kept per shard; far more than are retried at once
+APPLIED_KEPT = 500
+REBUILD_BATCH = 500
+
+# upper bounds of the MAX_ATTENDEES buckets
+SEAT_BUCKETS = (50, 100, 500, 1000)
+
+
+def _seatBucket(max_attendees):
+    """Return the MAX_ATTENDEES bucket label for a conference size."""
+    if not max_attendees:
+        return '0'
+    lower = 1
+    for upper in SEAT_BUCKETS:
+        if max_attendees <= upper:
+            return '%d-%d' % (lower, upper)
+        lower = upper + 1
+    return '%d+' % lower
+
+
+def conferenceFacets(conf):
+    """Return the list of "FACET:value" strings a Conference counts towards."""
+    if conf is None or conf.isLive is False:
+        return []
+    facets = ['CITY:%s' % conf.city] if conf.city else []
+    facets.extend('TOPIC:%s' % topic for topic in set(conf.topics or []))
+    facets.append('MONTH:%d' % (conf.month or 0))
+    facets.append('MAX_ATTENDEES:%s' % _seatBucket(conf.maxAttendees))
+    facets.append('SEATS:%s' % (
+        'available' if (conf.seatsAvailable or 0) > 0 else 'sold_out'))
+    return facets
+
+
+def facetDelta(old, new):
+    """Return {facet: change} between two conferenceFacets() results."""
+    delta = collections.Counter(new)
+    delta.subtract(collections.Counter(old))
+    return dict((facet, n) for facet, n in delta.items() if n)
+
+
+def enqueueFacetDelta(delta):
+    """Queue a facet delta; transactional if called inside a transaction."""
+    if not delta:
+        return
+    taskqueue.add(url='/tasks/update_facets',
+                  params={'delta': json.dumps(delta)},
+                  transactional=ndb.in_transaction())
+
+
+def _shardKey(index):
+    return ndb.Key(ConferenceFacetShard, 'shard-%d' % index)
+
+
+@ndb.transactional()
+def _applyToShard(shard_key, delta, delta_id=None):
+    """Add delta to a shard; False if delta_id was applied already."""
+    shard = shard_key.get() or ConferenceFacetShard(key=shard_key)
+    if delta_id:
+        if delta_id in shard.applied:
+            return False
+        shard.applied = (shard.applied + [delta_id])[-APPLIED_KEPT:]
+    counts = shard.counts or {}
+    for facet, n in delta.items():
+        counts[facet] = counts.get(facet, 0) + n
+        if not counts[facet]:
+            del counts[facet]
+    shard.counts = counts
+    shard.put()
+    return True
+
+
+def applyFacetDelta(delta, delta_id=None):
+    """Add delta to a shard and invalidate the cached totals.
+
+    delta_id (the task name) picks the shard, so a retry of the same
+    task lands on the shard that remembers it.
+    """
+    if delta_id:
+        index = int(hashlib.md5(delta_id).hexdigest(), 16) % FACET_SHARDS
+    else:
+        index = random.randrange(FACET_SHARDS)
+    if _applyToShard(_shardKey(index), delta, delta_id):
+        hot_cache.delete(MEMCACHE_FACETS_KEY)
+
+
+def getFacetCounts():
+    """Return {facet: count} summed over all shards."""
+    counts = hot_cache.get(MEMCACHE_FACETS_KEY)
+    if counts is not None:
+        return counts
+    counts = collections.Counter()
+    for shard in ndb.get_multi([_shardKey(i) for i in range(FACET_SHARDS)]):
+        if shard and shard.counts:
+            counts.update(shard.counts)
+    counts = dict((facet, n) for facet, n in counts.items() if n > 0)
+    hot_cache.set(MEMCACHE_FACETS_KEY, counts)
+    return counts
+
+
+def enqueueRebuildTask(cursor=None, counts=None):
+    """Queue the next link of the facet rebuild task chain."""
+    params = {'counts': json.dumps(counts or {})}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    taskqueue.add(url='/tasks/rebuild_facets', params=params)
+
+
+def rebuildFacetCounts(cursor=None, counts=None):
+    """Recount one batch of live conferences and chain the next.
+
+    The counts so far travel with the task chain; the last batch
+    writes them into shard 0 and empties the others (admin backfill).
+    Returns the number of conferences counted in this batch.
+    """
+    counts = collections.Counter(counts or {})
+    confs, next_cursor, more = Conference.query(
+        Conference.isLive == True).fetch_page(
+            REBUILD_BATCH,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    for conf in confs:
+        counts.update(conferenceFacets(conf))
+    if more and next_cursor:
+        enqueueRebuildTask(next_cursor, dict(counts))
+        return len(confs)
+    shards = [ConferenceFacetShard(key=_shardKey(i), counts={})
+              for i in range(FACET_SHARDS)]
+    shards[0].counts = dict(counts)
+    ndb.put_multi(shards)
+    hot_cache.delete(MEMCACHE_FACETS_KEY)
+    return len(confs)
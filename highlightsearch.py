@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+"""highlightsearch.py
+
+Ranked highlight search for getSessionsWithHighlights.
+
+A cron job builds an inverted index from normalized highlight to live
+sessions and stores it as a compressed .npz, split over HighlightIndexParts.
+The build is a chain of tasks: each reads SESSION_BATCH sessions by
+cursor and stages their sort keys and terms as arrays; the last one
+sorts and merges the staged arrays into the index.
+Sessions are numbered in result order (date descending, then conference
+and id), so every posting list is a sorted array of those numbers and
+a smaller number means an earlier result.
+
+A search merges the posting lists of the query terms. Runs of equal
+numbers in the merged array give each session's number of matched
+highlights. Results are ranked by that count, then by date. Sessions
+created after the index was built are read from the datastore and
+ranked the same way, so new sessions show up before the next rebuild.
+Until the first build finishes, searches return nothing.
+
+The build reads sessions by isLive, so sessions written before isLive
+and created existed are missing from it; backfill them once with the
+session_stamps mapper.
+
+A cursor holds the (count, date, conference, id) of the last result.
+Paging stays stable even when the index is rebuilt between pages.
+
+"""
+
+import base64
+import bisect
+import datetime
+import io
+import json
+import threading
+import time
+
+import numpy as np
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import HighlightIndex
+from models import HighlightIndexPart
+from models import Session
+
+MAX_TERMS = 50
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+# bytes of .npz per HighlightIndexPart, below the 1MB entity limit
+PART_BYTES = 900000
+RECHECK_SECS = 60.0
+SESSION_BATCH = 2000
+
+_lock = threading.Lock()
+# per-instance copy of the newest index and of the sessions created since
+_loaded = {}
+
+
+def normalizeHighlight(highlight):
+    """Lowercase and collapse whitespace; None for empty highlights.
+
+    Terms are utf-8 byte strings so they sort like the index's arrays.
+    """
+    term = u' '.join((highlight or u'').lower().split())
+    if not term or term == u'not_specified':
+        return None
+    return term.encode('utf-8')
+
+
+def _sortKey(date, conference, session_id):
+    """Result order within one match count: newest first."""
+    return (-(date.toordinal() if date else 0), conference, session_id)
+
+
+def _sessionSortKey(session):
+    return _sortKey(session.date, session.key.parent().urlsafe(),
+                    session.key.id())
+
+
+def _packArrays(**arrays):
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+
+def _batchKey(index_key, batch):
+    # names sort after the numeric ids of the final parts
+    return ndb.Key(HighlightIndexPart, 'batch-%06d' % batch,
+                   parent=index_key)
+
+
+def startIndex():
+    """Create a new HighlightIndex and queue its first batch."""
+    index_key = HighlightIndex(builtFrom=datetime.datetime.now()).put()
+    enqueueIndexTask(index_key, 0)
+    return index_key
+
+
+def enqueueIndexTask(index_key, batch, cursor=None):
+    params = {'index': index_key.urlsafe(), 'batch': batch}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    taskqueue.add(url='/tasks/build_highlight_index', params=params)
+
+
+def indexBatch(index, batch, cursor=None):
+    """Stage one batch of live sessions and chain the next.
+
+    The batch is saved as a staging part named after its number, so a
+    retried task overwrites it. The last batch builds the index.
+    """
+    index_key = ndb.Key(urlsafe=index)
+    sessions, next_cursor, more = Session.query(
+        Session.isLive == True).fetch_page(
+            SESSION_BATCH,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    docs, terms = [], []
+    for doc, session in enumerate(sessions):
+        for term in set(map(normalizeHighlight, session.highlights)):
+            if term:
+                docs.append(doc)
+                terms.append(term)
+    HighlightIndexPart(key=_batchKey(index_key, batch), data=_packArrays(
+        date=np.array([-_sessionSortKey(s)[0] for s in sessions],
+                      dtype=np.int32),
+        conf=np.array([s.key.parent().urlsafe() for s in sessions],
+                      dtype=str),
+        ids=np.array([s.key.id() for s in sessions], dtype=np.int64),
+        docs=np.array(docs, dtype=np.int32),
+        terms=np.array(terms, dtype=str))).put()
+    if more and next_cursor:
+        enqueueIndexTask(index_key, batch + 1, next_cursor)
+    else:
+        _finishIndex(index_key, batch + 1)
+
+
+def _finishIndex(index_key, batches):
+    """Merge the staging parts into the index's final parts."""
+    index = index_key.get()
+    if index is None or index.complete:
+        # a retry after the index was finished
+        return
+    staging_keys = [_batchKey(index_key, i) for i in range(batches)]
+    staged = [np.load(io.BytesIO(part.data))
+              for part in ndb.get_multi(staging_keys)]
+    cat = lambda name, dtype: np.concatenate(
+        [part[name] for part in staged] + [np.zeros(0, dtype=dtype)])
+    date, conf, ids = cat('date', np.int32), cat('conf', str), \
+        cat('ids', np.int64)
+    offsets = np.cumsum([0] + [len(part['ids']) for part in staged])
+    docs = np.concatenate([part['docs'] + offset for part, offset
+                           in zip(staged, offsets)] +
+                          [np.zeros(0, dtype=np.int32)])
+    terms = cat('terms', str)
+
+    conferences, conf_codes = np.unique(conf, return_inverse=True)
+    # result order: newest first, then conference and id (_sortKey)
+    order = np.lexsort((ids, conf_codes, -date.astype(np.int64)))
+    position = np.empty(len(order), dtype=np.int32)
+    position[order] = np.arange(len(order), dtype=np.int32)
+    vocab, term_codes = np.unique(terms, return_inverse=True)
+    pairs_doc = position[docs]
+    # by term, then by document: each term's postings come out sorted
+    pair_order = np.lexsort((pairs_doc, term_codes))
+    sorted_terms = term_codes[pair_order]
+    data = _packArrays(
+        terms=vocab.astype(str),
+        term_ptr=np.searchsorted(sorted_terms, np.arange(len(vocab) + 1)),
+        postings=pairs_doc[pair_order].astype(np.int32),
+        date=date[order],
+        conf=conf_codes[order].astype(np.int32),
+        ids=ids[order],
+        conferences=conferences.astype(str))
+
+    # ids keep the parts in byte order for _loadIndex
+    parts = [HighlightIndexPart(id=start // PART_BYTES + 1, parent=index_key,
+                                data=data[start:start + PART_BYTES])
+             for start in range(0, len(data), PART_BYTES)]
+    ndb.put_multi(parts)
+    index.numTerms, index.numDocs = len(vocab), len(ids)
+    index.numParts = len(parts)
+    index.complete = True
+    index.put()
+    ndb.delete_multi(staging_keys)
+    # a newer build may still be running; leave it and its parts alone
+    for old in HighlightIndex.query(HighlightIndex.complete == True):
+        if old.createdAt < index.createdAt:
+            ndb.delete_multi(HighlightIndexPart.query(
+                ancestor=old.key).fetch(keys_only=True) + [old.key])
+
+
+def _loadIndex(now=None):
+    """Return the newest index and recent sessions, cached per instance."""
+    now = now if now is not None else time.time()
+    with _lock:
+        loaded = dict(_loaded)
+    if loaded.get('checked', 0) + RECHECK_SECS > now:
+        return loaded
+    latest = HighlightIndex.query(HighlightIndex.complete == True).order(
+        -HighlightIndex.createdAt).get()
+    if latest is None:
+        # nothing to search until the first build finishes; scanning
+        # every session here instead would repeat each RECHECK_SECS
+        loaded = {'index': None, 'recent': [], 'key': None, 'checked': now}
+        with _lock:
+            _loaded.clear()
+            _loaded.update(loaded)
+        return loaded
+    if loaded.get('key') != latest.key:
+        if latest.numParts is None:
+            # built in one request, before staging parts existed
+            parts = HighlightIndexPart.query(ancestor=latest.key)
+        else:
+            # by id: the ancestor query would also see staging parts
+            parts = ndb.get_multi(
+                [ndb.Key(HighlightIndexPart, i, parent=latest.key)
+                 for i in range(1, latest.numParts + 1)])
+        data = ''.join(part.data for part in parts)
+        archive = np.load(io.BytesIO(data))
+        loaded = {'key': latest.key,
+                  'builtFrom': latest.builtFrom or latest.createdAt,
+                  'index': dict((name, archive[name])
+                                for name in archive.files)}
+    loaded['recent'] = [
+        s for s in Session.query(Session.created >= loaded['builtFrom'])
+        if s.isLive is not False]
+    loaded['checked'] = now
+    with _lock:
+        _loaded.clear()
+        _loaded.update(loaded)
+    return loaded
+
+
+class _DocOrder(object):
+    """Sequence view of the index's documents as their sort keys."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index['date'])
+
+    def __getitem__(self, doc):
+        index = self.index
+        return (-int(index['date'][doc]),
+                str(index['conferences'][index['conf'][doc]]),
+                int(index['ids'][doc]))
+
+
+def encodeCursor(count, sort_key):
+    return base64.urlsafe_b64encode(json.dumps([count] + list(sort_key)))
+
+
+def decodeCursor(cursor):
+    """Return (count, sort_key); ValueError if the cursor is malformed."""
+    try:
+        count, date, conference, session_id = json.loads(
+            base64.urlsafe_b64decode(str(cursor)))
+        return int(count), (int(date), str(conference), session_id)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+
+
+def _indexMatches(index, terms, scope, after, exclude):
+    """Return (docs, counts) of index matches ranked after `after`."""
+    vocab = index['terms']
+    ptr, postings = index['term_ptr'], index['postings']
+    slices = []
+    for term in terms:
+        t = int(np.searchsorted(vocab, term))
+        if t < len(vocab) and vocab[t] == term:
+            slices.append(postings[ptr[t]:ptr[t + 1]])
+    if not slices:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.intp)
+    # merge the sorted posting lists; equal documents end up adjacent
+    docs = np.sort(np.concatenate(slices), kind='mergesort')
+    if scope is not None:
+        conferences = index['conferences']
+        c = int(np.searchsorted(conferences, scope))
+        if c == len(conferences) or conferences[c] != scope:
+            return docs[:0], np.zeros(0, dtype=np.intp)
+        docs = docs[index['conf'][docs] == c]
+    if not len(docs):
+        return docs, np.zeros(0, dtype=np.intp)
+    starts = np.concatenate(([0], np.nonzero(np.diff(docs))[0] + 1))
+    counts = np.diff(np.append(starts, len(docs)))
+    docs = docs[starts]
+
+    keep = ~np.in1d(docs, exclude) if exclude else np.ones(len(docs), bool)
+    if after is not None:
+        count, sort_key = after
+        boundary = bisect.bisect_right(_DocOrder(index), sort_key)
+        keep &= (counts < count) | ((counts == count) & (docs >= boundary))
+    docs, counts = docs[keep], counts[keep]
+    order = np.lexsort((docs, -counts))
+    return docs[order], counts[order]
+
+
+def searchHighlights(highlights, conference=None, cursor=None, limit=None):
+    """Return (session keys, next cursor) ranked by matched highlights.
+
+    Args:
+      highlights: highlight strings; matched after normalization.
+      conference: optional websafe conference key to search within.
+      cursor: cursor from a previous page.
+      limit: page size, at most MAX_LIMIT.
+    Raises ValueError for too many terms or a malformed cursor.
+    """
+    terms = sorted(set(t for t in map(normalizeHighlight, highlights) if t))
+    if len(terms) > MAX_TERMS:
+        raise ValueError('At most %d highlights per search.' % MAX_TERMS)
+    limit = min(limit or DEFAULT_LIMIT, MAX_LIMIT)
+    after = decodeCursor(cursor) if cursor else None
+    if not terms:
+        return [], None
+    loaded = _loadIndex()
+    index = loaded['index']
+
+    # sessions written since the build, scored in python
+    term_set = set(terms)
+    recent, positions = [], []
+    order = _DocOrder(index) if index is not None else []
+    for session in loaded['recent']:
+        if conference and session.key.parent().urlsafe() != conference:
+            continue
+        sort_key = _sessionSortKey(session)
+        doc = bisect.bisect_left(order, sort_key)
+        if doc < len(order) and order[doc] == sort_key:
+            # also indexed; the fresh copy wins
+            positions.append(doc)
+        count = len(term_set.intersection(
+            map(normalizeHighlight, session.highlights)))
+        if count and (after is None or
+                      (-count, sort_key) > (-after[0], after[1])):
+            recent.append((-count, sort_key, session.key))
+
+    ranked = []
+    if index is not None:
+        docs, counts = _indexMatches(index, terms, conference, after,
+                                     positions)
+        for doc, count in zip(docs[:limit + 1], counts[:limit + 1]):
+            sort_key = order[doc]
+            ranked.append((-int(count), sort_key, ndb.Key(
+                Session, sort_key[2], parent=ndb.Key(urlsafe=sort_key[1]))))
+    ranked = sorted(ranked + recent)[:limit + 1]
+    page = ranked[:limit]
+    next_cursor = None
+    if len(ranked) > limit:
+        next_cursor = encodeCursor(-page[-1][0], page[-1][1])
+    return [key for _, _, key in page], next_cursor
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""homepage.py
+
+Server-rendered bootstrap payload for the web client.
+
+`/` is served by main.py rather than as a static file. The page carries
+window.CONFERENCE_BOOTSTRAP, a JSON object holding the announcement, the
+featured speakers and the first page of live conferences, so the client
+draws its first screen without waiting for gapi and an Endpoints call.
+
+The conference page is cached in hot_cache under MEMCACHE_HOMEPAGE_KEY.
+Every write that changes what it shows (conference create/update,
+registrations, waitlist admissions, archiving, organizer renames) calls
+invalidateHomePage(). The announcement and featured speakers are read
+from their own hot_cache keys on each request, so they are as fresh as
+the API's.
+
+"""
+
+import io
+import json
+import os
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+from announcements import getAnnouncement
+from announcements import getFeaturedSpeaker
+from converters import copyConferenceToForm
+from hotcache import VERSION_SUFFIX
+from hotcache import hot_cache
+from models import Conference
+from models import ConferenceForms
+from models import Profile
+from settings import HOMEPAGE_CONFERENCES
+
+MEMCACHE_HOMEPAGE_KEY = "HOMEPAGE_CONFERENCES"
+_TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
+# tools/build_assets.py writes the bundled page; fall back to the
+# source page in development
+_TEMPLATE_NAMES = ('index.dist.html', 'index.html')
+
+_template = []
+
+
+def loadTemplate():
+    """Return the page template, read once per instance."""
+    if not _template:
+        for name in _TEMPLATE_NAMES:
+            path = os.path.join(_TEMPLATES, name)
+            if os.path.exists(path):
+                with io.open(path, encoding='utf-8') as f:
+                    _template.append(f.read())
+                break
+    return _template[0]
+
+
+def _buildConferencePage():
+    """Return the first page of an unfiltered queryConferences."""
+    # the same filter and orders as queryConferences, so the client can
+    # pass the cursor back to it for the rest
+    confs, cursor, more = Conference.query(Conference.isLive == True).order(
+        Conference.name).order(Conference.key).fetch_page(
+            HOMEPAGE_CONFERENCES)
+    more = bool(more and cursor)
+    profiles = ndb.get_multi([ndb.Key(Profile, conf.organizerUserId)
+                              for conf in confs])
+    names = dict((prof.key.id(), prof.displayName)
+                 for prof in profiles if prof)
+    forms = ConferenceForms(items=[
+        copyConferenceToForm(conf, names.get(conf.organizerUserId))
+        for conf in confs])
+    # the same JSON the Endpoints client hands to the controllers
+    items = json.loads(protojson.encode_message(forms)).get('items', [])
+    return {'items': items, 'more': more,
+            'cursor': cursor.urlsafe() if more else None}
+
+
+def getConferencePage():
+    """Return the cached conference page, building it on a miss."""
+    page = hot_cache.get(MEMCACHE_HOMEPAGE_KEY)
+    if page is None:
+        version = memcache.get(MEMCACHE_HOMEPAGE_KEY + VERSION_SUFFIX)
+        page = _buildConferencePage()
+        # skip the write if a conference changed while we were reading
+        if memcache.get(MEMCACHE_HOMEPAGE_KEY + VERSION_SUFFIX) == version:
+            hot_cache.set(MEMCACHE_HOMEPAGE_KEY, page)
+    return page
+
+
+def invalidateHomePage():
+    """Drop the cached conference page; call after the write commits."""
+    hot_cache.delete(MEMCACHE_HOMEPAGE_KEY)
+
+
+def renderHomePage():
+    """Return the page with the bootstrap payload in its head."""
+    conferences = getConferencePage()
+    payload = json.dumps({
+        'announcement': getAnnouncement(),
+        'featuredSpeaker': getFeaturedSpeaker(),
+        'conferences': conferences['items'],
+        'moreConferences': conferences['more'],
+        'nextConferenceCursor': conferences.get('cursor'),
+    })
+    # keep "</script>" in a conference name from closing the tag
+    script = u'<script>window.CONFERENCE_BOOTSTRAP = %s;</script>\n' % (
+        payload.replace('</', '<\\/'))
+    return loadTemplate().replace(u'</head>', script + u'</head>', 1)
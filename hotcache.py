@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""hotcache.py
+
+Two-tier cache for hot singleton memcache keys: a per-instance,
+thread-safe LRU with a short TTL in front of memcache.
+
+Every key has a small version stamp stored next to it in memcache
+(<key>:v), bumped on each write. An evicted stamp restarts from a
+random value, never from one an instance may still hold. When a local
+entry's TTL runs out the instance only re-reads the stamp; the value
+itself is fetched again only if the stamp moved. Values are kept with largevalue.py, so they
+are compressed and may be larger than a memcache item.
+
+"""
+
+import collections
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from largevalue import deleteLargeValue
+from largevalue import getLargeValue
+from largevalue import setLargeValue
+
+VERSION_SUFFIX = ':v'
+
+
+def _bumpVersion(key):
+    """Increment key's stamp and return it."""
+    # headroom below 2**64 keeps incr from wrapping
+    return memcache.incr(key + VERSION_SUFFIX,
+                         initial_value=random.getrandbits(62))
+
+
+class TwoTierCache(object):
+    """Instance-local LRU with TTL, backed by memcache."""
+
+    def __init__(self, ttl=5.0, max_entries=256, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (value, version, expires)
+        self._entries = collections.OrderedDict()
+        self._stats = collections.defaultdict(
+            lambda: {'local': 0, 'revalidated': 0, 'memcache': 0, 'miss': 0})
+
+    def _remember(self, key, value, version):
+        """Store an entry locally, evicting the least recently used."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, version, self._clock() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count(self, key, tier):
+        with self._lock:
+            self._stats[key][tier] += 1
+
+    def get(self, key):
+        """Return the value for key, or None if memcache has no value."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # refresh LRU position
+                del self._entries[key]
+                self._entries[key] = entry
+        if entry is not None and entry[2] > self._clock():
+            self._count(key, 'local')
+            return entry[0]
+
+        version = memcache.get(key + VERSION_SUFFIX)
+        if entry is not None and version == entry[1]:
+            # stamp unchanged, local copy is still current
+            self._remember(key, entry[0], version)
+            self._count(key, 'revalidated')
+            return entry[0]
+
+        value = getLargeValue(key)
+        # absent values are remembered too, so an empty announcement
+        # does not cost two memcache reads on every request
+        self._remember(key, value, version)
+        self._count(key, 'miss' if value is None else 'memcache')
+        return value
+
+    def set(self, key, value):
+        """Write value through to memcache and bump the key's version."""
+        setLargeValue(key, value)
+        version = _bumpVersion(key)
+        self._remember(key, value, version)
+
+    def delete(self, key):
+        """Remove key from memcache and bump its version."""
+        deleteLargeValue(key)
+        _bumpVersion(key)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        """Return per-key tier counts and hit ratios for this instance."""
+        with self._lock:
+            result = {}
+            for key, counts in self._stats.items():
+                total = sum(counts.values())
+                hits = total - counts['miss']
+                result[key] = dict(counts,
+                    total=total,
+                    local_ratio=float(counts['local']) / total if total else 0.0,
+                    hit_ratio=float(hits) / total if total else 0.0)
+            return result
+
+
+# shared by every request handled by this instance
+hot_cache = TwoTierCache()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""idempotency.py
+
+Client supplied requestId support for mutating ConferenceApi methods.
+
+The first successful response for a (user, method, requestId) triple is
+stored in memcache and in an IdempotencyRecord. A retry carrying the
+same requestId gets that response back without any further datastore
+work. Failed calls are not stored, so a retry after an error runs again.
+
+Before the call runs, its requestId is reserved with a transactional
+insert of a response-less IdempotencyRecord. A retry arriving while the
+first call is still running gets a 409 instead of running it twice. A
+reservation older than IDEMPOTENCY_PENDING_SECS is taken to be from a
+call that died and can be reclaimed.
+
+"""
+
+import datetime
+import functools
+import hashlib
+
+import endpoints
+from protorpc import protojson
+
+from google.appengine.ext import ndb
+
+from largevalue import getLargeValue
+from largevalue import setLargeValue
+from errors import ConflictException
+from models import IdempotencyRecord
+from settings import IDEMPOTENCY_PENDING_SECS
+from settings import IDEMPOTENCY_TTL_SECS
+from utils import getUserId
+
+MEMCACHE_IDEMPOTENCY_PREFIX = "IDEMPOTENCY:"
+
+
+def _recordId(user_id, method_name, request_id):
+    return hashlib.sha1('%s|%s|%s' % (
+        user_id, method_name, request_id)).hexdigest()
+
+
+@ndb.transactional()
+def _reserve(record_id):
+    """Return the stored response, or None once the id is reserved.
+
+    Raises ConflictException while another call holds the reservation.
+    """
+    record = IdempotencyRecord.get_by_id(record_id)
+    if record is not None:
+        age = datetime.datetime.now() - record.createdAt
+        if record.response is not None:
+            if age <= datetime.timedelta(seconds=IDEMPOTENCY_TTL_SECS):
+                return record.response
+        elif age <= datetime.timedelta(seconds=IDEMPOTENCY_PENDING_SECS):
+            raise ConflictException(
+                'A request with this requestId is still in progress.')
+    IdempotencyRecord(id=record_id).put()
+    return None
+
+
+def _lookup(record_id):
+    payload = getLargeValue(MEMCACHE_IDEMPOTENCY_PREFIX + record_id)
+    if payload is not None:
+        return payload
+    return _reserve(record_id)
+
+
+def _store(record_id, payload):
+    setLargeValue(MEMCACHE_IDEMPOTENCY_PREFIX + record_id, payload,
+                  time=IDEMPOTENCY_TTL_SECS)
+    IdempotencyRecord(id=record_id, response=payload).put()
+
+
+def idempotent(response_class):
+    """Decorate an API method whose request may carry a requestId field.
+
+    Place it below @endpoints.method:
+
+        @endpoints.method(...)
+        @idempotent(ConferenceForm)
+        def createConference(self, request):
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, request):
+            request_id = getattr(request, 'requestId', None)
+            user = endpoints.get_current_user()
+            if not request_id or not user:
+                return method(self, request)
+            record_id = _recordId(getUserId(user), method.__name__, request_id)
+            payload = _lookup(record_id)
+            if payload is not None:
+                return protojson.decode_message(response_class, payload)
+            try:
+                response = method(self, request)
+            except Exception:
+                # release the reservation so a retry runs again
+                ndb.Key(IdempotencyRecord, record_id).delete()
+                raise
+            _store(record_id, protojson.encode_message(response))
+            return response
+        return wrapper
+    return decorator
+
+
+def purgeIdempotencyRecords(batch=500):
+    """Delete expired IdempotencyRecords; returns how many were removed."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(
+        seconds=IDEMPOTENCY_TTL_SECS)
+    removed = 0
+    while True:
+        keys = IdempotencyRecord.query(
+            IdempotencyRecord.createdAt < cutoff).fetch(batch, keys_only=True)
+        if not keys:
+            return removed
+        ndb.delete_multi(keys)
+        removed += len(keys)
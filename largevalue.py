@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""largevalue.py
+
+Memcache storage for values that may exceed its 1 MB item limit.
+
+A value is pickled and, if it is larger than LARGE_VALUE_COMPRESS_BYTES,
+zlib-compressed. A payload that fits in one chunk is stored inline in
+the key's manifest, so small values still cost a single memcache read.
+A larger one is split into LARGE_VALUE_CHUNK_BYTES chunks written with
+one set_multi under keys carrying a fresh version:
+
+    <key>                 manifest (tag, version, compressed, chunks,
+                          crc32, inline payload or None)
+    <key>:c:<version>:<n> chunk n
+
+The manifest is written only after every chunk was stored, so a reader
+never follows it to a chunk of another write. If memcache evicted any
+chunk, or the payload fails its checksum, the read is a miss and the
+caller rebuilds the value. Chunks of replaced versions are left to
+expire or be evicted.
+
+"""
+
+import binascii
+import logging
+import os
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from google.appengine.api import memcache
+
+from settings import LARGE_VALUE_CHUNK_BYTES
+from settings import LARGE_VALUE_COMPRESS_BYTES
+from settings import LARGE_VALUE_MAX_CHUNKS
+
+MANIFEST_TAG = 'LV1'
+CHUNK_INFIX = ':c:'
+
+
+def _chunkKeys(key, version, count):
+    return ['%s%s%s:%d' % (key, CHUNK_INFIX, version, i)
+            for i in range(count)]
+
+
+def _checksum(payload):
+    return binascii.crc32(payload) & 0xffffffff
+
+
+def _decode(payload, compressed, crc):
+    if _checksum(payload) != crc:
+        return None
+    if compressed:
+        payload = zlib.decompress(payload)
+    return pickle.loads(payload)
+
+
+def getLargeValue(key):
+    """Return the value stored under key, or None on a miss."""
+    manifest = memcache.get(key)
+    if not isinstance(manifest, tuple) or len(manifest) != 6 or \
+            manifest[0] != MANIFEST_TAG:
+        # absent, or written in another format
+        return None
+    _, version, compressed, count, crc, inline = manifest
+    if inline is not None:
+        return _decode(inline, compressed, crc)
+    chunk_keys = _chunkKeys(key, version, count)
+    chunks = memcache.get_multi(chunk_keys)
+    if len(chunks) != count:
+        logging.info('%s: %d of %d chunks evicted', key,
+                     count - len(chunks), count)
+        return None
+    return _decode(''.join(chunks[chunk_key] for chunk_key in chunk_keys),
+                   compressed, crc)
+
+
+def setLargeValue(key, value, time=0):
+    """Store value under key; return False if memcache did not take it."""
+    payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    compressed = len(payload) > LARGE_VALUE_COMPRESS_BYTES
+    if compressed:
+        payload = zlib.compress(payload)
+    crc = _checksum(payload)
+    if len(payload) <= LARGE_VALUE_CHUNK_BYTES:
+        return memcache.set(
+            key, (MANIFEST_TAG, None, compressed, 1, crc, payload), time=time)
+
+    count = -(-len(payload) // LARGE_VALUE_CHUNK_BYTES)
+    if count > LARGE_VALUE_MAX_CHUNKS:
+        logging.warning('%s: %d bytes after compression, not cached', key,
+                        len(payload))
+        memcache.delete(key)
+        return False
+    version = binascii.hexlify(os.urandom(4))
+    chunk_keys = _chunkKeys(key, version, count)
+    failed = memcache.set_multi(dict(
+        (chunk_key, payload[i * LARGE_VALUE_CHUNK_BYTES:
+                            (i + 1) * LARGE_VALUE_CHUNK_BYTES])
+        for i, chunk_key in enumerate(chunk_keys)), time=time)
+    if failed:
+        # keep readers off the old manifest's value as well
+        memcache.delete(key)
+        return False
+    return memcache.set(
+        key, (MANIFEST_TAG, version, compressed, count, crc, None), time=time)
+
+
+def deleteLargeValue(key):
+    """Remove the value stored under key."""
+    # without its manifest the chunks are unreachable
+    memcache.delete(key)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""mailqueue.py
+
+Conference creation confirmation emails, sent in batches from a pull
+queue by a cron worker instead of one push task per conference.
+
+"""
+
+import json
+import logging
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+
+from settings import MAIL_QUEUE_NAME
+from settings import MAIL_LEASE_BATCH
+from settings import MAIL_LEASE_SECS
+from settings import MAIL_SENDS_PER_SECOND
+from settings import MAIL_RETRY_BASE_SECS
+from settings import MAIL_RETRY_MAX_SECS
+from settings import MAIL_MAX_RETRIES
+from settings import MAIL_WORKER_BUDGET_SECS
+
+CONFIRMATION_SUBJECT = 'You created a new Conference!'
+CONFIRMATION_BODY = (
+    'Hi, you have created the following conference:\r\n\r\n'
+    '%(name)s\r\n'
+    'City: %(city)s\r\n'
+    'Dates: %(startDate)s - %(endDate)s\r\n'
+    'Topics: %(topics)s\r\n'
+    'Seats: %(maxAttendees)s\r\n'
+)
+
+
+def enqueueConfirmationEmail(email, conf, transactional=False):
+    """Add a pull task holding the fields the confirmation email needs.
+
+    Pass transactional=True from inside the transaction that puts the
+    Conference so the email is only queued if the put commits.
+    """
+    payload = json.dumps({
+        'email': email,
+        'name': conf.name,
+        'city': conf.city,
+        'startDate': str(conf.startDate) if conf.startDate else '',
+        'endDate': str(conf.endDate) if conf.endDate else '',
+        'topics': conf.topics,
+        'maxAttendees': conf.maxAttendees,
+    }, separators=(',', ':'))
+    taskqueue.Queue(MAIL_QUEUE_NAME).add(
+        taskqueue.Task(payload=payload, method='PULL'),
+        transactional=transactional)
+
+
+def renderConfirmationEmail(payload):
+    """Return (to, subject, body) for a decoded task payload."""
+    fields = dict(payload)
+    fields['topics'] = ', '.join(fields.get('topics') or [])
+    return fields['email'], CONFIRMATION_SUBJECT, CONFIRMATION_BODY % fields
+
+
+def _retryDelay(retry_count):
+    """Exponential backoff for a message that failed retry_count times."""
+    return min(MAIL_RETRY_MAX_SECS, MAIL_RETRY_BASE_SECS * 2 ** retry_count)
+
+
+def processConfirmationEmails(budget_secs=MAIL_WORKER_BUDGET_SECS,
+                              sleep=time.sleep):
+    """Lease and send confirmation emails until the queue is empty or the
+    time budget runs out. Returns a dict of sent/retried/dropped counts.
+    """
+    queue = taskqueue.Queue(MAIL_QUEUE_NAME)
+    sender = 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+    interval = 1.0 / MAIL_SENDS_PER_SECOND if MAIL_SENDS_PER_SECOND else 0
+    deadline = time.time() + budget_secs
+    stats = {'sent': 0, 'retried': 0, 'dropped': 0}
+
+    while time.time() < deadline:
+        tasks = queue.lease_tasks(MAIL_LEASE_SECS, MAIL_LEASE_BATCH)
+        if not tasks:
+            break
+        done = []
+        for task in tasks:
+            try:
+                to, subject, body = renderConfirmationEmail(
+                    json.loads(task.payload))
+            except (ValueError, KeyError, TypeError):
+                logging.error('dropping malformed confirmation task %s',
+                              task.name)
+                done.append(task)
+                stats['dropped'] += 1
+                continue
+            try:
+                mail.send_mail(sender, to, subject, body)
+            except Exception:
+                if task.retry_count >= MAIL_MAX_RETRIES:
+                    logging.exception('giving up on confirmation email to %s',
+                                      to)
+                    done.append(task)
+                    stats['dropped'] += 1
+                else:
+                    logging.warning('confirmation email to %s failed, retrying',
+                                    to, exc_info=True)
+                    # keep the task leased until its backoff has elapsed
+                    queue.modify_task_lease(task,
+                                            _retryDelay(task.retry_count))
+                    stats['retried'] += 1
+                continue
+            done.append(task)
+            stats['sent'] += 1
+            if interval:
+                sleep(interval)
+        if done:
+            queue.delete_tasks(done)
+    return stats
@@ -12,21 +12,60 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+import logging
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
-from conference import ConferenceApi
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from announcements import MEMCACHE_ANNOUNCEMENTS_KEY
+from announcements import MEMCACHE_FEATUREDSPEAKER_KEY
+from announcements import cacheAnnouncement
+from announcements import cacheFeaturedSpeaker
+from converters import buildConverters
+from converters import copySessionToForm
+from mailqueue import processConfirmationEmails
+from hotcache import hot_cache
+from deadline import truncationStats
+from homepage import loadTemplate
+from homepage import renderHomePage
+from facets import applyFacetDelta
+from facets import enqueueRebuildTask
+from facets import rebuildFacetCounts
+from models import MapperJob
+from models import QueryShape
+from queryshapes import flushQueryShapes
+from queryshapes import generateIndexYaml
+from queryshapes import loadIndexYaml
+from archive import archiveConferences
+from archive import enqueueArchiveTask
+from waitlist import processWaitlist
+from sync import purgeSyncChanges
+from trafficcapture import exportRecords
+from trafficcapture import resetCapture
+from settings import MAPPER_SHARDS
+from mapper import renderJobs
+from mapper import resumeJob
+from mapper import runSlice
+from mapper import startJob
+from profiler import ProfilingMiddleware
+from profiler import loadReports
+from profiler import renderReports
+from profiler import resetReports
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
         # TODO 1
-        ConferenceApi._cacheAnnouncement()
+        cacheAnnouncement()
 
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
+        # legacy push task; new confirmations go through the pull queue
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -37,16 +76,276 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Drain the confirmation email pull queue in batches."""
+        stats = processConfirmationEmails()
+        logging.info('confirmation emails: %(sent)d sent, '
+                     '%(retried)d retried, %(dropped)d dropped', stats)
+
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
         """Set Featured Speaker in Memcache."""
-        ConferenceApi._cacheFeaturedSpeaker(
+        cacheFeaturedSpeaker(
                         self.request.get("speaker_email"),
                         self.request.get("wsck"))
 
 
-app = webapp2.WSGIApplication([
+class UpdateFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply a conference facet count delta to one shard."""
+        # a retried task keeps its name
+        applyFacetDelta(json.loads(self.request.get('delta')),
+                        self.request.headers.get('X-AppEngine-TaskName'))
+
+
+class RebuildFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start recounting conference facets from scratch."""
+        enqueueRebuildTask()
+        self.response.write('facet rebuild started')
+
+    def post(self):
+        """Recount one batch of conferences and chain the next."""
+        counted = rebuildFacetCounts(self.request.get('cursor') or None,
+                                     json.loads(self.request.get('counts')
+                                                or '{}'))
+        logging.info('recounted facets of %d conferences', counted)
+
+
+class FlushQueryShapesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Merge an instance's aggregated query shapes into the registry."""
+        flushQueryShapes(json.loads(self.request.body))
+
+
+class QueryIndexesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Render the minimal index.yaml covering recorded query shapes."""
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(generateIndexYaml(QueryShape.query().fetch(),
+                                              loadIndexYaml()))
+
+
+class StartArchiveHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the task chain that archives ended conferences."""
+        enqueueArchiveTask(full=bool(self.request.get('full')))
+
+
+class ArchiveConferencesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Archive one batch of ended conferences, chaining the next."""
+        changed = archiveConferences(self.request.get('cursor') or None,
+                                     full=bool(self.request.get('full')))
+        logging.info('archive batch updated %d conferences', changed)
+
+
+class ProcessWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """Admit waitlisted users while the conference has seats."""
+        processWaitlist(self.request.get('wsck'))
+
+
+class PurgeIdempotencyRecordsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete idempotency records older than their TTL."""
+        # idempotency.py pulls in endpoints; only this cron needs it
+        from idempotency import purgeIdempotencyRecords
+        logging.info('purged %d idempotency records',
+                     purgeIdempotencyRecords())
+
+
+class PurgeSyncChangesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete sync removal records older than the token retention."""
+        logging.info('purged %d sync changes', purgeSyncChanges())
+
+
+class StartAnalyticsSnapshotHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start a new columnar analytics snapshot."""
+        from analytics import startSnapshot
+        startSnapshot()
+
+
+class AnalyticsSnapshotHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy one batch of entities into the analytics snapshot."""
+        from analytics import snapshotBatch
+        snapshotBatch(self.request.get('snapshot'), self.request.get('kind'),
+                      self.request.get('cursor') or None)
+
+
+class BuildRecommendationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start rebuilding the session TF-IDF model."""
+        from recommend import startModel
+        startModel()
+
+
+class RecommendationsBatchHandler(webapp2.RequestHandler):
+    def post(self):
+        """Vectorize one batch of sessions; refresh all profiles once
+        the model is complete."""
+        from recommend import modelBatch
+        if modelBatch(self.request.get('model'),
+                      int(self.request.get('batch')),
+                      self.request.get('cursor') or None):
+            taskqueue.add(url='/tasks/recommend_profiles')
+
+
+class RecommendProfilesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Refresh recommendations for one batch of profiles."""
+        from recommend import recommendProfiles
+        cursor = recommendProfiles(copySessionToForm,
+                                   self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(url='/tasks/recommend_profiles',
+                          params={'cursor': cursor.urlsafe()})
+
+
+class RefreshRecommendationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Refresh one user's recommendations after a wishlist change."""
+        from recommend import refreshProfile
+        refreshProfile(self.request.get('user_id'), copySessionToForm)
+
+
+class BuildHighlightIndexHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start rebuilding the highlight -> sessions search index."""
+        from highlightsearch import startIndex
+        startIndex()
+
+
+class HighlightIndexBatchHandler(webapp2.RequestHandler):
+    def post(self):
+        """Index one batch of sessions and chain the next."""
+        from highlightsearch import indexBatch
+        indexBatch(self.request.get('index'), int(self.request.get('batch')),
+                   self.request.get('cursor') or None)
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report this instance's two-tier cache hit ratios as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(hot_cache.stats(), indent=2))
+
+
+class QueryTruncationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report how often deadline-bounded queries returned partial results."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(truncationStats(), indent=2))
+
+
+class TrafficCaptureHandler(webapp2.RequestHandler):
+    def get(self):
+        """Export captured Endpoints calls as JSON lines; ?reset=1 clears them."""
+        self.response.headers['Content-Type'] = 'text/plain'
+        if self.request.get('reset'):
+            resetCapture()
+            self.response.write('traffic capture cleared\n')
+            return
+        for line in exportRecords():
+            self.response.write(line + '\n')
+
+
+class ProfilesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Render aggregated request profiles; ?reset=1 clears them."""
+        self.response.headers['Content-Type'] = 'text/plain'
+        if self.request.get('reset'):
+            resetReports()
+            self.response.write('profiles cleared\n')
+            return
+        self.response.write(renderReports(
+            loadReports(), int(self.request.get('top') or 30)))
+
+
+class MappersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report mapper jobs. ?start=<mapper>&kind=<Kind>&shards=<n>
+        starts one; ?resume=<job id> restarts its stalled shards."""
+        self.response.headers['Content-Type'] = 'text/plain'
+        if self.request.get('start'):
+            try:
+                job_key = startJob(self.request.get('start'),
+                                   self.request.get('kind') or None,
+                                   int(self.request.get('shards') or 0) or
+                                   MAPPER_SHARDS)
+            except ValueError as e:
+                self.response.set_status(400)
+                self.response.write('%s\n' % e)
+                return
+            self.response.write('started job %s\n\n' % job_key.id())
+        elif self.request.get('resume'):
+            restarted = resumeJob(ndb.Key(MapperJob,
+                                          int(self.request.get('resume'))))
+            self.response.write('restarted %d shards\n\n' % restarted)
+        self.response.write(renderJobs(
+            MapperJob.query().order(-MapperJob.createdAt).fetch(10)))
+
+
+class RunMapperHandler(webapp2.RequestHandler):
+    def post(self):
+        """Map one slice of a mapper shard, chaining the next."""
+        runSlice(self.request.get('job'), int(self.request.get('shard')),
+                 int(self.request.get('slice')))
+
+
+class HomePageHandler(webapp2.RequestHandler):
+    def get(self):
+        """Serve the web client with its first screen's data embedded."""
+        # the payload changes with every registration; always revalidate
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.write(renderHomePage())
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Load the API module and fill per-instance caches."""
+        # importing conference builds the Endpoints service and its
+        # message classes, the slowest part of an API cold start
+        import conference
+        buildConverters()
+        loadTemplate()
+        hot_cache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        hot_cache.get(MEMCACHE_FEATUREDSPEAKER_KEY)
+
+
+app = ProfilingMiddleware(webapp2.WSGIApplication([
+    ('/', HomePageHandler),
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/send_confirmation_emails', SendConfirmationEmailsHandler),
+    ('/crons/archive_conferences', StartArchiveHandler),
+    ('/crons/purge_idempotency_records', PurgeIdempotencyRecordsHandler),
+    ('/crons/purge_sync_changes', PurgeSyncChangesHandler),
+    ('/crons/analytics_snapshot', StartAnalyticsSnapshotHandler),
+    ('/tasks/analytics_snapshot', AnalyticsSnapshotHandler),
+    ('/crons/build_recommendations', BuildRecommendationsHandler),
+    ('/tasks/build_recommendations', RecommendationsBatchHandler),
+    ('/tasks/recommend_profiles', RecommendProfilesHandler),
+    ('/tasks/refresh_recommendations', RefreshRecommendationsHandler),
+    ('/crons/build_highlight_index', BuildHighlightIndexHandler),
+    ('/tasks/build_highlight_index', HighlightIndexBatchHandler),
+    ('/tasks/archive_conferences', ArchiveConferencesHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler), 
-], debug=True)
+    ('/tasks/update_facets', UpdateFacetsHandler),
+    ('/tasks/rebuild_facets', RebuildFacetsHandler),
+    ('/tasks/process_waitlist', ProcessWaitlistHandler),
+    ('/tasks/flush_query_shapes', FlushQueryShapesHandler),
+    ('/admin/query_indexes', QueryIndexesHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/query_truncations', QueryTruncationsHandler),
+    ('/admin/profiles', ProfilesHandler),
+    ('/admin/traffic_capture', TrafficCaptureHandler),
+    ('/admin/mappers', MappersHandler),
+    ('/tasks/run_mapper', RunMapperHandler),
+], debug=True))
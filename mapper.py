@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+"""mapper.py
+
+Resumable, sharded mappers for schema backfills.
+
+A mapper is a function that takes an entity and returns True if it
+changed it and the entity has to be written back. startJob() splits a
+kind into MAPPER_SHARDS key ranges, using the datastore's __scatter__
+sample, and starts one task chain per range on the MAPPER_QUEUE queue.
+Each task:
+
+- reads its range in key order, MAPPER_BATCH entities at a time;
+- writes the changed entities back, re-reading and re-mapping them in
+  one transaction per entity group, so a concurrent update is never
+  overwritten;
+- checkpoints the shard's cursor and counters (MapperShard) after every
+  batch;
+- after MAPPER_TASK_SECS, enqueues the next slice of the shard in the
+  checkpoint transaction and returns, well inside the task deadline.
+
+A failed task is retried from the last checkpoint. resumeJob() restarts
+shards whose chain stopped, e.g. after the retry limit. The checkpoint
+counters give each shard's throughput; /admin/mappers reports them.
+
+Mappers must be idempotent, since a batch is replayed if its task dies
+before the checkpoint, and may run twice on an entity: once on the page
+read to pick the entities to write, then on the copy read again inside
+the transaction.
+
+"""
+
+import logging
+import time
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import MapperJob
+from models import MapperShard
+from settings import MAPPER_BATCH
+from settings import MAPPER_QUEUE
+from settings import MAPPER_SHARDS
+from settings import MAPPER_TASK_SECS
+
+# keys sampled per shard to place the split points
+SCATTER_OVERSAMPLE = 32
+# a shard not checkpointed for this long has no live task chain
+STALLED_AFTER = timedelta(seconds=MAPPER_TASK_SECS * 3)
+
+# mapper name -> (kind it is restricted to, or None for any, function)
+MAPPERS = {}
+
+
+def mapper(name, kind=None):
+    """Register the decorated function as mapper `name`."""
+    def register(func):
+        MAPPERS[name] = (kind, func)
+        return func
+    return register
+
+
+@mapper('touch')
+def touch(entity):
+    """Write every entity back as is.
+
+    This indexes properties that became indexed, recomputes
+    ComputedProperty values and sets auto_now stamps, so sync clients
+    fetch the entities again.
+    """
+    return True
+
+
+@mapper('conference_month', 'Conference')
+def conferenceMonth(conf):
+    """Derive Conference.month from startDate, as createConference does."""
+    month = conf.startDate.month if conf.startDate else 0
+    if conf.month == month:
+        return False
+    conf.month = month
+    return True
+
+
+@mapper('session_stamps', 'Session')
+def sessionStamps(session):
+    """Store isLive and created on sessions written before they existed.
+
+    Both are then set by put(): isLive to its default, created to now.
+    """
+    return session.created is None
+
+
+def _model(kind):
+    try:
+        return ndb.Model._lookup_model(kind)
+    except ndb.KindError:
+        raise ValueError('Unknown kind: %s' % kind)
+
+
+def _splitPoints(model, shards):
+    """Return up to shards - 1 ascending keys splitting the kind evenly."""
+    sample = model.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * SCATTER_OVERSAMPLE, keys_only=True)
+    sample.sort()
+    points = []
+    for i in range(1, shards):
+        if not sample:
+            break
+        key = sample[len(sample) * i // shards]
+        if not points or key > points[-1]:
+            points.append(key)
+    return points
+
+
+def startJob(name, kind=None, shards=MAPPER_SHARDS):
+    """Start mapper `name` over `kind` and return the MapperJob key.
+
+    Raises ValueError for an unknown mapper or kind.
+    """
+    if name not in MAPPERS:
+        raise ValueError('Unknown mapper: %s' % name)
+    kind = MAPPERS[name][0] or kind
+    if not kind:
+        raise ValueError('Mapper %s needs a kind.' % name)
+    bounds = [None] + _splitPoints(_model(kind), max(1, shards)) + [None]
+    job_key = MapperJob(mapper=name, kind=kind, shards=len(bounds) - 1).put()
+    # shard ids start at 1; ndb ids cannot be 0
+    ndb.put_multi([
+        MapperShard(parent=job_key, id=i, keyStart=bounds[i - 1],
+                    keyEnd=bounds[i])
+        for i in range(1, len(bounds))])
+    for i in range(1, len(bounds)):
+        _enqueueSlice(job_key, i, 0)
+    logging.info('mapper %s over %s started in %d shards', name, kind,
+                 len(bounds) - 1)
+    return job_key
+
+
+def resumeJob(job_key, now=None):
+    """Restart the unfinished shards that stopped checkpointing.
+
+    Returns the number of shards restarted.
+    """
+    now = now or datetime.utcnow()
+    restarted = 0
+    for shard in MapperShard.query(ancestor=job_key):
+        if not shard.done and now - shard.updatedAt > STALLED_AFTER:
+            _enqueueSlice(job_key, shard.key.id(), shard.slice)
+            restarted += 1
+    return restarted
+
+
+def _enqueueSlice(job_key, shard_no, slice_no, transactional=False):
+    taskqueue.add(queue_name=MAPPER_QUEUE, url='/tasks/run_mapper',
+                  params={'job': job_key.urlsafe(), 'shard': shard_no,
+                          'slice': slice_no},
+                  transactional=transactional)
+
+
+@ndb.transactional()
+def _checkpoint(shard_key, slice_no, cursor, processed, written, busy,
+                last=False, done=False):
+    """Save a shard's progress; False if another run of the slice won."""
+    shard = shard_key.get()
+    if shard.done or shard.slice != slice_no:
+        return False
+    shard.cursor = cursor.urlsafe() if cursor else None
+    shard.processed += processed
+    shard.written += written
+    shard.busySecs += busy
+    shard.done = done
+    if last and not done:
+        # the next slice starts only if this checkpoint commits
+        shard.slice += 1
+        _enqueueSlice(shard_key.parent(), shard_key.id(), shard.slice,
+                      transactional=True)
+    shard.put()
+    return True
+
+
+@ndb.transactional()
+def _recordFailure(shard_key, error):
+    shard = shard_key.get()
+    shard.failures += 1
+    shard.lastError = error
+    shard.put()
+
+
+def _shardQuery(model, shard):
+    q = model.query()
+    if shard.keyStart is not None:
+        q = q.filter(model.key >= shard.keyStart)
+    if shard.keyEnd is not None:
+        q = q.filter(model.key < shard.keyEnd)
+    return q.order(model.key)
+
+
+@ndb.tasklet
+def _mapGroup(func, keys):
+    """Re-map keys, all in one entity group, in one transaction.
+
+    Returns the number of entities written.
+    """
+    @ndb.tasklet
+    def txn():
+        entities = yield ndb.get_multi_async(keys)
+        changed = [entity for entity in entities
+                   if entity is not None and func(entity)]
+        if changed:
+            yield ndb.put_multi_async(changed)
+        raise ndb.Return(len(changed))
+    written = yield ndb.transaction_async(txn)
+    raise ndb.Return(written)
+
+
+def _writeChanged(func, entities):
+    """Write back the entities func changes; return how many were."""
+    groups = {}
+    for entity in entities:
+        if func(entity):
+            groups.setdefault(entity.key.root(), []).append(entity.key)
+    futures = [_mapGroup(func, keys) for keys in groups.values()]
+    return sum(future.get_result() for future in futures)
+
+
+def runSlice(websafe_job, shard_no, slice_no):
+    """Map one task's worth of a shard, chaining the next slice."""
+    job_key = ndb.Key(urlsafe=websafe_job)
+    shard_key = ndb.Key(MapperShard, shard_no, parent=job_key)
+    job, shard = ndb.get_multi([job_key, shard_key])
+    if job is None or shard is None or shard.done or shard.slice != slice_no:
+        # a duplicate or stale task
+        return
+    func = MAPPERS[job.mapper][1]
+    q = _shardQuery(_model(job.kind), shard)
+    cursor = Cursor(urlsafe=shard.cursor) if shard.cursor else None
+    started = time.time()
+    processed = written = 0
+    try:
+        while True:
+            batch_started = time.time()
+            entities, next_cursor, more = q.fetch_page(
+                MAPPER_BATCH, start_cursor=cursor)
+            changed = _writeChanged(func, entities)
+            done = not (more and next_cursor)
+            last = done or time.time() - started >= MAPPER_TASK_SECS
+            if not _checkpoint(shard_key, slice_no, next_cursor,
+                               len(entities), changed,
+                               time.time() - batch_started, last, done):
+                logging.warning('mapper job %s shard %d slice %d superseded',
+                                job_key.id(), shard_no, slice_no)
+                return
+            processed += len(entities)
+            written += changed
+            cursor = next_cursor
+            if last:
+                break
+    except Exception as e:
+        _recordFailure(shard_key, '%s: %s' % (type(e).__name__, e))
+        raise
+    elapsed = time.time() - started
+    logging.info('mapper %s job %s shard %d: %d read, %d written in %.1fs '
+                 '(%.0f entities/s)%s', job.mapper, job_key.id(), shard_no,
+                 processed, written, elapsed, processed / max(elapsed, 0.001),
+                 ', shard done' if done else '')
+
+
+def jobStatus(job, shards):
+    """Return a dict summarizing a job's progress and throughput."""
+    processed = sum(shard.processed for shard in shards)
+    last_update = max([shard.updatedAt for shard in shards] or
+                      [job.createdAt])
+    wall = max((last_update - job.createdAt).total_seconds(), 0.001)
+    return {
+        'id': job.key.id(),
+        'mapper': job.mapper,
+        'kind': job.kind,
+        'shards': len(shards),
+        'done': sum(1 for shard in shards if shard.done),
+        'processed': processed,
+        'written': sum(shard.written for shard in shards),
+        'failures': sum(shard.failures for shard in shards),
+        'wall': wall,
+        'rate': processed / wall,
+    }
+
+
+def renderJobs(jobs):
+    """Render jobs and their shards as plain text, newest first."""
+    lines = []
+    for job in jobs:
+        shards = MapperShard.query(ancestor=job.key).fetch()
+        shards.sort(key=lambda shard: shard.key.id())
+        status = jobStatus(job, shards)
+        lines.append(
+            'job %(id)s  %(mapper)s over %(kind)s  %(done)d/%(shards)d shards '
+            'done  %(processed)d read  %(written)d written  %(failures)d '
+            'failures  %(rate).0f entities/s over %(wall).0fs' % status)
+        for shard in shards:
+            lines.append('  shard %2d  %-7s slice %3d  %8d read  %8d written'
+                         '  %6.0f entities/s%s' % (
+                             shard.key.id(),
+                             'done' if shard.done else 'running',
+                             shard.slice, shard.processed, shard.written,
+                             shard.processed / max(shard.busySecs, 0.001),
+                             '  last error: %s' % shard.lastError
+                             if shard.lastError else ''))
+        lines.append('')
+    return '\n'.join(lines)
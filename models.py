@@ -12,22 +12,43 @@ created/forked from conferences.py by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
-import httplib
-import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
-class ConflictException(endpoints.ServiceException):
-    """ConflictException -- exception mapped to HTTP 409 response"""
-    http_status = httplib.CONFLICT
+import dateranges
 
-class Profile(ndb.Model):
+class SyncChange(ndb.Model):
+    """SyncChange -- change the sync API cannot see from `updated` stamps.
+
+    Child of a Profile: a conference or session entered (removed=False)
+    or left (removed=True) that user's sync scope. Child of the deleted
+    key, with userId '*': an entity was deleted.
+    """
+    userId     = ndb.StringProperty()
+    entityKind = ndb.StringProperty(indexed=False)
+    websafeKey = ndb.StringProperty(indexed=False)
+    removed    = ndb.BooleanProperty(indexed=False)
+    changedAt  = ndb.DateTimeProperty(auto_now_add=True)
+
+class Tombstoned(object):
+    """Mixin recording a SyncChange tombstone whenever an entity is deleted"""
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        # in the deleted entity's group: inside a transaction the
+        # tombstone commits with the delete, outside one it is sent in
+        # parallel with it
+        SyncChange(parent=key, id='deleted', userId='*',
+                   entityKind=key.kind(), websafeKey=key.urlsafe(),
+                   removed=True).put_async()
+
+class Profile(Tombstoned, ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     wishlist = ndb.StringProperty(repeated=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -46,7 +67,7 @@ class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
 
-class Conference(ndb.Model):
+class Conference(Tombstoned, ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
@@ -54,10 +75,105 @@ class Conference(ndb.Model):
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
-    month           = ndb.IntegerProperty(indexed=False) # TODO: do we need for indexing like Java?
+    month           = ndb.IntegerProperty()
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    # False once endDate has passed; see archive.py
+    isLive          = ndb.BooleanProperty(default=True)
+    updated         = ndb.DateTimeProperty(auto_now=True)
+    # day buckets for "active between" queries; see dateranges.py
+    activeWeeks     = ndb.ComputedProperty(
+        lambda self: dateranges.activeWeeks(self.startDate, self.endDate),
+        repeated=True)
+    activeMonths    = ndb.ComputedProperty(
+        lambda self: dateranges.activeMonths(self.startDate, self.endDate),
+        repeated=True)
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- user waiting for a seat; child of Conference, id is user id"""
+    createdAt = ndb.DateTimeProperty(auto_now_add=True)
+
+class IdempotencyRecord(ndb.Model):
+    """IdempotencyRecord -- stored response of a mutating call, keyed by client requestId"""
+    # None while the call holding the reservation is still running
+    response  = ndb.TextProperty()
+    createdAt = ndb.DateTimeProperty(auto_now_add=True)
+
+class AnalyticsSnapshot(ndb.Model):
+    """AnalyticsSnapshot -- columnar copy of conferences and sessions; see analytics.py"""
+    createdAt = ndb.DateTimeProperty(auto_now_add=True)
+    complete  = ndb.BooleanProperty(default=False)
+
+class AnalyticsSnapshotPart(ndb.Model):
+    """AnalyticsSnapshotPart -- one .npz batch of a snapshot; child of AnalyticsSnapshot"""
+    kind = ndb.StringProperty()
+    data = ndb.BlobProperty()
+
+class RecommenderModel(ndb.Model):
+    """RecommenderModel -- TF-IDF session vectors built by recommend.py"""
+    createdAt = ndb.DateTimeProperty(auto_now_add=True)
+    complete  = ndb.BooleanProperty(default=False)
+    numTerms  = ndb.IntegerProperty(indexed=False)
+    numRows   = ndb.IntegerProperty(indexed=False)
+
+class RecommenderModelPart(ndb.Model):
+    """RecommenderModelPart -- .npz slice of a RecommenderModel; child of it"""
+    data = ndb.BlobProperty()
+
+class HighlightIndex(ndb.Model):
+    """HighlightIndex -- highlight -> sessions postings built by highlightsearch.py"""
+    createdAt = ndb.DateTimeProperty(auto_now_add=True)
+    # sessions created from this time on are not in the index
+    builtFrom = ndb.DateTimeProperty(indexed=False)
+    complete  = ndb.BooleanProperty(default=False)
+    numTerms  = ndb.IntegerProperty(indexed=False)
+    numDocs   = ndb.IntegerProperty(indexed=False)
+    numParts  = ndb.IntegerProperty(indexed=False)
+
+class HighlightIndexPart(ndb.Model):
+    """HighlightIndexPart -- byte range of a HighlightIndex .npz; child of it"""
+    data = ndb.BlobProperty()
+
+class ProfileReport(ndb.Model):
+    """ProfileReport -- aggregated cProfile samples of one endpoint; id is its name"""
+    report    = ndb.JsonProperty(compressed=True)
+    updatedAt = ndb.DateTimeProperty(auto_now=True)
+
+class MapperJob(ndb.Model):
+    """MapperJob -- one run of a mapper over a kind; see mapper.py"""
+    mapper    = ndb.StringProperty()
+    kind      = ndb.StringProperty(indexed=False)
+    shards    = ndb.IntegerProperty(indexed=False)
+    createdAt = ndb.DateTimeProperty(auto_now_add=True)
+
+class MapperShard(ndb.Model):
+    """MapperShard -- checkpoint of one key range of a MapperJob; child of it, id is the shard number"""
+    keyStart  = ndb.KeyProperty(indexed=False)
+    keyEnd    = ndb.KeyProperty(indexed=False)
+    cursor    = ndb.StringProperty(indexed=False)
+    # number of the task slice expected next; stale duplicates are dropped
+    slice     = ndb.IntegerProperty(default=0, indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    written   = ndb.IntegerProperty(default=0, indexed=False)
+    # seconds spent inside tasks, for throughput
+    busySecs  = ndb.FloatProperty(default=0.0, indexed=False)
+    failures  = ndb.IntegerProperty(default=0, indexed=False)
+    lastError = ndb.TextProperty()
+    done      = ndb.BooleanProperty(default=False, indexed=False)
+    updatedAt = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class TrafficCaptureChunk(ndb.Model):
+    """TrafficCaptureChunk -- sampled Endpoints requests for replay; see trafficcapture.py"""
+    records   = ndb.JsonProperty(compressed=True)
+    createdAt = ndb.DateTimeProperty(auto_now_add=True)
+
+class Recommendation(ndb.Model):
+    """Recommendation -- precomputed recommended sessions; id is user id"""
+    sessionKeys = ndb.StringProperty(repeated=True, indexed=False)
+    # protojson encoded SessionForms, served as is
+    forms       = ndb.BlobProperty(compressed=True)
+    updatedAt   = ndb.DateTimeProperty(auto_now=True)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -77,6 +193,10 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    # set when the request deadline cut the query short; pass nextCursor
+    # back as `cursor` for the rest
+    nextCursor = messages.StringField(2)
+    partial = messages.BooleanField(3, default=False)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -96,6 +216,55 @@ class TeeShirtSize(messages.Enum):
     XXXL_M = 14
     XXXL_W = 15
 
+class ConferenceFacetShard(ndb.Model):
+    """ConferenceFacetShard -- one shard of the conference facet counters"""
+    # "facet:value" -> number of conferences
+    counts = ndb.JsonProperty(indexed=False)
+    # names of the most recent update tasks applied, to skip retries
+    applied = ndb.StringProperty(repeated=True, indexed=False)
+
+class ConferenceFacetForm(messages.Message):
+    """ConferenceFacetForm -- count of conferences for one filter value"""
+    facet = messages.StringField(1)
+    value = messages.StringField(2)
+    count = messages.IntegerField(3, variant=messages.Variant.INT32)
+
+class ConferenceFacetForms(messages.Message):
+    """ConferenceFacetForms -- multiple ConferenceFacetForm outbound form message"""
+    items = messages.MessageField(ConferenceFacetForm, 1, repeated=True)
+
+class QueryShape(ndb.Model):
+    """QueryShape -- how often a normalized query shape ran and how long it took"""
+    kind        = ndb.StringProperty()
+    equalities  = ndb.StringProperty(repeated=True, indexed=False)
+    inequality  = ndb.StringProperty(indexed=False)
+    orders      = ndb.StringProperty(repeated=True, indexed=False)
+    count       = ndb.IntegerProperty(default=0, indexed=False)
+    totalMs     = ndb.FloatProperty(default=0.0, indexed=False)
+    maxMs       = ndb.FloatProperty(default=0.0, indexed=False)
+    lastSeen    = ndb.DateTimeProperty(auto_now=True)
+
+class StatsRowForm(messages.Message):
+    """StatsRowForm -- aggregates for one value of a grouping dimension"""
+    dimension     = messages.StringField(1)
+    value         = messages.StringField(2)
+    conferences   = messages.IntegerField(3)
+    registrations = messages.IntegerField(4)
+    capacity      = messages.IntegerField(5)
+    fillRate      = messages.FloatField(6)
+    sessions      = messages.IntegerField(7)
+    avgDuration   = messages.FloatField(8)
+
+class ConferenceStatsForm(messages.Message):
+    """ConferenceStatsForm -- attendance analytics outbound form message"""
+    snapshotAt    = messages.StringField(1)
+    conferences   = messages.IntegerField(2)
+    registrations = messages.IntegerField(3)
+    capacity      = messages.IntegerField(4)
+    fillRate      = messages.FloatField(5)
+    sessions      = messages.IntegerField(6)
+    rows          = messages.MessageField(StatsRowForm, 7, repeated=True)
+
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
     field = messages.StringField(1)
@@ -105,6 +274,12 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    includePast = messages.BooleanField(2, default=False)
+    # YYYY-MM-DD; conferences running on any day in [activeFrom, activeTo]
+    activeFrom = messages.StringField(3)
+    activeTo = messages.StringField(4)
+    # nextCursor of a partial answer
+    cursor = messages.StringField(5)
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
@@ -117,7 +292,7 @@ class SessionType(messages.Enum):
     KEYNODE = 3
     WORKSHOP = 4
 
-class Session(ndb.Model):
+class Session(Tombstoned, ndb.Model):
     """Session -- Session object"""
     name          = ndb.StringProperty(required=True)
     highlights    = ndb.StringProperty(repeated=True)
@@ -128,6 +303,10 @@ class Session(ndb.Model):
     typeOfSession = ndb.StringProperty(default='NOT_SPECIFIED')
     date          = ndb.DateProperty()
     startTime     = ndb.TimeProperty()
+    # mirrors the parent Conference's isLive
+    isLive        = ndb.BooleanProperty(default=True)
+    created       = ndb.DateTimeProperty(auto_now_add=True)
+    updated       = ndb.DateTimeProperty(auto_now=True)
 
 
 class SessionForm(messages.Message):
@@ -145,23 +324,47 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- mutiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    # set when the request deadline cut the query short; pass nextCursor
+    # back as `cursor` for the rest
+    nextCursor = messages.StringField(2)
+    partial = messages.BooleanField(3, default=False)
         
 
 class SessionHighlightsForm(messages.Message):
     """SessionHighlightsForm -- mutiple highlights form"""
     highlights=messages.StringField(1, repeated=True)
+    websafeConferenceKey = messages.StringField(2)
+    cursor = messages.StringField(3)
+    limit = messages.IntegerField(4, variant=messages.Variant.INT32)
+
+class SessionDateRangeForm(messages.Message):
+    """SessionDateRangeForm -- sessions between two dates (YYYY-MM-DD), optionally
+    starting within [startTimeFrom, startTimeTo] (HH:MM)"""
+    websafeConferenceKey = messages.StringField(1)
+    startDate = messages.StringField(2)
+    endDate = messages.StringField(3)
+    startTimeFrom = messages.StringField(4)
+    startTimeTo = messages.StringField(5)
+
+class SessionSearchForms(messages.Message):
+    """SessionSearchForms -- one page of ranked Session search results"""
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
 
 class SessionSpeakerFieldForm(messages.Message):
     """SessionSpeakerFieldFor -- mutiple speaker's field"""
     fields = messages.StringField(1, repeated=True)
+    # nextCursor of a partial answer
+    cursor = messages.StringField(2)
 
-class Speaker(ndb.Model):
+class Speaker(Tombstoned, ndb.Model):
     """Speaker -- Speaker object"""
     name    = ndb.StringProperty(required=True)
     email   = ndb.StringProperty(required=True)
     company = ndb.StringProperty()
     sex     = ndb.StringProperty()
     field   = ndb.StringProperty(repeated=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
 
 class SpeakerForm(messages.Message):
     """SpeakerForm -- SpeakerForm outbound form message"""
@@ -176,6 +379,58 @@ class SpeakerForms(messages.Message):
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
         
 
+class MultiGetForm(messages.Message):
+    """MultiGetForm -- websafe keys (or speaker emails) to resolve in one call"""
+    keys = messages.StringField(1, repeated=True)
+
+class ConferenceResultForm(messages.Message):
+    """ConferenceResultForm -- one requested key; conference unset if not found"""
+    key        = messages.StringField(1)
+    found      = messages.BooleanField(2)
+    conference = messages.MessageField(ConferenceForm, 3)
+
+class ConferenceResultForms(messages.Message):
+    """ConferenceResultForms -- results in request order"""
+    items = messages.MessageField(ConferenceResultForm, 1, repeated=True)
+
+class SessionResultForm(messages.Message):
+    """SessionResultForm -- one requested key; session unset if not found"""
+    key     = messages.StringField(1)
+    found   = messages.BooleanField(2)
+    session = messages.MessageField(SessionForm, 3)
+
+class SessionResultForms(messages.Message):
+    """SessionResultForms -- results in request order"""
+    items = messages.MessageField(SessionResultForm, 1, repeated=True)
+
+class SpeakerResultForm(messages.Message):
+    """SpeakerResultForm -- one requested email; speaker unset if not found"""
+    key     = messages.StringField(1)
+    found   = messages.BooleanField(2)
+    speaker = messages.MessageField(SpeakerForm, 3)
+
+class SpeakerResultForms(messages.Message):
+    """SpeakerResultForms -- results in request order"""
+    items = messages.MessageField(SpeakerResultForm, 1, repeated=True)
+
+class SyncRemovedForm(messages.Message):
+    """SyncRemovedForm -- entity deleted or no longer in the caller's scope"""
+    kind       = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+
+class SyncForm(messages.Message):
+    """SyncForm -- one page of changes since a sync token"""
+    profile     = messages.MessageField(ProfileForm, 1)
+    conferences = messages.MessageField(ConferenceForm, 2, repeated=True)
+    sessions    = messages.MessageField(SessionForm, 3, repeated=True)
+    speakers    = messages.MessageField(SpeakerForm, 4, repeated=True)
+    removed     = messages.MessageField(SyncRemovedForm, 5, repeated=True)
+    # pass back to fetch the next page, or the next sync once more is False
+    syncToken   = messages.StringField(6)
+    more        = messages.BooleanField(7)
+    # the token had expired: drop local data and apply this as a full sync
+    reset       = messages.BooleanField(8)
+
 class SpeakerQueryForm(messages.Message):
     """SpeakerQueryForm -- Speaker query inbound form message"""
     field = messages.StringField(1)
@@ -184,5 +439,8 @@ class SpeakerQueryForm(messages.Message):
 class SpeakerQueryForms(messages.Message):
     """SpeakerQueryForms -- mutiple SpeakerQueryForm inbound form message"""
     filters = messages.MessageField(SpeakerQueryForm, 1, repeated=True)
+    # case-insensitive name prefix, for typeahead
+    namePrefix = messages.StringField(2)
+    limit = messages.IntegerField(3, variant=messages.Variant.INT32)
         
         
\ No newline at end of file
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""profiler.py
+
+On-demand cProfile sampling for production requests.
+
+A request is profiled when:
+- a random draw falls under PROFILE_SAMPLE_RATE;
+- an admin sends the PROFILE_HEADER header (see utils.isAdmin for
+  Endpoints calls); or
+- for main.py handlers, an admin's URL has the ?_profile=1 flag.
+  Some main.py URLs, such as the home page, are public, so both flags
+  are checked against users.is_current_user_admin() there.
+
+Otherwise the wrappers cost one comparison and one header lookup.
+
+Each profiled request adds its PROFILE_TOP_N functions by own time to a
+per-endpoint aggregate in memcache. Every PROFILE_PERSIST_EVERY samples
+the aggregate is also saved as a ProfileReport entity. /admin/profiles
+renders the reports.
+
+Use the profiled class decorator under @endpoints.api for ConferenceApi,
+and ProfilingMiddleware around other WSGI applications.
+
+"""
+
+import cProfile
+import functools
+import pstats
+import random
+import time
+import urlparse
+
+from google.appengine.api import memcache
+from google.appengine.api import users
+from google.appengine.ext import ndb
+
+from models import ProfileReport
+from settings import PROFILE_HEADER
+from settings import PROFILE_PERSIST_EVERY
+from settings import PROFILE_SAMPLE_RATE
+from settings import PROFILE_TOP_N
+
+MEMCACHE_PROFILE_PREFIX = "PROFILE:"
+# functions kept per aggregate, so it stays well below memcache's 1MB
+_KEPT_FUNCTIONS = PROFILE_TOP_N * 4
+
+
+def _sampled():
+    return PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _label(func):
+    filename, line, name = func
+    return '%s:%d(%s)' % (filename, line, name)
+
+
+def _merge(aggregate, sample):
+    aggregate['samples'] += 1
+    aggregate['wall'] += sample['wall']
+    functions = aggregate['functions']
+    for label, (calls, own, cumulative) in sample['functions'].items():
+        total = functions.setdefault(label, [0, 0.0, 0.0])
+        total[0] += calls
+        total[1] += own
+        total[2] += cumulative
+    if len(functions) > _KEPT_FUNCTIONS:
+        kept = sorted(functions.items(), key=lambda item: -item[1][1])
+        aggregate['functions'] = dict(kept[:_KEPT_FUNCTIONS])
+    return aggregate
+
+
+def record(name, profile, wall):
+    """Add one profile run to the aggregate of endpoint `name`."""
+    stats = pstats.Stats(profile).stats
+    top = sorted(stats.items(), key=lambda item: -item[1][2])[:PROFILE_TOP_N]
+    sample = {'wall': wall, 'functions': dict(
+        (_label(func), [calls, own, cumulative])
+        for func, (_, calls, own, cumulative, _) in top)}
+    key = MEMCACHE_PROFILE_PREFIX + name
+    client = memcache.Client()
+    aggregate = None
+    for _ in range(3):
+        current = client.gets(key)
+        if current is None:
+            aggregate = _merge({'samples': 0, 'wall': 0.0, 'functions': {}},
+                               sample)
+            if client.add(key, aggregate):
+                break
+        else:
+            aggregate = _merge(current, sample)
+            if client.cas(key, aggregate):
+                break
+    else:
+        # lost every race; dropping one sample is fine
+        return
+    # the first sample also registers the endpoint for loadReports
+    if (aggregate['samples'] - 1) % PROFILE_PERSIST_EVERY == 0:
+        ProfileReport(id=name, report=aggregate).put()
+
+
+def _run(name, func, *args):
+    profile = cProfile.Profile()
+    start = time.time()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        record(name, profile, time.time() - start)
+
+
+def _forcedByAdmin(service):
+    request_state = getattr(service, 'request_state', None)
+    headers = getattr(request_state, 'headers', None) or {}
+    if not headers.get(PROFILE_HEADER):
+        return False
+    # imported here so main.py's handlers never load Endpoints
+    import endpoints
+    from utils import isAdmin
+    user = endpoints.get_current_user()
+    return bool(user and isAdmin(user))
+
+
+def _profiledMethod(method_name, method):
+    @functools.wraps(method)
+    def wrapper(self, request):
+        if _sampled() or _forcedByAdmin(self):
+            return _run(method_name, method, self, request)
+        return method(self, request)
+    return wrapper
+
+
+def profiled(service_class):
+    """Class decorator letting every remote method be sampled by cProfile."""
+    for name, value in list(vars(service_class).items()):
+        if hasattr(value, 'remote'):
+            setattr(service_class, name, _profiledMethod(name, value))
+    return service_class
+
+
+class ProfilingMiddleware(object):
+    """WSGI middleware sampling requests by path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _forcedByAdmin(environ):
+        header = 'HTTP_' + PROFILE_HEADER.upper().replace('-', '_')
+        query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+        if not (environ.get(header) or query.get('_profile') == ['1']):
+            return False
+        # checked last: it reads the login cookie
+        return users.is_current_user_admin()
+
+    def __call__(self, environ, start_response):
+        if not (_sampled() or self._forcedByAdmin(environ)):
+            return self.app(environ, start_response)
+        # webapp2 builds the whole response before returning it
+        return _run(environ.get('PATH_INFO', '/'),
+                    lambda: list(self.app(environ, start_response)))
+
+
+def loadReports():
+    """Return {endpoint: aggregate}, newest from memcache, else datastore."""
+    reports = dict((report.key.id(), report.report)
+                   for report in ProfileReport.query())
+    cached = memcache.get_multi(reports.keys(),
+                                key_prefix=MEMCACHE_PROFILE_PREFIX)
+    reports.update(cached)
+    return reports
+
+
+def renderReports(reports, top=PROFILE_TOP_N):
+    """Render aggregates as plain text, slowest endpoints first."""
+    lines = []
+    for name, aggregate in sorted(reports.items(),
+                                  key=lambda item: -item[1]['wall']):
+        samples = aggregate['samples'] or 1
+        lines.append('%s  samples=%d  avg wall=%.1fms' % (
+            name, aggregate['samples'], aggregate['wall'] * 1000 / samples))
+        lines.append('  %10s %12s %12s  %s' % (
+            'calls/req', 'own ms/req', 'cum ms/req', 'function'))
+        functions = sorted(aggregate['functions'].items(),
+                           key=lambda item: -item[1][1])[:top]
+        for label, (calls, own, cumulative) in functions:
+            lines.append('  %10.1f %12.2f %12.2f  %s' % (
+                float(calls) / samples, own * 1000 / samples,
+                cumulative * 1000 / samples, label))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def resetReports():
+    """Drop all aggregates."""
+    keys = ProfileReport.query().fetch(keys_only=True)
+    memcache.delete_multi([key.id() for key in keys],
+                          key_prefix=MEMCACHE_PROFILE_PREFIX)
+    ndb.delete_multi(keys)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""queryshapes.py
+
+Runtime registry of datastore query shapes and a generator for the
+minimal set of composite indexes that covers them.
+
+A shape is the kind, the equality filter properties, the inequality
+property and the sort orders of a query, without the filter values.
+Each instance aggregates shapes and latencies in memory and flushes them
+to QueryShape entities through a task about once a minute.
+
+The generator relies on the datastore's merge join: equality filters on
+several properties can be answered by intersecting one (property,
+<sort orders>) index per property, so N filterable fields need N
+indexes per sort order instead of one per combination. Indexes that
+would hold more than one repeated property (exploding indexes) and
+indexes in index.yaml that no recorded shape needs are flagged.
+
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import QueryShape
+
+FLUSH_SECS = 60
+# shapes slower than this on average are worth a dedicated composite
+# index instead of a merge join
+SLOW_QUERY_MS = 200.0
+INDEX_YAML = os.path.join(os.path.dirname(__file__), 'index.yaml')
+
+_lock = threading.Lock()
+_pending = {}
+_last_flush = [time.time()]
+
+
+def shapeId(kind, equalities, inequality, orders):
+    """Return a stable id for a normalized shape."""
+    signature = json.dumps([kind, sorted(equalities), inequality, list(orders)])
+    return hashlib.md5(signature).hexdigest()
+
+
+def recordQueryShape(kind, equalities, inequality, orders, elapsed_ms):
+    """Aggregate one query execution; flush to the datastore periodically.
+
+    Args:
+      kind: entity kind name
+      equalities: property names used with "=" (may repeat)
+      inequality: property name used with an inequality, or None
+      orders: sort orders, "-prop" for descending
+      elapsed_ms: wall time spent running the query
+    """
+    equalities = sorted(equalities)
+    sid = shapeId(kind, equalities, inequality, orders)
+    with _lock:
+        entry = _pending.get(sid)
+        if entry is None:
+            entry = _pending[sid] = {
+                'kind': kind, 'equalities': equalities,
+                'inequality': inequality, 'orders': list(orders),
+                'count': 0, 'totalMs': 0.0, 'maxMs': 0.0}
+        entry['count'] += 1
+        entry['totalMs'] += elapsed_ms
+        entry['maxMs'] = max(entry['maxMs'], elapsed_ms)
+        if time.time() - _last_flush[0] < FLUSH_SECS:
+            return
+        batch = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+    try:
+        taskqueue.add(url='/tasks/flush_query_shapes',
+                      payload=json.dumps(batch))
+    except (taskqueue.Error, ValueError):
+        logging.warning('dropping %d query shapes', len(batch), exc_info=True)
+
+
+@ndb.transactional()
+def _mergeShape(sid, entry):
+    shape = QueryShape.get_by_id(sid) or QueryShape(
+        id=sid, kind=entry['kind'], equalities=entry['equalities'],
+        inequality=entry['inequality'], orders=entry['orders'])
+    shape.count += entry['count']
+    shape.totalMs += entry['totalMs']
+    shape.maxMs = max(shape.maxMs, entry['maxMs'])
+    shape.put()
+
+
+def flushQueryShapes(batch):
+    """Merge a batch produced by recordQueryShape() into QueryShape entities."""
+    for sid, entry in batch.items():
+        _mergeShape(sid, entry)
+
+
+def _isRepeated(kind, prop):
+    model = ndb.Model._kind_map.get(kind)
+    prop = model and model._properties.get(prop)
+    return bool(prop and prop._repeated)
+
+
+def _orderSpec(order):
+    if order.startswith('-'):
+        return (order[1:], 'desc')
+    return (order, 'asc')
+
+
+def requiredIndexes(shape):
+    """Return the composite indexes a merge join needs for one shape.
+
+    Each index is (kind, ((prop, direction), ...)).
+    """
+    postfix = tuple(_orderSpec(o) for o in shape.orders)
+    if shape.inequality and (not postfix or postfix[0][0] != shape.inequality):
+        postfix = ((shape.inequality, 'asc'),) + postfix
+    indexes = set()
+    for prop in set(shape.equalities):
+        if prop == shape.inequality:
+            continue
+        if postfix:
+            indexes.add((shape.kind, ((prop, 'asc'),) + postfix))
+    if not shape.equalities and len(postfix) > 1:
+        indexes.add((shape.kind, postfix))
+    # a lone sort order or pure equality filters use the built-in indexes
+    return indexes
+
+
+def loadIndexYaml(path=INDEX_YAML):
+    """Return the composite indexes currently declared in index.yaml."""
+    import yaml
+    with open(path) as f:
+        doc = yaml.safe_load(f) or {}
+    indexes = set()
+    for index in doc.get('indexes') or []:
+        props = tuple((p['name'], p.get('direction', 'asc'))
+                      for p in index.get('properties', []))
+        indexes.add((index['kind'], props))
+    return indexes
+
+
+def _isExploding(index):
+    kind, props = index
+    return len([name for name, _ in props if _isRepeated(kind, name)]) > 1
+
+
+def generateIndexYaml(shapes, existing=None):
+    """Render the minimal covering index.yaml for the recorded shapes."""
+    needed = collections.defaultdict(list)
+    slow = []
+    for shape in shapes:
+        for index in requiredIndexes(shape):
+            needed[index].append(shape)
+        if shape.count and shape.totalMs / shape.count > SLOW_QUERY_MS and \
+                len(set(shape.equalities)) > 1:
+            slow.append(shape)
+
+    lines = ['indexes:', '',
+             '# generated by queryshapes.generateIndexYaml() from %d query '
+             'shapes' % len(shapes), '']
+    for index in sorted(needed):
+        kind, props = index
+        uses = sum(s.count for s in needed[index])
+        lines.append('# used by %d queries in %d shapes%s' % (
+            uses, len(needed[index]),
+            '; EXPLODING: more than one repeated property' if
+            _isExploding(index) else ''))
+        lines.append('- kind: %s' % kind)
+        lines.append('  properties:')
+        for name, direction in props:
+            lines.append('  - name: %s' % name)
+            if direction == 'desc':
+                lines.append('    direction: desc')
+        lines.append('')
+
+    for shape in slow:
+        lines.append('# SLOW: %s %s avg %.0fms over %d runs; consider a '
+                     'dedicated composite index' % (
+                         shape.kind, '+'.join(shape.equalities),
+                         shape.totalMs / shape.count, shape.count))
+    if existing:
+        for kind, props in sorted(set(existing) - set(needed)):
+            lines.append('# UNUSED%s: %s(%s)' % (
+                ' EXPLODING' if _isExploding((kind, props)) else '',
+                kind, ', '.join(name for name, _ in props)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""ratelimit.py
+
+Per user, per API method token buckets kept in memcache.
+
+A bucket holds up to `size` tokens and refills continuously at `rate`
+tokens per second. It is stored as (tokens, timestamp) and updated with
+gets/cas, so concurrent calls cannot both spend the same token. Every
+call takes one token; queries without filters take
+UNFILTERED_QUERY_COST. A call that finds its bucket short fails fast
+with a 403 (rateLimitExceeded) before any datastore work.
+
+Only signed-in callers are limited. Behind the Endpoints frontend
+REMOTE_ADDR is the frontend's address, not the client's, so anonymous
+callers cannot be told apart and one shared bucket would throttle all
+of them together.
+
+Apply the rateLimited class decorator under @endpoints.api to cover
+every remote method of a service.
+
+"""
+
+import functools
+import hashlib
+import logging
+import time
+
+import endpoints
+
+from google.appengine.api import memcache
+
+from errors import TooManyRequestsException
+from settings import RATE_LIMITS
+from settings import UNFILTERED_QUERY_COST
+from utils import getUserId
+
+MEMCACHE_RATELIMIT_PREFIX = "RATELIMIT:"
+# cas attempts before a contended call is let through
+CAS_RETRIES = 3
+
+
+def _requestCost(method_name, request):
+    """Return how many tokens a call takes."""
+    narrowed = any(getattr(request, name, None) for name in
+                   ('namePrefix', 'activeFrom', 'activeTo'))
+    if getattr(request, 'filters', None) == [] and not narrowed and \
+            method_name in ('queryConferences', 'querySpeakers'):
+        return UNFILTERED_QUERY_COST
+    return 1
+
+
+def takeTokens(method_name, request, now=None):
+    """Take tokens for a call; return False if the bucket is short."""
+    user = endpoints.get_current_user()
+    if not user:
+        return True
+    rate, size = RATE_LIMITS.get(method_name, RATE_LIMITS['*'])
+    now = now if now is not None else time.time()
+    key = MEMCACHE_RATELIMIT_PREFIX + hashlib.md5('%s|%s' % (
+        getUserId(user), method_name)).hexdigest()
+    cost = _requestCost(method_name, request)
+    # an evicted or expired bucket is a full one
+    expires = int(size / rate) + 1
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        bucket = client.gets(key)
+        if bucket is None:
+            if cost > size:
+                return False
+            if client.add(key, (size - cost, now), time=expires):
+                return True
+            continue
+        tokens, stamp = bucket
+        tokens = min(size, tokens + max(0.0, now - stamp) * rate)
+        if tokens < cost:
+            return False
+        if client.cas(key, (tokens - cost, now), time=expires):
+            return True
+    # lost every race, or memcache unavailable: fail open
+    return True
+
+
+def _limited(method_name, method):
+    @functools.wraps(method)
+    def wrapper(self, request):
+        if not takeTokens(method_name, request):
+            logging.info('rate limited %s', method_name)
+            raise TooManyRequestsException(
+                'rateLimitExceeded: too many %s requests; slow down.'
+                % method_name)
+        return method(self, request)
+    return wrapper
+
+
+def rateLimited(service_class):
+    """Class decorator wrapping every remote method with takeTokens()."""
+    for name, value in list(vars(service_class).items()):
+        if hasattr(value, 'remote'):
+            setattr(service_class, name, _limited(name, value))
+    return service_class
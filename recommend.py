@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""recommend.py
+
+Offline "recommended sessions" engine.
+
+A batch job turns every live Session into a sparse, L2-normalized TF-IDF
+vector over its highlight words, its speaker's fields, the speaker and
+the session type, and stores the vectors as .npz parts. It runs as a
+chain of tasks: each reads SESSION_BATCH sessions by cursor and saves
+their raw term counts as a staging part; the last one computes the
+IDF weights and norms from those arrays and writes the final parts. A user's vector
+is the sum of the sessions in their wishlist. Scoring a user against all
+sessions is one sparse matrix-vector product, done with numpy gathers
+and a bincount over the term -> sessions postings. The top TOP_K
+unwishlisted sessions, limited to conferences the user attends when
+there are any, are rendered and stored in the user's Recommendation
+entity, so the API serves them with a single get.
+
+A wishlist change queues a refresh for that user only
+(ConferenceApi._scheduleRecommendationRefresh).
+
+"""
+
+import collections
+import io
+import re
+
+import numpy as np
+from protorpc import protojson
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import Recommendation
+from models import RecommenderModel
+from models import RecommenderModelPart
+from models import Session
+from models import SessionForms
+from models import Speaker
+
+TOP_K = 20
+PART_ROWS = 20000
+SESSION_BATCH = 2000
+PROFILE_BATCH = 200
+_TOKEN_RE = re.compile(r'[a-z0-9+#]+')
+
+# per-instance copy of the newest model: {'key': ..., 'model': {...}}
+_loaded = {}
+
+
+def sessionTerms(session, speaker_fields):
+    """Return the list of (possibly repeated) terms describing a session."""
+    terms = ['h:' + token for highlight in session.highlights
+             if highlight != 'NOT_SPECIFIED'
+             for token in _TOKEN_RE.findall(highlight.lower())]
+    terms += ['f:' + field.lower() for field in speaker_fields
+              if field != 'NOT_SPECIFIED']
+    if session.speaker:
+        terms.append('s:' + session.speaker.lower())
+    terms.append('t:' + (session.typeOfSession or 'NOT_SPECIFIED'))
+    return terms
+
+
+def _pack(**arrays):
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+
+def _batchKey(model_key, batch):
+    # names sort after the numeric ids of the final parts
+    return ndb.Key(RecommenderModelPart, 'batch-%06d' % batch,
+                   parent=model_key)
+
+
+def startModel():
+    """Create a new RecommenderModel and queue its first batch."""
+    model_key = RecommenderModel().put()
+    enqueueModelTask(model_key, 0)
+    return model_key
+
+
+def enqueueModelTask(model_key, batch, cursor=None):
+    params = {'model': model_key.urlsafe(), 'batch': batch}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    taskqueue.add(url='/tasks/build_recommendations', params=params)
+
+
+def modelBatch(model, batch, cursor=None):
+    """Count the terms of one batch of live sessions and chain the next.
+
+    The batch is saved as a staging part named after its number, so a
+    retried task overwrites it. Returns the model key once the last
+    batch has completed the model, otherwise None.
+    """
+    model_key = ndb.Key(urlsafe=model)
+    sessions, next_cursor, more = Session.query(
+        Session.isLive == True).fetch_page(
+            SESSION_BATCH,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    speaker_keys = list(set(ndb.Key(Speaker, s.speaker)
+                            for s in sessions if s.speaker))
+    fields = dict((speaker.key.id(), speaker.field) for speaker in
+                  ndb.get_multi(speaker_keys) if speaker)
+    rows, terms, tf = [], [], []
+    for row, session in enumerate(sessions):
+        counts = collections.Counter(
+            sessionTerms(session, fields.get(session.speaker, [])))
+        for term, n in counts.items():
+            rows.append(row)
+            terms.append(term.encode('utf-8'))
+            tf.append(n)
+    RecommenderModelPart(key=_batchKey(model_key, batch), data=_pack(
+        rows=np.array(rows, dtype=np.int32), terms=np.array(terms, dtype=str),
+        tf=np.array(tf, dtype=np.int32),
+        sessions=np.array([s.key.urlsafe() for s in sessions], dtype=str),
+        conferences=np.array([s.key.parent().urlsafe() for s in sessions],
+                             dtype=str))).put()
+    if more and next_cursor:
+        enqueueModelTask(model_key, batch + 1, next_cursor)
+        return None
+    return _finishModel(model_key, batch + 1)
+
+
+def _finishModel(model_key, batches):
+    """Turn the staging parts into the final TF-IDF parts."""
+    model = model_key.get()
+    if model is None or model.complete:
+        # a retry after the model was finished
+        return model_key if model else None
+    staged = [np.load(io.BytesIO(part.data)) for part in ndb.get_multi(
+        [_batchKey(model_key, i) for i in range(batches)])]
+    rows, terms, tf, session_keys, conf_keys = [], [], [], [], []
+    offset = 0
+    for part in staged:
+        rows.append(part['rows'] + offset)
+        terms.append(part['terms'])
+        tf.append(part['tf'])
+        session_keys.append(part['sessions'])
+        conf_keys.append(part['conferences'])
+        offset += len(part['sessions'])
+    staging_keys = [_batchKey(model_key, i) for i in range(batches)]
+    if not offset:
+        ndb.delete_multi(staging_keys + [model_key])
+        return None
+    rows = np.concatenate(rows)
+    vocab, cols = np.unique(np.concatenate(terms), return_inverse=True)
+    cols = cols.astype(np.int32)
+    session_keys = np.concatenate(session_keys)
+    conf_keys = np.concatenate(conf_keys)
+    # every session has at least its type term, so nothing here is empty
+    df = np.bincount(cols, minlength=len(vocab))
+    idf = np.log((1.0 + offset) / (1.0 + df)) + 1.0
+    data = np.concatenate(tf).astype(np.float64) * idf[cols]
+    norms = np.sqrt(np.bincount(rows, weights=data ** 2, minlength=offset))
+    data = (data / norms[rows]).astype(np.float32)
+
+    parts = []
+    for start in range(0, offset, PART_ROWS):
+        stop = start + PART_ROWS
+        mask = (rows >= start) & (rows < stop)
+        # ids keep the parts in row order for loadModel
+        parts.append(RecommenderModelPart(
+            id=start // PART_ROWS + 1, parent=model_key, data=_pack(
+            rows=rows[mask], cols=cols[mask], data=data[mask],
+            sessions=session_keys[start:stop],
+            conferences=conf_keys[start:stop])))
+    ndb.put_multi(parts)
+    model.numTerms, model.numRows = len(vocab), offset
+    model.complete = True
+    model.put()
+    ndb.delete_multi(staging_keys)
+    # a newer build may still be running; leave it and its parts alone
+    for old in RecommenderModel.query(RecommenderModel.complete == True):
+        if old.createdAt < model.createdAt:
+            ndb.delete_multi(RecommenderModelPart.query(
+                ancestor=old.key).fetch(keys_only=True) + [old.key])
+    return model_key
+
+
+def loadModel():
+    """Return the newest complete model as arrays, cached per instance."""
+    latest = RecommenderModel.query(RecommenderModel.complete == True).order(
+        -RecommenderModel.createdAt).get()
+    if latest is None:
+        return None
+    if _loaded.get('key') == latest.key:
+        return _loaded['model']
+    # by id: the ancestor query would also see a build's staging parts
+    num_parts = -(-latest.numRows // PART_ROWS)
+    parts = [np.load(io.BytesIO(part.data)) for part in ndb.get_multi(
+        [ndb.Key(RecommenderModelPart, i, parent=latest.key)
+         for i in range(1, num_parts + 1)])]
+    cat = lambda name, dtype: np.concatenate(
+        [p[name] for p in parts]) if parts else np.zeros(0, dtype=dtype)
+    rows, cols = cat('rows', np.int32), cat('cols', np.int32)
+    data = cat('data', np.float32)
+    session_keys, conf_keys = cat('sessions', str), cat('conferences', str)
+    # parts are written in row order, so rows are already sorted (CSR)
+    row_ptr = np.searchsorted(rows, np.arange(latest.numRows + 1))
+    # term -> sessions postings (CSC) for the scoring product
+    order = np.argsort(cols, kind='mergesort')
+    model = {
+        'rows': rows, 'cols': cols, 'data': data, 'row_ptr': row_ptr,
+        'post_rows': rows[order], 'post_data': data[order],
+        'term_ptr': np.searchsorted(cols[order],
+                                    np.arange(latest.numTerms + 1)),
+        'sessions': session_keys, 'conferences': conf_keys,
+        'row_of': dict((key, i) for i, key in enumerate(session_keys)),
+    }
+    _loaded.clear()
+    _loaded.update(key=latest.key, model=model)
+    return model
+
+
+def _gather(ptr, ids):
+    """Return positions of all entries in slices ptr[i]:ptr[i+1] for ids."""
+    starts, lengths = ptr[ids], ptr[ids + 1] - ptr[ids]
+    total = int(lengths.sum())
+    if not total:
+        return np.zeros(0, dtype=np.intp), lengths
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths,
+                                           lengths)
+    return np.repeat(starts, lengths) + offsets, lengths
+
+
+def recommendFor(model, wishlist, attending):
+    """Return up to TOP_K session keys for a wishlist, best first."""
+    wished = np.array([model['row_of'][k] for k in wishlist
+                       if k in model['row_of']], dtype=np.intp)
+    if not len(wished):
+        return []
+    # user vector: sum of the wishlisted session vectors
+    pos, _ = _gather(model['row_ptr'], wished)
+    terms, inverse = np.unique(model['cols'][pos], return_inverse=True)
+    weights = np.bincount(inverse, weights=model['data'][pos])
+    # sessions x user product over the postings of the user's terms
+    pos, lengths = _gather(model['term_ptr'], terms.astype(np.intp))
+    scores = np.bincount(model['post_rows'][pos],
+                         weights=model['post_data'][pos] *
+                         np.repeat(weights, lengths),
+                         minlength=len(model['sessions']))
+    scores[wished] = 0
+    if attending:
+        scores[~np.in1d(model['conferences'], list(attending))] = 0
+    best = np.argsort(-scores, kind='mergesort')[:TOP_K]
+    return [str(model['sessions'][i]) for i in best if scores[i] > 0]
+
+
+def _storeRecommendations(user_id, session_keys, render):
+    sessions = [s for s in ndb.get_multi(
+        [ndb.Key(urlsafe=k) for k in session_keys]) if s]
+    forms = SessionForms(items=[render(s) for s in sessions])
+    return Recommendation(id=user_id,
+                          sessionKeys=[s.key.urlsafe() for s in sessions],
+                          forms=protojson.encode_message(forms))
+
+
+def recommendProfiles(render, cursor=None):
+    """Refresh one batch of profiles; returns the next cursor or None."""
+    model = loadModel()
+    if model is None:
+        return None
+    profiles, next_cursor, more = Profile.query().fetch_page(
+        PROFILE_BATCH, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    ndb.put_multi([
+        _storeRecommendations(prof.key.id(), recommendFor(
+            model, prof.wishlist, prof.conferenceKeysToAttend), render)
+        for prof in profiles if prof.wishlist])
+    # an emptied wishlist leaves nothing to recommend from
+    ndb.delete_multi([ndb.Key(Recommendation, prof.key.id())
+                      for prof in profiles if not prof.wishlist])
+    return next_cursor if more else None
+
+
+def refreshProfile(user_id, render):
+    """Recompute one user's recommendations against the current model."""
+    model = loadModel()
+    prof = ndb.Key(Profile, user_id).get()
+    if model is None or prof is None:
+        return
+    _storeRecommendations(user_id, recommendFor(
+        model, prof.wishlist, prof.conferenceKeysToAttend), render).put()
@@ -16,3 +16,88 @@ WEB_CLIENT_ID = '747134833928-c9bsb4alsm87qs79ug37ubk12c6f6rg1.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Confirmation email pull queue (see mailqueue.py and queue.yaml)
+MAIL_QUEUE_NAME = 'confirmation-email'
+MAIL_LEASE_BATCH = 100          # tasks leased per batch
+MAIL_LEASE_SECS = 120           # lease held while a batch is being sent
+MAIL_SENDS_PER_SECOND = 5.0     # send-rate limit for mail.send_mail
+MAIL_RETRY_BASE_SECS = 60       # first retry delay, doubled on every failure
+MAIL_RETRY_MAX_SECS = 3600
+MAIL_MAX_RETRIES = 8            # give up on a message after this many failures
+MAIL_WORKER_BUDGET_SECS = 50    # cron runs every minute; stop leasing before the next run
+
+# Conference registration admission control (see waitlist.py)
+REGISTRATION_RATE_PER_SEC = 50  # per conference; extra requests are queued
+WAITLIST_ADMIT_BATCH = 20       # waiters admitted per cross-group transaction
+WAITLIST_BATCHES_PER_TASK = 10
+
+# How long a client requestId is remembered for mutating calls (idempotency.py)
+IDEMPOTENCY_TTL_SECS = 24 * 60 * 60
+# A reserved requestId whose call has not finished after this long (the
+# request deadline) is assumed abandoned and may be run again
+IDEMPOTENCY_PENDING_SECS = 60
+
+# Delta sync (see sync.py): entities per sync page, and how long removal
+# records are kept; older tokens get a full resync
+SYNC_PAGE_SIZE = 200
+SYNC_RETENTION_DAYS = 30
+
+# Request profiling (see profiler.py): fraction of requests run under
+# cProfile (0 disables sampling), the header admins send to profile a
+# single request, functions kept per sample, and how often aggregates
+# are saved to the datastore
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOP_N = 30
+PROFILE_PERSIST_EVERY = 20
+
+# Conferences embedded in the home page (see homepage.py); one page of
+# the web client's conference list
+HOMEPAGE_CONFERENCES = 20
+
+# Schema backfills (see mapper.py): shards per job by default, entities
+# per put_multi batch (the datastore limit is 500) and the time a task
+# runs before it checkpoints and chains the next one; push tasks are
+# cut off at 10 minutes
+MAPPER_QUEUE = 'mapper'
+MAPPER_SHARDS = 8
+MAPPER_BATCH = 500
+MAPPER_TASK_SECS = 120
+
+# Deadline-aware queries (see deadline.py): seconds of datastore reads
+# an API request may spend before returning partial results (requests
+# are cut off at 60), and entities fetched per RPC
+QUERY_BUDGET_SECS = 40
+QUERY_BATCH_SIZE = 200
+
+# Traffic capture for load replay (see trafficcapture.py): fraction of
+# Endpoints requests logged (0 turns the middleware off), and how many
+# records or seconds an instance buffers before saving a chunk
+CAPTURE_SAMPLE_RATE = 0.0
+CAPTURE_FLUSH_RECORDS = 100
+CAPTURE_FLUSH_SECS = 60
+
+# Large memcache values (see largevalue.py): payloads above
+# LARGE_VALUE_COMPRESS_BYTES are zlib-compressed, and split into chunks
+# below memcache's 1 MB item limit; values needing more than
+# LARGE_VALUE_MAX_CHUNKS chunks are not cached
+LARGE_VALUE_CHUNK_BYTES = 900 * 1024
+LARGE_VALUE_COMPRESS_BYTES = 1024
+LARGE_VALUE_MAX_CHUNKS = 16
+
+# Users allowed to call admin-only API methods such as getConferenceStats,
+# e.g. ['ops@example.com']. Project admins calling with an OAuth access
+# token (as the API explorer does) are allowed as well; see utils.isAdmin
+ADMIN_EMAILS = []
+
+# Per user and API method request budgets (see ratelimit.py):
+# method name -> (tokens refilled per second, bucket size)
+RATE_LIMITS = {
+    '*': (5.0, 30),
+    'queryConferences': (2.0, 20),
+    # served from the in-instance directory; typeahead calls per keystroke
+    'querySpeakers': (10.0, 50),
+}
+# token cost of a query without filters, which returns a whole kind
+UNFILTERED_QUERY_COST = 10
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""speakerdirectory.py
+
+In-instance speaker directory serving querySpeakers.
+
+Every Speaker is kept as a compact tuple in a list sorted by lowercased
+name, so a name prefix is two bisects. Equality filters on the
+whitelisted fields are answered from per-value postings of row numbers,
+which stay in name order. No filter combination needs a datastore index.
+
+The directory is rebuilt from the datastore when the version stamp in
+memcache moves; _createSpeakerObject bumps it after every write. An
+instance re-reads the stamp at most every RECHECK_SECS.
+
+The rebuild's global query is eventually consistent and can miss a
+speaker written a moment ago. bumpVersion() therefore also remembers
+the written key for RECENT_SECS, and rebuilds read those speakers by
+key and merge them in.
+
+"""
+
+import bisect
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Speaker
+
+MEMCACHE_SPEAKER_DIRECTORY_VERSION = "SPEAKER_DIRECTORY_VERSION"
+MEMCACHE_SPEAKER_DIRECTORY_RECENT = "SPEAKER_DIRECTORY_RECENT"
+RECHECK_SECS = 5.0
+# how long a written speaker is read by key on rebuilds; well past the
+# time the global query takes to catch up
+RECENT_SECS = 60
+# field name in SpeakerQueryForm -> column in a directory row
+FILTER_FIELDS = {'name': 1, 'email': 2, 'company': 3, 'sex': 4, 'field': 5}
+
+_lock = threading.Lock()
+# {'version': ..., 'checked': ..., 'rows': [...], 'names': [...], 'postings': {...}}
+_directory = {}
+
+
+def _rememberWrite(s_key, now):
+    """Add s_key to the recently written speakers, dropping old ones."""
+    client = memcache.Client()
+    for _ in range(5):
+        recent = client.gets(MEMCACHE_SPEAKER_DIRECTORY_RECENT)
+        if recent is None:
+            if client.add(MEMCACHE_SPEAKER_DIRECTORY_RECENT,
+                          [(now, s_key.id())]):
+                return
+            continue
+        recent = [(written, speaker_id) for written, speaker_id in recent
+                  if written > now - RECENT_SECS and
+                  speaker_id != s_key.id()]
+        recent.append((now, s_key.id()))
+        if client.cas(MEMCACHE_SPEAKER_DIRECTORY_RECENT, recent):
+            return
+
+
+def _recentSpeakers(now):
+    recent = memcache.get(MEMCACHE_SPEAKER_DIRECTORY_RECENT) or []
+    keys = [ndb.Key(Speaker, speaker_id) for written, speaker_id in recent
+            if written > now - RECENT_SECS]
+    return [s for s in ndb.get_multi(keys) if s is not None]
+
+
+def bumpVersion(s_key=None):
+    """Invalidate every instance's directory after a Speaker write."""
+    if s_key is not None:
+        # before the bump, so a rebuild at the new version sees it
+        _rememberWrite(s_key, time.time())
+    # an evicted stamp restarts from the clock, never from a value an
+    # instance may already hold
+    memcache.incr(MEMCACHE_SPEAKER_DIRECTORY_VERSION,
+                  initial_value=int(time.time()))
+    with _lock:
+        _directory.pop('checked', None)
+
+
+def _currentVersion():
+    version = memcache.get(MEMCACHE_SPEAKER_DIRECTORY_VERSION)
+    if version is None:
+        memcache.add(MEMCACHE_SPEAKER_DIRECTORY_VERSION, int(time.time()))
+        version = memcache.get(MEMCACHE_SPEAKER_DIRECTORY_VERSION)
+    return version
+
+
+def buildDirectory(speakers):
+    """Return sorted rows, their sort keys and the filter postings."""
+    rows = sorted(
+        ((s.name or u'').lower(), s.name, s.email, s.company, s.sex,
+         tuple(s.field)) for s in speakers)
+    postings = dict((name, {}) for name in FILTER_FIELDS)
+    for i, row in enumerate(rows):
+        for name, column in FILTER_FIELDS.items():
+            values = row[column] if name == 'field' else (row[column],)
+            for value in set(values):
+                postings[name].setdefault(value, []).append(i)
+    return {'rows': rows, 'names': [row[0] for row in rows],
+            'postings': postings}
+
+
+def _getDirectory(now=None):
+    now = now if now is not None else time.time()
+    with _lock:
+        directory = dict(_directory)
+    if directory.get('checked', 0) + RECHECK_SECS > now:
+        return directory
+    version = _currentVersion()
+    if directory and version is not None and version == directory['version']:
+        directory['checked'] = now
+    else:
+        # gets by key are strongly consistent; they replace whatever
+        # the query returned for the same speakers
+        speakers = dict((s.key, s) for s in Speaker.query())
+        speakers.update((s.key, s) for s in _recentSpeakers(now))
+        directory = buildDirectory(speakers.values())
+        directory.update(version=version, checked=now)
+    with _lock:
+        _directory.clear()
+        _directory.update(directory)
+    return directory
+
+
+def searchSpeakers(filters, prefix=None, limit=None):
+    """Return matching speakers as (name, email, company, sex, fields).
+
+    Args:
+      filters: (field, value) equality pairs; fields must be in
+        FILTER_FIELDS, otherwise ValueError is raised.
+      prefix: optional case-insensitive name prefix.
+      limit: optional maximum number of results.
+    Results are ordered by name.
+    """
+    for field, _ in filters:
+        if field not in FILTER_FIELDS:
+            raise ValueError('Unknown speaker field: %s' % field)
+    directory = _getDirectory()
+    names = directory['names']
+    lo, hi = 0, len(names)
+    if prefix:
+        prefix = prefix.lower()
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_left(names, prefix + u'\uffff', lo)
+
+    candidates = None
+    # most selective posting first, so the intersection stays small
+    for posting in sorted((directory['postings'][field].get(value, [])
+                           for field, value in filters), key=len):
+        # postings are sorted: restrict to the prefix range by bisecting
+        posting = posting[bisect.bisect_left(posting, lo):
+                          bisect.bisect_left(posting, hi)]
+        if candidates is None:
+            candidates = posting
+        else:
+            members = set(posting)
+            candidates = [i for i in candidates if i in members]
+        if not candidates:
+            return []
+    if candidates is None:
+        candidates = xrange(lo, hi)
+
+    rows = directory['rows']
+    results = []
+    for i in candidates:
+        if limit and len(results) >= limit:
+            break
+        results.append(rows[i][1:])
+    return results
@@ -0,0 +1,719 @@
+'use strict';
+ 
+var app = angular.module('conferenceApp',
+['conferenceControllers', 'ngRoute', 'ui.bootstrap']).
+config(['$routeProvider',
+function ($routeProvider) {
+$routeProvider.
+when('/conference', {
+templateUrl: '/partials/show_conferences.html',
+controller: 'ShowConferenceCtrl'
+}).
+when('/conference/create', {
+templateUrl: '/partials/create_conferences.html',
+controller: 'CreateConferenceCtrl'
+}).
+when('/conference/detail/:websafeConferenceKey', {
+templateUrl: '/partials/conference_detail.html',
+controller: 'ConferenceDetailCtrl'
+}).
+when('/profile', {
+templateUrl: '/partials/profile.html',
+controller: 'MyProfileCtrl'
+}).
+when('/', {
+templateUrl: '/partials/home.html'
+}).
+otherwise({
+redirectTo: '/'
+});
+}]);
+ 
+app.filter('startFrom', function () {
+ 
+var filter = function (data, start) {
+return data.slice(start);
+}
+return filter;
+});
+ 
+app.constant('HTTP_ERRORS', {
+'UNAUTHORIZED': 401
+});
+ 
+app.factory('bootstrapPayload', function () {
+var payload = window.CONFERENCE_BOOTSTRAP || {};
+return {
+ 
+take: function (name) {
+var value = payload[name];
+delete payload[name];
+return value;
+},
+ 
+expireConferences: function () {
+delete payload.conferences;
+delete payload.moreConferences;
+delete payload.nextConferenceCursor;
+}
+};
+});
+ 
+app.factory('oauth2Provider', function ($modal) {
+var oauth2Provider = {
+CLIENT_ID: '747134833928-c9bsb4alsm87qs79ug37ubk12c6f6rg1.apps.googleusercontent.com',
+SCOPES: 'email profile',
+signedIn: false
+}
+ 
+oauth2Provider.signIn = function (callback) {
+gapi.auth.signIn({
+'clientid': oauth2Provider.CLIENT_ID,
+'cookiepolicy': 'single_host_origin',
+'accesstype': 'online',
+'approveprompt': 'auto',
+'scope': oauth2Provider.SCOPES,
+'callback': callback
+});
+};
+ 
+oauth2Provider.signOut = function () {
+gapi.auth.signOut();
+
+gapi.auth.setToken({access_token: ''})
+oauth2Provider.signedIn = false;
+};
+ 
+oauth2Provider.showLoginModal = function() {
+var modalInstance = $modal.open({
+templateUrl: '/partials/login.modal.html',
+controller: 'OAuth2LoginModalCtrl'
+});
+return modalInstance;
+};
+return oauth2Provider;
+});
+angular.module("conferenceApp").run(['$templateCache',function($templateCache){
+$templateCache.put("/partials/conference_detail.html","<div ng-controller=\"ConferenceDetailCtrl\"> <div class=\"row\"> <div class=\"col-lg-12\"> <div id=\"messages\" class=\"alert alert-{{alertStatus}}\" ng-show=\"messages\"> <span ng-bind=\"messages\"></span> <i class=\"dismiss-messages pull-right glyphicon glyphicon-remove\" ng-click=\"messages = ''\"\n                   ng-show=\"messages\"></i> </div> <img class=\"spinner\" src=\"/img/ajax-loader.gif\" ng-show=\"loading\"/> </div> </div> <div class=\"row\" ng-init=\"init()\"> <div class=\"col-md-9\"> <div class=\"well well-sm\"> <h2>{{conference.name}}</h2> <h5>{{conference.description}}</h5> <div> <label for=\"registered\">Registered/Open: </label> <span id=\"registered\">{{conference.maxAttendees - conference.seatsAvailable}} / {{conference.maxAttendees}}</span> </div> <div> <label for=\"organizer\">Organizer: </label> <span id=\"organizer\">{{conference.organizerDisplayName}}</span> </div> <p><a class=\"btn btn-primary\" ng-hide=\"isUserAttending\" ng-click=\"registerForConference()\"\n                        ng-disabled=\"loading\">Register</a></p> <p><a class=\"btn btn-primary\" ng-show=\"isUserAttending\" ng-click=\"unregisterFromConference()\"\n                        ng-disabled=\"loading\">Unregister</a></p> </div> <form class=\"form\" novalidate role=\"form\"> <fieldset> <div> <label for=\"city\">City: </label> <span id=\"city\">{{conference.city}}</span> </div> <div> <label for=\"topics\">Topics: </label> <span id=\"topics\"> <span ng-repeat=\"topic in conference.topics\" class=\"label label-primary label-separated\">{{topic}}</span> </span> </div> <div> <label for=\"startDate\">Start Date: </label> <span id=\"startDate\">{{conference.startDate | date:'dd-MMMM-yyyy'}}</span> </div> <div> <label for=\"endDate\">End Date: </label> <span id=\"endDate\">{{conference.endDate | date:'dd-MMMM-yyyy'}}</span> </div> </fieldset> </form> </div> </div> </div>");
+$templateCache.put("/partials/create_conferences.html","<div ng-controller=\"CreateConferenceCtrl\"> <div class=\"row\"> <div class=\"col-lg-12\"> <div id=\"messages\" class=\"alert alert-{{alertStatus}}\" ng-show=\"messages\"> <span ng-bind=\"messages\"></span> <i class=\"dismiss-messages pull-right glyphicon glyphicon-remove\" ng-click=\"messages = ''\"\n                   ng-show=\"messages\"></i> </div> <img class=\"spinner\" src=\"/img/ajax-loader.gif\" ng-show=\"loading\"/> </div> </div> <div class=\"row\"> <div class=\"col-md-8\"> <h3>Create a conference</h3> <form name=\"conferenceForm\" novalidate role=\"form\"> <div class=\"form-group\"> <label for=\"name\">Name <span class=\"required\">*</span></label> <span class=\"label label-danger\"\n                        ng-show=\"conferenceForm.name.$error.required\">Required!</span> <input id=\"name\" type=\"text\" name=\"name\" ng-model=\"conference.name\" class=\"form-control\"\n                           ng-required=\"true\"/> </div> <div class=\"form-group\"> <label for=\"city\">City</label> <select id=\"city\" ng-model=\"conference.city\" name=\"city\" ng-options=\"city for city in cities\"\n                            class=\"form-control\"> </select> </div> <div class=\"form-group\"> <label for=\"description\">Description</label> <textarea id=\"description\" type=\"text\" name=\"description\" ng-model=\"conference.description\"\n                              class=\"form-control\"></textarea> </div> <div class=\"form-group\"> <label for=\"topics\">Topics</label> <select id=\"topics\" ng-model=\"conference.topics\" name=\"topics\"\n                            ng-options=\"topic for topic in topics\"\n                            class=\"form-control\" multiple> </select> </div> <div class=\"form-group\" ng-controller=\"DatepickerCtrl\"> <label for=\"startDate\">Start Date</label> <p class=\"input-group\"> <input id=\"startDate\" type=\"text\" class=\"form-control\" datepicker-popup=\"{{format}}\"\n                               ng-model=\"conference.startDate\" is-open=\"opened\"\n                               datepicker-options=\"dateOptions\"\n                               close-text=\"Close\"/> <span class=\"input-group-btn\"> <button class=\"btn btn-default\" ng-click=\"open($event)\"><i\n                                class=\"glyphicon glyphicon-calendar\"></i> </button> </span> </p> </div> <div class=\"form-group\" ng-controller=\"DatepickerCtrl\"> <label for=\"endDate\">End Date</label> <span class=\"label label-danger\"\n                        ng-show=\"!isValidDates()\">End Date must be later or equal to Start Date!</span> <p class=\"input-group\"> <input id=\"endDate\" type=\"text\" class=\"form-control\" datepicker-popup=\"{{format}}\"\n                               ng-model=\"conference.endDate\" is-open=\"opened\"\n                               datepicker-options=\"dateOptions\"\n                               close-text=\"Close\"/> <span class=\"input-group-btn\"> <button class=\"btn btn-default\" ng-click=\"open($event)\"><i\n                                class=\"glyphicon glyphicon-calendar\"></i> </button> </span> </p> </div> <div class=\"form-group\"> <label for=\"maxAttendees\">Max Attendees</label> <span class=\"label label-danger\"\n                        ng-show=\"!isValidMaxAttendees()\">Must be an integer!</span> <!-- The input type is text as the conference.maxAttendees will be undefined,\n                    hence isValidMaxAttendees will be true when input type is number --> <input id=\"maxAttendees\" type=\"text\" name=\"maxAttendees\" ng-model=\"conference.maxAttendees\"\n                           class=\"form-control\"/> </div> <button ng-click=\"createConference(conferenceForm)\" class=\"btn btn-primary\"\n                        ng-disabled=\"!isValidConference(conferenceForm) || loading\">Create\n                </button> </form> </div> </div> </div>");
+$templateCache.put("/partials/home.html","<div class=\"intro-header\"> <div class=\"row\"> <div class=\"col-lg-12\"> <div class=\"intro-message\"> <h1>Welcome to Conference Central</h1> <h3>Lets you manage conferences</h3> <hr class=\"intro-divider\"> <ul class=\"list-inline intro-social-buttons\"> <li id=\"signInLink\" ng-hide=\"getSignedInState()\" on-click=\"return false\"> <a class=\"btn btn-default btn-lg\" ng-click=\"signIn()\">Google+ SignIn</a> </li> <li id=\"signOutLink\" ng-show=\"getSignedInState()\" on-click=\"return false\"> <a class=\"btn btn-default btn-lg\" ng-click=\"signOut()\">Log out</a> </li> </ul> </div> </div> </div> </div> <div class=\"section-a\"> <div class=\"row\"> <div class=\"col-lg-5 col-sm-6\"> <hr> <div class=\"clearfix\"></div> <h2>View conferences</h2> <p class=\"lead\">View by city, topics, date, max attendees.</p> <a href=\"#/conference\" class=\"btn btn-default btn-lg\">View conferences</a> </div> <div class=\"col-lg-5 col-lg-offset-2 col-sm-6\"> <img class=\"img-responsive\" src=\"/img/business1.jpg\" alt=\"\"> </div> </div> </div> <div class=\"section-a\"> <div class=\"row\"> <div class=\"col-lg-5 col-lg-offset-1 col-sm-push-6  col-sm-6\"> <hr class=\"section-heading-spacer\"> <div class=\"clearfix\"></div> <h2 class=\"section-heading\">Create new conferences</h2> <p class=\"lead\">In 10 seconds or less.</p> <a href=\"#/conference/create\" class=\"btn btn-default btn-lg\">Create a conference</a> </div> <div class=\"col-lg-5 col-sm-pull-6  col-sm-6\"> <img class=\"img-responsive\" src=\"/img/business2.jpg\" alt=\"\"> </div> </div> </div> <div class=\"section-a\"> <div class=\"row\"> <div class=\"col-lg-5 col-sm-6\"> <hr> <div class=\"clearfix\"></div> <h2 class=\"section-heading\">Update your profile</h2> <a href=\"#/profile\" class=\"btn btn-default btn-lg\">View my profile</a> </div> <div class=\"col-lg-5 col-lg-offset-2 col-sm-6\"> <img class=\"img-responsive\" src=\"/img/business3.jpg\" alt=\"\"> </div> </div> </div>");
+$templateCache.put("/partials/login.modal.html","<div> <div class=\"alert alert-warning\"> <h3>Please sign in to complete this action.</h3> </div> <div class=\"modal-footer\"> <button class=\"btn btn-primary pull-left\" ng-click=\"singInViaModal()\">Google+ SignIn</button> </div> </div>");
+$templateCache.put("/partials/profile.html","<div ng-controller=\"MyProfileCtrl\" ng-init=\"init()\"> <div class=\"row\"> <div class=\"col-lg-12\"> <div id=\"messages\" class=\"alert alert-{{alertStatus}}\" ng-show=\"messages\"> <span ng-bind=\"messages\"></span> <i class=\"dismiss-messages pull-right glyphicon glyphicon-remove\" ng-click=\"messages = ''\"\n                   ng-show=\"messages\"></i> </div> <img class=\"spinner\" src=\"/img/ajax-loader.gif\" ng-show=\"loading\"/> </div> </div> <div class=\"row\"> <div class=\"col-md-8\"> <h3>My Profile</h3> <form name=\"profileForm\" novalidate role=\"form\"> <div class=\"form-group\" ng-class=\"{'has-warning': profile.displayName != initialProfile.displayName}\"> <label for=\"displayName\">Display Name </label> <span class=\"label label-warning\"\n                          ng-show=\"profile.displayName != initialProfile.displayName\"> Changed</span> <input id=\"displayName\" type=\"text\" name=\"displayName\" ng-model=\"profile.displayName\"\n                           class=\"form-control\"/> </div> <div class=\"form-group\" ng-class=\"{'has-warning': profile.teeShirtSize != initialProfile.teeShirtSize}\"> <label for=\"teeShirtSize\">Tee shirt size</label> <span class=\"label label-warning\"\n                          ng-show=\"profile.teeShirtSize != initialProfile.teeShirtSize\"> Changed</span> <select id=\"teeShirtSize\" ng-model=\"profile.teeShirtSize\" name=\"teeShirtSize\" ng-options=\"\nshirt.size as shirt.text for shirt in teeShirtSizes\"\n                            class=\"form-control\"> </select> </div> <button ng-click=\"saveProfile(profileForm)\" class=\"btn btn-primary\"\n                        ng-disabled=\"loading\">Update profile\n                </button> </form> </div> </div> </div>");
+$templateCache.put("/partials/show_conferences.html","<div ng-controller=\"ShowConferenceCtrl\"> <div class=\"row\"> <div class=\"col-lg-12\"> <div id=\"messages\" class=\"alert alert-{{alertStatus}}\" ng-show=\"messages\"> <span ng-bind=\"messages\"></span> <i class=\"dismiss-messages pull-right glyphicon glyphicon-remove\" ng-click=\"messages = ''\"\n                   ng-show=\"messages\"></i> </div> <img class=\"spinner\" src=\"/img/ajax-loader.gif\" ng-show=\"loading\"/> </div> </div> <div class=\"row\"> <div class=\"col-lg-12\"> <h3>Show conferences</h3> </div> </div> <tabset id=\"show-conferences-tab\" justified=\"true\"> <tab select=\"tabAllSelected()\" heading=\"All\"></tab> <tab select=\"tabYouHaveCreatedSelected()\" heading=\"You've created\"></tab> <tab select=\"tabYouWillAttendSelected()\" heading=\"You'll attend (You've attended)\"></tab> </tabset> <div class=\"row row-offcanvas row-offcanvas-right\" ng-class=\"{active: isOffcanvasEnabled}\"> <div class=\"col-xs-12 col-sm-8\"> <button ng-click=\"queryConferences();\" class=\"btn btn-primary pull-right\"> <i class=\"glyphicon glyphicon-search\"></i> Search\n            </button> <p class=\"pull-right visible-xs\"> <button ng-hide=\"selectedTab != 'ALL'\" type=\"button\" class=\"btn btn-primary btn-sm\" data-toggle=\"offcanvas\"\n                        ng-click=\"isOffcanvasEnabled = !isOffcanvasEnabled\"> <i class=\"glyphicon glyphicon-chevron-left\" ng-show=\"isOffcanvasEnabled\"></i> <span ng-show=\"isOffcanvasEnabled\">Hide</span> <span ng-hide=\"isOffcanvasEnabled\">Show</span>\n                    filters\n                    <i class=\"glyphicon glyphicon-chevron-right\" ng-hide=\"isOffcanvasEnabled\"></i> </button> </p> <div ng-show=\"submitted && conferences.length == 0\"> <h4>No matching results.</h4> </div> <div class=\"table-responsive\" ng-show=\"conferences.length > 0\"> <table id=\"conference-table\" class=\"table table-striped table-hover\"> <thead> <tr> <th>Details</th> <th>Name</th> <th>City</th> <th>Start Date</th> <th>Organizer</th> <th>Registered/Open</th> </tr> </thead> <tbody> <tr ng-repeat=\"conference in conferences | startFrom: pagination.currentPage * pagination.pageSize | limitTo: pagination.pageSize\"> <td><a href=\"#/conference/detail/{{conference.websafeKey}}\">Details</a></td> <td>{{conference.name}}</td> <td>{{conference.city}}</td> <td>{{conference.startDate | date:'dd-MMMM-yyyy'}}</td> <td>{{conference.organizerDisplayName}}</td> <td>{{conference.maxAttendees - conference.seatsAvailable}} / {{conference.maxAttendees}}</td> </tr> </tbody> </table> </div> <ul class=\"pagination\" ng-show=\"conferences.length > 0\"> <li ng-class=\"{disabled: pagination.currentPage == 0 }\"> <a ng-class=\"{disabled: pagination.currentPage == 0 }\"\n                       ng-click=\"pagination.isDisabled($event) || (pagination.currentPage = 0)\">&lt&lt</a> </li> <li ng-class=\"{disabled: pagination.currentPage == 0 }\"> <a ng-class=\"{disabled: pagination.currentPage == 0 }\"\n                       ng-click=\"pagination.isDisabled($event) || (pagination.currentPage = pagination.currentPage - 1)\">&lt</a> </li> <!-- ng-repeat creates a new scope. Need to specify the pagination.currentPage as $parent.pagination.currentPage --> <li ng-repeat=\"page in pagination.pageArray()\" ng-class=\"{active: $parent.pagination.currentPage == page}\"> <a ng-click=\"$parent.pagination.currentPage = page\">{{page + 1}}</a> </li> <li ng-class=\"{disabled: pagination.currentPage == pagination.numberOfPages() - 1}\"> <a ng-class=\"{disabled: pagination.currentPage == pagination.numberOfPages() - 1}\"\n                       ng-click=\"pagination.isDisabled($event) || (pagination.currentPage = pagination.currentPage + 1)\">&gt</a> </li> <li ng-class=\"{disabled: pagination.currentPage == pagination.numberOfPages() - 1}\"> <a ng-class=\"{disabled: pagination.currentPage == pagination.numberOfPages() - 1}\"\n                       ng-click=\"pagination.isDisabled($event) || (pagination.currentPage = pagination.numberOfPages() - 1)\">&gt&gt</a> </li> </ul> </div> <div ng-hide=\"selectedTab != 'ALL'\" class=\"col-xs-6 col-sm-4 sidebar-offcanvas\" id=\"sidebar\" role=\"navigation\"> <button ng-click=\"addFilter()\" class=\"btn btn-primary\"> <i class=\"glyphicon glyphicon-plus\"></i> Filter\n            </button> <button ng-click=\"clearFilters()\" class=\"btn btn-primary\" ng-disabled=\"filters.length == 0\">Clear</button> <ul id=\"filters\" ng-repeat=\"filter in filters\"> <li> <form class=\"form-horizontal\" name=\"filterForm-$index\" novalidate role=\"form\"> <div class=\"form-group-condensed\"> <label class=\"form-control-static\">Field: </label> <select class=\"form-control-sm\" ng-model=\"filters[$index].field\"\n                                    ng-options=\"field.displayName for field in filtereableFields\"> </select> </div> <div class=\"form-group-condensed\"> <label class=\"form-control-static\">Operator: </label> <select class=\"form-control-sm\" ng-model=\"filters[$index].operator\"\n                                    ng-options=\"operator.displayName for operator in operators\"> </select> </div> <div class=\"form-roup-condensed\" ng-class=\"{'has-error': filters[$index].value.length == 0}\"> <label class=\"form-control-static\">Value: </label> <input type=\"text\" class=\"form-control-sm\" name=\"value\" ng-model=\"filters[$index].value\"\n                                   ng-required=\"true\"> <span class=\"label label-danger\"\n                                  ng-show=\"filters[$index].value.length == 0\">Required</span> </div> <div class=\"form-group-condensed\"> <button class=\"btn btn-danger btn-xs\" ng-click=\"removeFilter($index)\"><i\n                                    class=\"glyphicon glyphicon-remove\"></i></button> </div> </form> </li> </ul> </div> </div> </div>");
+}]);
+'use strict';
+ 
+var conferenceApp = conferenceApp || {};
+ 
+conferenceApp.controllers = angular.module('conferenceControllers', ['ui.bootstrap']);
+ 
+conferenceApp.controllers.controller('MyProfileCtrl',
+function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+$scope.submitted = false;
+$scope.loading = false;
+ 
+$scope.initialProfile = {};
+ 
+$scope.teeShirtSizes = [
+{'size': 'XS_M', 'text': "XS - Men's"},
+{'size': 'XS_W', 'text': "XS - Women's"},
+{'size': 'S_M', 'text': "S - Men's"},
+{'size': 'S_W', 'text': "S - Women's"},
+{'size': 'M_M', 'text': "M - Men's"},
+{'size': 'M_W', 'text': "M - Women's"},
+{'size': 'L_M', 'text': "L - Men's"},
+{'size': 'L_W', 'text': "L - Women's"},
+{'size': 'XL_M', 'text': "XL - Men's"},
+{'size': 'XL_W', 'text': "XL - Women's"},
+{'size': 'XXL_M', 'text': "XXL - Men's"},
+{'size': 'XXL_W', 'text': "XXL - Women's"},
+{'size': 'XXXL_M', 'text': "XXXL - Men's"},
+{'size': 'XXXL_W', 'text': "XXXL - Women's"}
+];
+ 
+$scope.init = function () {
+var retrieveProfileCallback = function () {
+$scope.profile = {};
+$scope.loading = true;
+gapi.client.conference.getProfile().
+execute(function (resp) {
+$scope.$apply(function () {
+$scope.loading = false;
+if (resp.error) {
+
+} else {
+
+$scope.profile.displayName = resp.result.displayName;
+$scope.profile.teeShirtSize = resp.result.teeShirtSize;
+$scope.initialProfile = resp.result;
+}
+});
+}
+);
+};
+if (!oauth2Provider.signedIn) {
+var modalInstance = oauth2Provider.showLoginModal();
+modalInstance.result.then(retrieveProfileCallback);
+} else {
+retrieveProfileCallback();
+}
+};
+ 
+$scope.saveProfile = function () {
+$scope.submitted = true;
+$scope.loading = true;
+gapi.client.conference.saveProfile($scope.profile).
+execute(function (resp) {
+$scope.$apply(function () {
+$scope.loading = false;
+if (resp.error) {
+
+var errorMessage = resp.error.message || '';
+$scope.messages = 'Failed to update a profile : ' + errorMessage;
+$scope.alertStatus = 'warning';
+$log.error($scope.messages + 'Profile : ' + JSON.stringify($scope.profile));
+if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
+oauth2Provider.showLoginModal();
+return;
+}
+} else {
+
+$scope.messages = 'The profile has been updated';
+$scope.alertStatus = 'success';
+$scope.submitted = false;
+$scope.initialProfile = {
+displayName: $scope.profile.displayName,
+teeShirtSize: $scope.profile.teeShirtSize
+};
+$log.info($scope.messages + JSON.stringify(resp.result));
+}
+});
+});
+};
+})
+;
+ 
+conferenceApp.controllers.controller('CreateConferenceCtrl',
+function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+ 
+$scope.conference = $scope.conference || {};
+ 
+$scope.cities = [
+'Chicago',
+'London',
+'Paris',
+'San Francisco',
+'Tokyo'
+];
+ 
+$scope.topics = [
+'Medical Innovations',
+'Programming Languages',
+'Web Technologies',
+'Movie Making',
+'Health and Nutrition'
+];
+ 
+$scope.isValidMaxAttendees = function () {
+if (!$scope.conference.maxAttendees || $scope.conference.maxAttendees.length == 0) {
+return true;
+}
+return /^[\d]+$/.test($scope.conference.maxAttendees) && $scope.conference.maxAttendees >= 0;
+}
+ 
+$scope.isValidDates = function () {
+if (!$scope.conference.startDate && !$scope.conference.endDate) {
+return true;
+}
+if ($scope.conference.startDate && !$scope.conference.endDate) {
+return true;
+}
+return $scope.conference.startDate <= $scope.conference.endDate;
+}
+ 
+$scope.isValidConference = function (conferenceForm) {
+return !conferenceForm.$invalid &&
+$scope.isValidMaxAttendees() &&
+$scope.isValidDates();
+}
+ 
+$scope.createConference = function (conferenceForm) {
+if (!$scope.isValidConference(conferenceForm)) {
+return;
+}
+$scope.loading = true;
+gapi.client.conference.createConference($scope.conference).
+execute(function (resp) {
+$scope.$apply(function () {
+$scope.loading = false;
+if (resp.error) {
+
+var errorMessage = resp.error.message || '';
+$scope.messages = 'Failed to create a conference : ' + errorMessage;
+$scope.alertStatus = 'warning';
+$log.error($scope.messages + ' Conference : ' + JSON.stringify($scope.conference));
+if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
+oauth2Provider.showLoginModal();
+return;
+}
+} else {
+
+$scope.messages = 'The conference has been created : ' + resp.result.name;
+$scope.alertStatus = 'success';
+$scope.submitted = false;
+$scope.conference = {};
+$log.info($scope.messages + ' : ' + JSON.stringify(resp.result));
+}
+});
+});
+};
+});
+ 
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS, bootstrapPayload) {
+ 
+$scope.submitted = false;
+$scope.selectedTab = 'ALL';
+ 
+$scope.filters = [
+];
+$scope.filtereableFields = [
+{enumValue: 'CITY', displayName: 'City'},
+{enumValue: 'TOPIC', displayName: 'Topic'},
+{enumValue: 'MONTH', displayName: 'Start month'},
+{enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'},
+{enumValue: 'START_DATE', displayName: 'Start date (YYYY-MM-DD)'},
+{enumValue: 'END_DATE', displayName: 'End date (YYYY-MM-DD)'}
+]
+ 
+$scope.operators = [
+{displayName: '=', enumValue: 'EQ'},
+{displayName: '>', enumValue: 'GT'},
+{displayName: '>=', enumValue: 'GTEQ'},
+{displayName: '<', enumValue: 'LT'},
+{displayName: '<=', enumValue: 'LTEQ'},
+{displayName: '!=', enumValue: 'NE'}
+];
+ 
+$scope.conferences = [];
+ 
+$scope.isOffcanvasEnabled = false;
+ 
+$scope.tabAllSelected = function () {
+$scope.selectedTab = 'ALL';
+$scope.queryConferences();
+};
+ 
+$scope.tabYouHaveCreatedSelected = function () {
+$scope.selectedTab = 'YOU_HAVE_CREATED';
+if (!oauth2Provider.signedIn) {
+oauth2Provider.showLoginModal();
+return;
+}
+$scope.queryConferences();
+};
+ 
+$scope.tabYouWillAttendSelected = function () {
+$scope.selectedTab = 'YOU_WILL_ATTEND';
+if (!oauth2Provider.signedIn) {
+oauth2Provider.showLoginModal();
+return;
+}
+$scope.queryConferences();
+};
+ 
+$scope.toggleOffcanvas = function () {
+$scope.isOffcanvasEnabled = !$scope.isOffcanvasEnabled;
+};
+ 
+$scope.pagination = $scope.pagination || {};
+$scope.pagination.currentPage = 0;
+$scope.pagination.pageSize = 20;
+ 
+$scope.pagination.numberOfPages = function () {
+return Math.ceil($scope.conferences.length / $scope.pagination.pageSize);
+};
+ 
+$scope.pagination.pageArray = function () {
+var pages = [];
+var numberOfPages = $scope.pagination.numberOfPages();
+for (var i = 0; i < numberOfPages; i++) {
+pages.push(i);
+}
+return pages;
+};
+ 
+$scope.pagination.isDisabled = function (event) {
+return angular.element(event.target).hasClass('disabled');
+}
+ 
+$scope.addFilter = function () {
+$scope.filters.push({
+field: $scope.filtereableFields[0],
+operator: $scope.operators[0],
+value: ''
+})
+};
+ 
+$scope.clearFilters = function () {
+$scope.filters = [];
+};
+ 
+$scope.removeFilter = function (index) {
+if ($scope.filters[index]) {
+$scope.filters.splice(index, 1);
+}
+};
+ 
+$scope.queryConferences = function () {
+$scope.submitted = false;
+if ($scope.selectedTab == 'ALL') {
+$scope.queryConferencesAll();
+} else if ($scope.selectedTab == 'YOU_HAVE_CREATED') {
+$scope.getConferencesCreated();
+} else if ($scope.selectedTab == 'YOU_WILL_ATTEND') {
+$scope.getConferencesAttend();
+}
+};
+ 
+$scope.queryConferencesAll = function () {
+var sendFilters = {
+filters: []
+}
+for (var i = 0; i < $scope.filters.length; i++) {
+var filter = $scope.filters[i];
+if (filter.field && filter.operator && filter.value) {
+sendFilters.filters.push({
+field: filter.field.enumValue,
+operator: filter.operator.enumValue,
+value: filter.value
+});
+}
+}
+var embedded = bootstrapPayload.take('conferences');
+var more = bootstrapPayload.take('moreConferences');
+var cursor = bootstrapPayload.take('nextConferenceCursor');
+var append = false;
+if (embedded && sendFilters.filters.length == 0) {
+
+$scope.conferences = embedded;
+$scope.submitted = true;
+if (!more || !cursor) {
+return;
+}
+
+sendFilters.cursor = cursor;
+append = true;
+}
+$scope.loading = true;
+gapi.client.conference.queryConferences(sendFilters).
+execute(function (resp) {
+$scope.$apply(function () {
+$scope.loading = false;
+if (resp.error) {
+
+var errorMessage = resp.error.message || '';
+$scope.messages = 'Failed to query conferences : ' + errorMessage;
+$scope.alertStatus = 'warning';
+$log.error($scope.messages + ' filters : ' + JSON.stringify(sendFilters));
+} else {
+
+$scope.submitted = false;
+$scope.messages = 'Query succeeded : ' + JSON.stringify(sendFilters);
+$scope.alertStatus = 'success';
+$log.info($scope.messages);
+if (!append) {
+$scope.conferences = [];
+}
+angular.forEach(resp.items, function (conference) {
+$scope.conferences.push(conference);
+});
+}
+$scope.submitted = true;
+});
+});
+}
+ 
+$scope.getConferencesCreated = function () {
+$scope.loading = true;
+gapi.client.conference.getConferencesCreated().
+execute(function (resp) {
+$scope.$apply(function () {
+$scope.loading = false;
+if (resp.error) {
+
+var errorMessage = resp.error.message || '';
+$scope.messages = 'Failed to query the conferences created : ' + errorMessage;
+$scope.alertStatus = 'warning';
+$log.error($scope.messages);
+if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
+oauth2Provider.showLoginModal();
+return;
+}
+} else {
+
+$scope.submitted = false;
+$scope.messages = 'Query succeeded : Conferences you have created';
+$scope.alertStatus = 'success';
+$log.info($scope.messages);
+$scope.conferences = [];
+angular.forEach(resp.items, function (conference) {
+$scope.conferences.push(conference);
+});
+}
+$scope.submitted = true;
+});
+});
+};
+ 
+$scope.getConferencesAttend = function () {
+$scope.loading = true;
+gapi.client.conference.getConferencesToAttend().
+execute(function (resp) {
+$scope.$apply(function () {
+if (resp.error) {
+
+var errorMessage = resp.error.message || '';
+$scope.messages = 'Failed to query the conferences to attend : ' + errorMessage;
+$scope.alertStatus = 'warning';
+$log.error($scope.messages);
+if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
+oauth2Provider.showLoginModal();
+return;
+}
+} else {
+
+$scope.conferences = resp.result.items;
+$scope.loading = false;
+$scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
+$scope.alertStatus = 'success';
+$log.info($scope.messages);
+}
+$scope.submitted = true;
+});
+});
+};
+});
+ 
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+$scope.conference = {};
+$scope.isUserAttending = false;
+ 
+$scope.init = function () {
+$scope.loading = true;
+gapi.client.conference.getConference({
+websafeConferenceKey: $routeParams.websafeConferenceKey
+}).execute(function (resp) {
+$scope.$apply(function () {
+$scope.loading = false;
+if (resp.error) {
+
+var errorMessage = resp.error.message || '';
+$scope.messages = 'Failed to get the conference : ' + $routeParams.websafeKey
++ ' ' + errorMessage;
+$scope.alertStatus = 'warning';
+$log.error($scope.messages);
+} else {
+
+$scope.alertStatus = 'success';
+$scope.conference = resp.result;
+}
+});
+});
+$scope.loading = true;
+
+gapi.client.conference.getProfile().execute(function (resp) {
+$scope.$apply(function () {
+$scope.loading = false;
+if (resp.error) {
+
+} else {
+var profile = resp.result;
+for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
+if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
+
+$scope.alertStatus = 'info';
+$scope.messages = 'You are attending this conference';
+$scope.isUserAttending = true;
+}
+}
+}
+});
+});
+};
+ 
+$scope.registerForConference = function () {
+$scope.loading = true;
+gapi.client.conference.registerForConference({
+websafeConferenceKey: $routeParams.websafeConferenceKey
+}).execute(function (resp) {
+$scope.$apply(function () {
+$scope.loading = false;
+if (resp.error) {
+
+var errorMessage = resp.error.message || '';
+$scope.messages = 'Failed to register for the conference : ' + errorMessage;
+$scope.alertStatus = 'warning';
+$log.error($scope.messages);
+if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
+oauth2Provider.showLoginModal();
+return;
+}
+} else {
+if (resp.result) {
+
+$scope.messages = 'Registered for the conference';
+$scope.alertStatus = 'success';
+$scope.isUserAttending = true;
+$scope.conference.seatsAvailable = $scope.conference.seatsAvailable - 1;
+} else {
+$scope.messages = 'Failed to register for the conference';
+$scope.alertStatus = 'warning';
+}
+}
+});
+});
+};
+ 
+$scope.unregisterFromConference = function () {
+$scope.loading = true;
+gapi.client.conference.unregisterFromConference({
+websafeConferenceKey: $routeParams.websafeConferenceKey
+}).execute(function (resp) {
+$scope.$apply(function () {
+$scope.loading = false;
+if (resp.error) {
+
+var errorMessage = resp.error.message || '';
+$scope.messages = 'Failed to unregister from the conference : ' + errorMessage;
+$scope.alertStatus = 'warning';
+$log.error($scope.messages);
+if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
+oauth2Provider.showLoginModal();
+return;
+}
+} else {
+if (resp.result) {
+
+$scope.messages = 'Unregistered from the conference';
+$scope.alertStatus = 'success';
+$scope.conference.seatsAvailable = $scope.conference.seatsAvailable + 1;
+$scope.isUserAttending = false;
+$log.info($scope.messages);
+} else {
+var errorMessage = resp.error.message || '';
+$scope.messages = 'Failed to unregister from the conference : ' + $routeParams.websafeKey +
+' : ' + errorMessage;
+$scope.messages = 'Failed to unregister from the conference';
+$scope.alertStatus = 'warning';
+$log.error($scope.messages);
+}
+}
+});
+});
+};
+});
+ 
+conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider, bootstrapPayload) {
+ 
+$scope.announcement = bootstrapPayload.take('announcement');
+$scope.featuredSpeaker = bootstrapPayload.take('featuredSpeaker');
+ 
+$scope.$on('$routeChangeStart', function (event, next, current) {
+if (current) {
+bootstrapPayload.expireConferences();
+}
+});
+ 
+$scope.isActive = function (viewLocation) {
+return viewLocation === $location.path();
+};
+ 
+$scope.getSignedInState = function () {
+return oauth2Provider.signedIn;
+};
+ 
+$scope.signIn = function () {
+oauth2Provider.signIn(function () {
+gapi.client.oauth2.userinfo.get().execute(function (resp) {
+$scope.$apply(function () {
+if (resp.email) {
+oauth2Provider.signedIn = true;
+$scope.alertStatus = 'success';
+$scope.rootMessages = 'Logged in with ' + resp.email;
+}
+});
+});
+});
+};
+ 
+$scope.initSignInButton = function () {
+gapi.signin.render('signInButton', {
+'callback': function () {
+jQuery('#signInButton button').attr('disabled', 'true').css('cursor', 'default');
+if (gapi.auth.getToken() && gapi.auth.getToken().access_token) {
+$scope.$apply(function () {
+oauth2Provider.signedIn = true;
+});
+}
+},
+'clientid': oauth2Provider.CLIENT_ID,
+'cookiepolicy': 'single_host_origin',
+'scope': oauth2Provider.SCOPES
+});
+};
+ 
+$scope.signOut = function () {
+oauth2Provider.signOut();
+$scope.alertStatus = 'success';
+$scope.rootMessages = 'Logged out';
+};
+ 
+$scope.collapseNavbar = function () {
+angular.element(document.querySelector('.navbar-collapse')).removeClass('in');
+};
+});
+ 
+conferenceApp.controllers.controller('OAuth2LoginModalCtrl',
+function ($scope, $modalInstance, $rootScope, oauth2Provider) {
+$scope.singInViaModal = function () {
+oauth2Provider.signIn(function () {
+gapi.client.oauth2.userinfo.get().execute(function (resp) {
+$scope.$root.$apply(function () {
+oauth2Provider.signedIn = true;
+$scope.$root.alertStatus = 'success';
+$scope.$root.rootMessages = 'Logged in with ' + resp.email;
+});
+$modalInstance.close();
+});
+});
+};
+});
+ 
+conferenceApp.controllers.controller('DatepickerCtrl', function ($scope) {
+$scope.today = function () {
+$scope.dt = new Date();
+};
+$scope.today();
+$scope.clear = function () {
+$scope.dt = null;
+};
+
+$scope.disabled = function (date, mode) {
+return ( mode === 'day' && ( date.getDay() === 0 || date.getDay() === 6 ) );
+};
+$scope.toggleMin = function () {
+$scope.minDate = ( $scope.minDate ) ? null : new Date();
+};
+$scope.toggleMin();
+$scope.open = function ($event) {
+$event.preventDefault();
+$event.stopPropagation();
+$scope.opened = true;
+};
+$scope.dateOptions = {
+'year-format': "'yy'",
+'starting-day': 1
+};
+$scope.formats = ['dd-MMMM-yyyy', 'yyyy/MM/dd', 'shortDate'];
+$scope.format = $scope.formats[0];
+});
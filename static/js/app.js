@@ -76,6 +76,44 @@ app.constant('HTTP_ERRORS', {
 });
 
 
+/**
+ * @ngdoc service
+ * @name bootstrapPayload
+ *
+ * @description
+ * Data the server embeds in the page as window.CONFERENCE_BOOTSTRAP (see homepage.py): the announcement,
+ * the featured speakers and the first page of conferences. Each entry is handed out once, so the first
+ * screen is drawn without an API call and later reads go to the API.
+ *
+ */
+app.factory('bootstrapPayload', function () {
+    var payload = window.CONFERENCE_BOOTSTRAP || {};
+
+    return {
+        /**
+         * Returns the embedded value for name, or undefined if it is absent or was already taken.
+         *
+         * @param name
+         * @returns {*}
+         */
+        take: function (name) {
+            var value = payload[name];
+            delete payload[name];
+            return value;
+        },
+
+        /**
+         * Drops the embedded conference list, which is only as fresh as the page load.
+         */
+        expireConferences: function () {
+            delete payload.conferences;
+            delete payload.moreConferences;
+            delete payload.nextConferenceCursor;
+        }
+    };
+});
+
+
 /**
  * @ngdoc service
  * @name oauth2Provider
@@ -249,7 +249,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS, bootstrapPayload) {
 
     /**
      * Holds the status if the query is being executed.
@@ -270,7 +270,9 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         {enumValue: 'CITY', displayName: 'City'},
         {enumValue: 'TOPIC', displayName: 'Topic'},
         {enumValue: 'MONTH', displayName: 'Start month'},
-        {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'}
+        {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'},
+        {enumValue: 'START_DATE', displayName: 'Start date (YYYY-MM-DD)'},
+        {enumValue: 'END_DATE', displayName: 'End date (YYYY-MM-DD)'}
     ]
 
     /**
@@ -440,6 +442,21 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
+        var embedded = bootstrapPayload.take('conferences');
+        var more = bootstrapPayload.take('moreConferences');
+        var cursor = bootstrapPayload.take('nextConferenceCursor');
+        var append = false;
+        if (embedded && sendFilters.filters.length == 0) {
+            // The server embedded the first page; show it without an API round trip.
+            $scope.conferences = embedded;
+            $scope.submitted = true;
+            if (!more || !cursor) {
+                return;
+            }
+            // Fetch only the conferences after the first page.
+            sendFilters.cursor = cursor;
+            append = true;
+        }
         $scope.loading = true;
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
@@ -458,7 +475,9 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
+                        if (!append) {
+                            $scope.conferences = [];
+                        }
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
@@ -691,7 +710,23 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
  * such as user authentications.
  *
  */
-conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider) {
+conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider, bootstrapPayload) {
+
+    /**
+     * The announcement and featured speakers embedded in the page by the server.
+     */
+    $scope.announcement = bootstrapPayload.take('announcement');
+    $scope.featuredSpeaker = bootstrapPayload.take('featuredSpeaker');
+
+    /**
+     * The embedded conferences are only used by the first view; after navigating, the user may have
+     * changed them (e.g. registered), so the next list comes from the API.
+     */
+    $scope.$on('$routeChangeStart', function (event, next, current) {
+        if (current) {
+            bootstrapPayload.expireConferences();
+        }
+    });
 
     /**
      * Returns if the viewLocation is the currently viewed page.
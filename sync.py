@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""sync.py
+
+Delta sync for mobile clients.
+
+A client keeps everything in its sync scope: its Profile, the
+conferences it attends with their sessions, its wishlist sessions and
+the speakers of those sessions. A sync token records when the client
+last synced. ConferenceApi.sync returns only what changed after that:
+
+- entities whose `updated` stamp is newer than the token;
+- everything under a conference or session that entered the scope
+  (registration, waitlist admission, wishlist add), whatever its stamp;
+- removals: keys that left the scope and deleted entities (SyncChange).
+  A removed conference takes its sessions with it on the client, except
+  the ones still in the wishlist.
+
+Changed speakers and deletions are found app-wide, then kept only if
+they are in the scope: a conference or session attended or wished for,
+a speaker named by such a session.
+
+Large answers are paged. Every token but the last carries the position
+reached, so reads scale with the number of changes, not the data size.
+
+"""
+
+import base64
+import datetime
+import json
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Session
+from models import Speaker
+from models import SyncChange
+from settings import SYNC_PAGE_SIZE
+from settings import SYNC_RETENTION_DAYS
+
+# a new token overlaps the previous sync by this much, so a write whose
+# `updated` stamp was taken just before the sync started, but which
+# committed after it ran, is still picked up
+CLOCK_SKEW = datetime.timedelta(seconds=5)
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# sync phases, in order
+PHASE_CONFERENCES, PHASE_SESSIONS, PHASE_WISHLIST, PHASE_SPEAKERS, \
+    PHASE_DELETED = range(5)
+
+
+def scopeChange(profile_key, key, removed=False):
+    """Return the SyncChange recording key entering or leaving a scope.
+
+    It is a child of the Profile, so callers can put it in the same
+    transaction as the Profile update.
+    """
+    return SyncChange(parent=profile_key, userId=profile_key.id(),
+                      entityKind=key.kind(), websafeKey=key.urlsafe(),
+                      removed=removed)
+
+
+def _micros(dt):
+    return int((dt - _EPOCH).total_seconds() * 1000000)
+
+
+def _datetime(micros):
+    return _EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def encodeToken(state):
+    return base64.urlsafe_b64encode(json.dumps(state, sort_keys=True))
+
+
+def decodeToken(token):
+    """Return the token's state dict; ValueError if it is malformed."""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(str(token)))
+        if state['s'] is not None:
+            int(state['s'])
+        return state
+    except (TypeError, ValueError, KeyError):
+        raise ValueError('Invalid sync token: %s' % token)
+
+
+def _changedSince(entity, since):
+    # an entity without a stamp counts as written at the epoch: a full
+    # sync sends it, later syncs do not keep resending it
+    return since is None or (entity.updated or _EPOCH) > since
+
+
+def _referencedSpeakers(emails, attending_set, wished):
+    """Return the emails that a session in the scope names as speaker."""
+    futures = [(email, Session.query(Session.speaker == email).fetch_async(
+        keys_only=True)) for email in set(emails)]
+    referenced = set()
+    for email, future in futures:
+        if any(s_key.urlsafe() in wished or
+               s_key.parent().urlsafe() in attending_set
+               for s_key in future.get_result()):
+            referenced.add(email)
+    return referenced
+
+
+def collectChanges(prof, token=None, now=None):
+    """Return one page of changes for the Profile since token.
+
+    Returns a dict with profile (None if unchanged), conferences,
+    sessions, speakers, removed [(kind, websafeKey)], token, more and
+    reset.
+    """
+    now = now or datetime.datetime.utcnow()
+    reset = False
+    state = decodeToken(token) if token else {'s': None}
+    if 'p' not in state:
+        # a new sync: it covers changes up to now
+        state['u'] = _micros(now)
+    since = _datetime(state['s']) if state['s'] is not None else None
+    until = _datetime(state['u'])
+    if since is not None and \
+            since < now - datetime.timedelta(days=SYNC_RETENTION_DAYS):
+        # removals this old have been purged; start over
+        reset, since = True, None
+        state = {'s': None, 'u': _micros(now)}
+    phase = state.get('p', PHASE_CONFERENCES)
+
+    attending = sorted(prof.conferenceKeysToAttend)
+    attending_set, wished = set(attending), set(prof.wishlist)
+
+    def inScope(kind, websafe_key):
+        if kind == 'Conference':
+            return websafe_key in attending_set
+        return websafe_key in wished or \
+            ndb.Key(urlsafe=websafe_key).parent().urlsafe() in attending_set
+
+    # what entered or left the scope since the token; small and per user
+    added, removed = set(), set()
+    if since is not None:
+        for change in SyncChange.query(SyncChange.changedAt > since,
+                                       ancestor=prof.key):
+            if change.userId != prof.key.id():
+                # a tombstone under one of the user's own conferences
+                continue
+            if not change.removed:
+                added.add(change.websafeKey)
+            elif not inScope(change.entityKind, change.websafeKey):
+                removed.add((change.entityKind, change.websafeKey))
+
+    result = {'profile': None, 'conferences': [], 'sessions': [],
+              'speakers': [], 'removed': [], 'more': False, 'reset': reset}
+    budget = SYNC_PAGE_SIZE
+
+    if phase == PHASE_CONFERENCES:
+        if _changedSince(prof, since):
+            result['profile'] = prof
+        confs = ndb.get_multi([ndb.Key(urlsafe=wsck) for wsck in attending])
+        result['conferences'] = [
+            conf for conf in confs if conf and (
+                _changedSince(conf, since) or conf.key.urlsafe() in added)]
+        result['removed'] = sorted(removed)
+        phase, state['i'], state['c'] = PHASE_SESSIONS, 0, None
+
+    if phase == PHASE_SESSIONS:
+        i, cursor = state.get('i', 0), state.get('c')
+        while i < len(attending) and budget > 0:
+            c_key = ndb.Key(urlsafe=attending[i])
+            q = Session.query(ancestor=c_key)
+            if since is not None and attending[i] not in added:
+                q = q.filter(Session.updated > since)
+            sessions, next_cursor, more = q.fetch_page(
+                budget, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+            result['sessions'] += sessions
+            budget -= len(sessions)
+            if more and next_cursor:
+                cursor = next_cursor.urlsafe()
+            else:
+                i, cursor = i + 1, None
+        state['i'], state['c'] = i, cursor
+        if i >= len(attending):
+            phase = PHASE_WISHLIST
+
+    if phase == PHASE_WISHLIST and budget > 0:
+        # wishlist sessions outside the attended conferences were not
+        # covered by the ancestor queries above; every key read takes
+        # from the page budget, like a query result would
+        keys = [ndb.Key(urlsafe=wssk) for wssk in sorted(prof.wishlist)
+                if ndb.Key(urlsafe=wssk).parent().urlsafe() not in attending_set]
+        w = state.get('w', 0)
+        while w < len(keys) and budget > 0:
+            batch = keys[w:w + budget]
+            result['sessions'] += [
+                session for session in ndb.get_multi(batch) if session and (
+                    _changedSince(session, since) or
+                    session.key.urlsafe() in added)]
+            budget -= len(batch)
+            w += len(batch)
+        state['w'] = w
+        if w >= len(keys):
+            phase, state['c'] = PHASE_SPEAKERS, None
+            state.pop('w', None)
+
+    if phase in (PHASE_SPEAKERS, PHASE_DELETED) and budget > 0:
+        if since is None:
+            # a full sync only needs the speakers of the sessions sent
+            phase = PHASE_DELETED + 1
+        else:
+            kind_query = {
+                PHASE_SPEAKERS: Speaker.query(Speaker.updated > since),
+                PHASE_DELETED: SyncChange.query(SyncChange.userId == '*',
+                                                SyncChange.changedAt > since),
+            }
+            while phase <= PHASE_DELETED and budget > 0:
+                cursor = state.get('c')
+                entities, next_cursor, more = kind_query[phase].fetch_page(
+                    budget,
+                    start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+                budget -= len(entities)
+                if phase == PHASE_SPEAKERS:
+                    referenced = _referencedSpeakers(
+                        [speaker.key.id() for speaker in entities],
+                        attending_set, wished)
+                    result['speakers'] += [speaker for speaker in entities
+                                           if speaker.key.id() in referenced]
+                else:
+                    emails = [ndb.Key(urlsafe=c.websafeKey).id()
+                              for c in entities if c.entityKind == 'Speaker']
+                    referenced = _referencedSpeakers(emails, attending_set,
+                                                     wished)
+                    for c in entities:
+                        if c.entityKind == 'Speaker':
+                            kept = ndb.Key(urlsafe=c.websafeKey).id() in \
+                                referenced
+                        else:
+                            kept = c.entityKind in ('Conference', 'Session') \
+                                and inScope(c.entityKind, c.websafeKey)
+                        if kept:
+                            result['removed'].append(
+                                (c.entityKind, c.websafeKey))
+                if more and next_cursor:
+                    state['c'] = next_cursor.urlsafe()
+                else:
+                    phase, state['c'] = phase + 1, None
+
+    # speakers of the sessions in this page, unless already included
+    sent = set(speaker.key for speaker in result['speakers'])
+    speaker_keys = set(ndb.Key(Speaker, s.speaker)
+                       for s in result['sessions'] if s.speaker) - sent
+    result['speakers'] += [speaker for speaker in ndb.get_multi(
+        list(speaker_keys)) if speaker]
+
+    if phase > PHASE_DELETED:
+        # done: the next sync starts where this one started
+        result['token'] = encodeToken({'s': _micros(until - CLOCK_SKEW)})
+    else:
+        state['p'] = phase
+        result['token'] = encodeToken(state)
+        result['more'] = True
+    return result
+
+
+def purgeSyncChanges(batch=500):
+    """Delete SyncChanges older than the token retention period."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        days=SYNC_RETENTION_DAYS)
+    removed = 0
+    while True:
+        keys = SyncChange.query(
+            SyncChange.changedAt < cutoff).fetch(batch, keys_only=True)
+        if not keys:
+            return removed
+        ndb.delete_multi(keys)
+        removed += len(keys)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""test_waitlist.py -- registration waitlist on the SDK testbed stubs
+
+Run from the repository root with the SDK on PYTHONPATH, as for
+tools/bench_async.py:
+
+    PYTHONPATH=$SDK:$SDK/lib/endpoints-1.0:$SDK/lib/protorpc-1.0:. \\
+        python -m unittest discover -s tests
+
+"""
+
+import os
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+
+ORGANIZER = 'organizer@example.com'
+FIRST = 'first@example.com'
+SECOND = 'second@example.com'
+
+
+class WaitlistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # xg transactions need the high replication stub
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+        import conference
+        from models import Conference, Profile
+        self.conference = conference
+        self.api = conference.ConferenceApi()
+        p_key = ndb.Key(Profile, ORGANIZER)
+        Profile(key=p_key, displayName='organizer', mainEmail=ORGANIZER).put()
+        self.c_key = Conference(parent=p_key, name='Small',
+                                organizerUserId=ORGANIZER, maxAttendees=1,
+                                seatsAvailable=1).put()
+        self.wsck = self.c_key.urlsafe()
+
+    def tearDown(self):
+        for name in ('ENDPOINTS_AUTH_EMAIL', 'ENDPOINTS_AUTH_DOMAIN'):
+            os.environ.pop(name, None)
+        self.testbed.deactivate()
+
+    def _as(self, email):
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
+
+    def _request(self):
+        return self.conference.CONF_REGISTER_REQUEST.combined_message_class(
+            websafeConferenceKey=self.wsck)
+
+    def _waitlistTasks(self):
+        return [task for task in self.taskqueue.get_filtered_tasks()
+                if task.url == '/tasks/process_waitlist']
+
+    def _waiting(self):
+        from models import WaitlistEntry
+        return [key.id() for key in WaitlistEntry.query(
+            ancestor=self.c_key).fetch(keys_only=True)]
+
+    def testSoldOutWaiterIsAdmittedWhenSeatFrees(self):
+        from errors import ConflictException
+        from models import Profile
+        from waitlist import processWaitlist
+
+        self._as(FIRST)
+        self.assertTrue(self.api.registerForConference(self._request()).data)
+
+        # a first-time caller finds the conference sold out
+        self._as(SECOND)
+        self.assertRaises(ConflictException,
+                          self.api.registerForConference, self._request())
+        self.assertIsNotNone(ndb.Key(Profile, SECOND).get())
+        self.assertEqual(self._waiting(), [SECOND])
+        self.assertTrue(self._waitlistTasks())
+
+        # no seat yet: the waiter stays queued
+        processWaitlist(self.wsck)
+        self.assertEqual(self._waiting(), [SECOND])
+
+        self._as(FIRST)
+        self.taskqueue.FlushQueue('default')
+        self.assertTrue(
+            self.api.unregisterFromConference(self._request()).data)
+        self.assertTrue(self._waitlistTasks())
+
+        processWaitlist(self.wsck)
+        self.assertEqual(self._waiting(), [])
+        self.assertIn(self.wsck,
+                      ndb.Key(Profile, SECOND).get().conferenceKeysToAttend)
+        self.assertEqual(self.c_key.get().seatsAvailable, 0)
+
+    def testWaiterWithoutProfileIsAdmitted(self):
+        from models import Profile
+        from waitlist import joinWaitlist
+        from waitlist import processWaitlist
+
+        joinWaitlist(self.c_key, SECOND)
+        processWaitlist(self.wsck)
+        self.assertEqual(self._waiting(), [])
+        prof = ndb.Key(Profile, SECOND).get()
+        self.assertEqual(prof.conferenceKeysToAttend, [self.wsck])
+        self.assertEqual(prof.mainEmail, SECOND)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+bench_async.py -- compare end-to-end latency of the tasklet based
+    multi-RPC paths in conference.py against their old sequential form
+
+Runs against the App Engine SDK testbed stubs; the SDK must be on
+PYTHONPATH, e.g.
+
+    PYTHONPATH=$SDK:$SDK/lib/endpoints-1.0:$SDK/lib/protorpc-1.0:. \\
+        python tools/bench_async.py --rpc-delay 20
+
+The in-memory datastore stub answers instantly, so --rpc-delay (ms) is
+added to every datastore RPC to model production round-trip latency.
+
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+USER_EMAIL = 'bench@example.com'
+
+
+def setUp(rpc_delay):
+    """Activate testbed stubs and fake an authenticated Endpoints user."""
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__),
+                                                  os.pardir))
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = USER_EMAIL
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().set_memcache_policy(False)
+
+    if rpc_delay:
+        def delay(service, call, request, response, rpc):
+            if service == 'datastore_v3':
+                time.sleep(rpc_delay / 1000.0)
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench_delay', delay)
+    return tb
+
+
+def timeit(fn, runs):
+    """Return mean wall time of fn() in milliseconds."""
+    start = time.time()
+    for _ in range(runs):
+        fn()
+    return (time.time() - start) * 1000.0 / runs
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--runs', type='int', default=50)
+    parser.add_option('--rpc-delay', type='float', default=20.0)
+    opts, _ = parser.parse_args()
+
+    tb = setUp(opts.rpc_delay)
+    import conference
+    from models import Conference, Profile, Session, Speaker
+
+    api = conference.ConferenceApi()
+    p_key = ndb.Key(Profile, USER_EMAIL)
+    Profile(key=p_key, displayName='bench', mainEmail=USER_EMAIL).put()
+    c_key = Conference(parent=p_key, name='Bench', organizerUserId=USER_EMAIL).put()
+    Profile(key=p_key, displayName='bench', mainEmail=USER_EMAIL,
+            conferenceKeysToAttend=[c_key.urlsafe()]).put()
+    Speaker(id='speaker@example.com', name='Speaker',
+            email='speaker@example.com').put()
+    s_key = Session(parent=c_key, name='Seed', speaker='speaker@example.com').put()
+
+    conf_req = conference.CONF_GET_REQUEST.combined_message_class(
+        websafeConferenceKey=c_key.urlsafe())
+    sess_req = conference.SESSION_CREATE_REQUEST.combined_message_class(
+        websafeConferenceKey=c_key.urlsafe(), name='Talk',
+        speaker='speaker@example.com')
+    wish_req = conference.SES_REQUEST.combined_message_class(
+        sessionKey=s_key.urlsafe())
+
+    def sequentialGetConference():
+        conf = c_key.get()
+        conf.key.parent().get()
+
+    def sequentialCreateSession():
+        c_key.get()
+        ndb.Key(Speaker, 'speaker@example.com').get()
+        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
+        key = Session(key=ndb.Key(Session, s_id, parent=c_key), name='Talk').put()
+        key.get()
+
+    def sequentialWishlist():
+        # add then remove, matching the tasklet row below
+        for _ in range(2):
+            prof = p_key.get()
+            s_key.get()
+            prof.put()
+
+    rows = [
+        ('getConference', sequentialGetConference,
+         lambda: api._getConferenceAsync(conf_req).get_result()),
+        ('createSession', sequentialCreateSession,
+         lambda: api._createSessionObjectAsync(sess_req).get_result()),
+        ('wishlist add/remove', sequentialWishlist,
+         lambda: (api._wishlistHandleAsync(wish_req).get_result(),
+                  api._wishlistHandleAsync(wish_req, add=False).get_result())),
+    ]
+    print('%-22s %12s %12s' % ('path', 'sequential', 'tasklet'))
+    for name, before, after in rows:
+        print('%-22s %10.1fms %10.1fms' % (
+            name, timeit(before, opts.runs), timeit(after, opts.runs)))
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
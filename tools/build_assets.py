@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+build_assets.py -- bundle, minify and fingerprint the web client's
+    static assets
+
+Concatenates and minifies the local stylesheets and scripts that
+templates/index.html loads, inlines static/partials/*.html into
+Angular's $templateCache, and writes content-hashed bundles to
+static/dist/. It then writes templates/index.dist.html pointing at the
+bundles, which homepage.py serves, and regenerates the marked block of
+app.yaml that serves the bundles with far-future expiration.
+
+Run it before every deploy, from the repository root:
+
+    python tools/build_assets.py
+
+"""
+
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+DIST_DIR = os.path.join(ROOT, 'static', 'dist')
+INDEX_SRC = os.path.join(ROOT, 'templates', 'index.html')
+INDEX_DIST = os.path.join(ROOT, 'templates', 'index.dist.html')
+APP_YAML = os.path.join(ROOT, 'app.yaml')
+
+# URL prefix -> directory, as mapped by the static handlers in app.yaml
+URL_DIRS = {
+    '/css/': os.path.join(ROOT, 'static', 'bootstrap', 'css'),
+    '/js/': os.path.join(ROOT, 'static', 'js'),
+}
+PARTIALS = os.path.join(ROOT, 'static', 'partials', '*.html')
+ANGULAR_MODULE = 'conferenceApp'
+
+BEGIN_MARK = '# BEGIN generated by tools/build_assets.py'
+END_MARK = '# END generated by tools/build_assets.py'
+APP_YAML_BLOCK = '''%s
+- url: /dist
+  static_dir: static/dist
+  expiration: "365d"
+  http_headers:
+    Cache-Control: public, max-age=31536000, immutable
+%s''' % (BEGIN_MARK, END_MARK)
+
+_CSS_LINK = re.compile(r'[ \t]*<link rel="stylesheet" href="(/css/[^"]+)">\n')
+_JS_TAG = re.compile(r'[ \t]*<script src="(/js/[^"]+)"></script>\n')
+
+
+def read(path):
+    with io.open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def write(path, text):
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def _strings_and_code(source, regex_allowed=False):
+    """Yield (is_code, text) chunks, keeping strings, regexes and code
+    apart and dropping comments."""
+    i, n, start = 0, len(source), 0
+    last_significant = ''
+    while i < n:
+        c = source[i]
+        if c in '"\'' or (c == '/' and regex_allowed and i + 1 < n and
+                          source[i + 1] not in '/*' and
+                          (last_significant in '(,=:[!&|?{};+-*%<>~^' or
+                           source[start:i].rstrip().endswith('return'))):
+            if i > start:
+                yield True, source[start:i]
+            end, in_class = i + 1, False
+            while end < n and (in_class or source[end] != c):
+                if source[end] == '\\':
+                    end += 2
+                    continue
+                if c == '/' and source[end] in '[]':
+                    # a regex character class may contain an unescaped /
+                    in_class = source[end] == '['
+                end += 1
+            yield False, source[i:end + 1]
+            i = start = end + 1
+            last_significant = c
+        elif source.startswith('/*', i):
+            if i > start:
+                yield True, source[start:i]
+            i = source.find('*/', i + 2)
+            i = n if i < 0 else i + 2
+            start = i
+            yield True, ' '
+        elif source.startswith('//', i) and regex_allowed:
+            if i > start:
+                yield True, source[start:i]
+            i = source.find('\n', i)
+            i = n if i < 0 else i
+            start = i
+        else:
+            if not c.isspace():
+                last_significant = c
+            i += 1
+    if start < n:
+        yield True, source[start:]
+
+
+def minifyCss(source):
+    out = []
+    for is_code, text in _strings_and_code(source):
+        if is_code:
+            text = re.sub(r'\s+', ' ', text)
+            text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+            # only after the colon: a space before it is a descendant
+            # combinator in selectors such as "div :first-child"
+            text = re.sub(r':\s+', ':', text)
+            text = text.replace(';}', '}')
+        out.append(text)
+    return ''.join(out).strip()
+
+
+def minifyJs(source):
+    """Drop comments and indentation; line breaks are kept so automatic
+    semicolon insertion behaves exactly as in the source."""
+    out = []
+    for is_code, text in _strings_and_code(source, regex_allowed=True):
+        if is_code:
+            text = re.sub(r'[ \t]+', ' ', text)
+            text = re.sub(r' ?\n[\s]*', '\n', text)
+        out.append(text)
+    return ''.join(out).strip() + '\n'
+
+
+def templateCacheJs(partials):
+    """Return a script putting the partials into $templateCache."""
+    puts = ''.join(
+        "$templateCache.put(%s,%s);\n" % (json.dumps(url), json.dumps(html))
+        for url, html in sorted(partials.items()))
+    return ("angular.module(%s).run(['$templateCache',function($templateCache){\n"
+            "%s}]);\n" % (json.dumps(ANGULAR_MODULE), puts))
+
+
+def _localPath(url):
+    for prefix, directory in URL_DIRS.items():
+        if url.startswith(prefix):
+            return os.path.join(directory, url[len(prefix):])
+    raise ValueError('No static directory for %s' % url)
+
+
+def fingerprinted(name, ext, content):
+    digest = hashlib.md5(content.encode('utf-8')).hexdigest()[:10]
+    return '%s.%s.%s' % (name, digest, ext)
+
+
+def rewriteIndex(index, css_name, js_name):
+    """Replace the local tags with one tag per bundle, placed where the
+    first tag of its kind was."""
+    def replaceFirst(pattern, text, tag):
+        count = [0]
+
+        def sub(match):
+            count[0] += 1
+            if count[0] > 1:
+                return ''
+            indent = match.group(0)[:len(match.group(0)) -
+                                    len(match.group(0).lstrip())]
+            return indent + tag + '\n'
+        return pattern.sub(sub, text)
+
+    index = replaceFirst(_CSS_LINK, index,
+                         '<link rel="stylesheet" href="/dist/%s">' % css_name)
+    return replaceFirst(_JS_TAG, index,
+                        '<script src="/dist/%s"></script>' % js_name)
+
+
+def build():
+    index = read(INDEX_SRC)
+    css_urls = _CSS_LINK.findall(index)
+    js_urls = _JS_TAG.findall(index)
+
+    css = '\n'.join(minifyCss(read(_localPath(url))) for url in css_urls)
+    # @import is only valid at the top of a stylesheet
+    imports = re.findall(r'@import[^;]+;', css)
+    css = ''.join(imports) + re.sub(r'@import[^;]+;', '', css).lstrip()
+
+    partials = dict(
+        ('/partials/' + os.path.basename(path),
+         re.sub(r'>\s+<', '> <', read(path).strip()))
+        for path in glob.glob(PARTIALS))
+    scripts = [minifyJs(read(_localPath(url))) for url in js_urls]
+    # the module has to exist before templates are registered on it
+    js = scripts[0] + templateCacheJs(partials) + ''.join(scripts[1:])
+
+    for old in glob.glob(os.path.join(DIST_DIR, 'app.*')):
+        os.remove(old)
+    if not os.path.isdir(DIST_DIR):
+        os.makedirs(DIST_DIR)
+    css_name = fingerprinted('app', 'css', css)
+    js_name = fingerprinted('app', 'js', js)
+    write(os.path.join(DIST_DIR, css_name), css)
+    write(os.path.join(DIST_DIR, js_name), js)
+
+    write(INDEX_DIST, rewriteIndex(index, css_name, js_name))
+
+    app_yaml = read(APP_YAML)
+    block = re.compile(re.escape(BEGIN_MARK) + '.*?' + re.escape(END_MARK),
+                       re.S)
+    if not block.search(app_yaml):
+        sys.exit('app.yaml has no %r block' % BEGIN_MARK)
+    write(APP_YAML, block.sub(lambda _: APP_YAML_BLOCK, app_yaml))
+
+    sources = sum(os.path.getsize(_localPath(url)) for url in css_urls + js_urls)
+    sources += sum(os.path.getsize(path) for path in glob.glob(PARTIALS))
+    print('%s  %d bytes' % (css_name, len(css.encode('utf-8'))))
+    print('%s  %d bytes' % (js_name, len(js.encode('utf-8'))))
+    print('%d files (%d bytes) -> 2 bundles' % (
+        len(css_urls) + len(js_urls) + len(partials), sources))
+
+
+if __name__ == '__main__':
+    build()
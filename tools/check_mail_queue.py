@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+check_mail_queue.py -- exercise the confirmation email pull queue
+    against the testbed mail and taskqueue stubs
+
+    PYTHONPATH=$SDK:$SDK/lib/endpoints-1.0:$SDK/lib/protorpc-1.0:. \\
+        python tools/check_mail_queue.py --conferences 250
+
+Creates conferences through ConferenceApi, checks that exactly one pull
+task was queued per committed create (and none for a rolled back one),
+then drains the queue with processConfirmationEmails() and checks that
+the mail stub received one compact message per conference.
+
+"""
+
+import optparse
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, ROOT)
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--conferences', type='int', default=250)
+    opts, _ = parser.parse_args()
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_app_identity_stub()
+    tb.init_mail_stub()
+    tb.init_taskqueue_stub(root_path=ROOT)
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = 'organizer@example.com'
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
+
+    import conference
+    import mailqueue
+    from models import ConferenceForm
+    from settings import MAIL_QUEUE_NAME
+
+    api = conference.ConferenceApi()
+    taskqueue_stub = tb.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    mail_stub = tb.get_stub(testbed.MAIL_SERVICE_NAME)
+
+    for i in range(opts.conferences):
+        api._createConferenceObject(ConferenceForm(
+            name='Conference %d' % i, city='London', topics=['Web'],
+            startDate='2030-01-01', endDate='2030-01-02', maxAttendees=10))
+
+    # a create whose transaction rolls back must not queue an email
+    original_put = ndb.Model.put
+    def failing_put(self, **kwargs):
+        raise RuntimeError('simulated datastore failure')
+    ndb.Model.put = failing_put
+    try:
+        api._createConferenceObject(ConferenceForm(name='Doomed'))
+    except RuntimeError:
+        pass
+    finally:
+        ndb.Model.put = original_put
+
+    queued = len(taskqueue_stub.get_filtered_tasks(queue_names=MAIL_QUEUE_NAME))
+    assert queued == opts.conferences, (queued, opts.conferences)
+
+    stats = mailqueue.processConfirmationEmails(sleep=lambda secs: None)
+    messages = mail_stub.get_sent_messages()
+    assert stats['sent'] == opts.conferences, stats
+    assert len(messages) == opts.conferences, len(messages)
+    assert 'Conference 0' in messages[0].body.decode()
+    assert not taskqueue_stub.get_filtered_tasks(queue_names=MAIL_QUEUE_NAME)
+
+    print('queued %d, sent %d, largest body %d bytes' % (
+        queued, len(messages),
+        max(len(m.body.decode()) for m in messages)))
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+measure_startup.py -- time how long a fresh interpreter takes to import
+    each WSGI entry point and the modules it pulls in
+
+Every sample runs in a new subprocess, so nothing is already cached in
+sys.modules. The SDK must be on PYTHONPATH, e.g.
+
+    PYTHONPATH=$SDK:$SDK/lib/endpoints-1.0:$SDK/lib/protorpc-1.0:\\
+$SDK/lib/webapp2-2.5.2:$SDK/lib/yaml-3.10:. \\
+        python tools/measure_startup.py --runs 5
+
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# entry point -> what it has to import before serving its first request
+TARGETS = [
+    ('main', 'main.app (cron and task handlers)'),
+    ('conference', 'conference.api (Endpoints API)'),
+    ('announcements', 'announcements'),
+    ('models', 'models'),
+]
+
+_PROBE = '''
+import sys, time
+start = time.time()
+__import__(%r)
+elapsed = time.time() - start
+heavy = [m for m in ('endpoints', 'numpy', 'yaml', 'conference')
+         if m in sys.modules]
+print('%%f %%d %%s' %% (elapsed, len(sys.modules), ','.join(heavy)))
+'''
+
+
+def sample(module):
+    """Import module in a new interpreter; return (secs, modules, heavy)."""
+    out = subprocess.check_output([sys.executable, '-c', _PROBE % module],
+                                  cwd=ROOT)
+    elapsed, count, heavy = (out.strip().split(' ') + [''])[:3]
+    return float(elapsed), int(count), heavy
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--runs', type='int', default=5)
+    opts, _ = parser.parse_args()
+
+    print('%-36s %10s %10s %8s  %s' % ('module', 'median', 'min',
+                                       'modules', 'heavy imports'))
+    for module, label in TARGETS:
+        samples = sorted(sample(module) for _ in range(opts.runs))
+        median = samples[len(samples) // 2]
+        print('%-36s %8.1fms %8.1fms %8d  %s' % (
+            label, median[0] * 1000, samples[0][0] * 1000, median[1],
+            median[2] or '-'))
+
+
+if __name__ == '__main__':
+    main()
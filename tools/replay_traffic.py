@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""
+replay_traffic.py -- replay captured Endpoints traffic and report
+    throughput, latency percentiles and error rates
+
+Reads the JSON lines exported by /admin/traffic_capture (see
+trafficcapture.py) and sends every call to ConferenceApi. Calls keep
+their captured spacing, divided by --speedup (0 sends them back to
+back), and up to --concurrency of them run at once.
+
+Targets:
+  --target testbed    ConferenceApi in process on the SDK testbed stubs,
+                      seeded with --conferences synthetic conferences.
+                      The SDK must be on PYTHONPATH, as for
+                      bench_async.py.
+  --target URL        a dev server's Endpoints backend, e.g.
+                      http://localhost:8080; --bearer is sent as the
+                      Authorization token.
+
+Reference tokens in the log ("@Conference:1a2b3c4d") are mapped onto
+entities found on the target, and a token always maps onto the same
+entity, so hot keys stay hot.
+
+    curl -o traffic.jsonl 'https://<app>/admin/traffic_capture'
+    python tools/replay_traffic.py traffic.jsonl --speedup 10 \\
+        --concurrency 8
+
+"""
+
+import datetime
+import json
+import optparse
+import os
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+# entities discovered per kind for mapping reference tokens
+POOL_LIMIT = 500
+SESSIONS_PER_CONFERENCE = 5
+CITIES = ['London', 'Chicago', 'Tokyo', 'Paris', 'San Francisco']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition']
+SESSION_TYPES = ['LECTURE', 'KEYNOTE', 'WORKSHOP', 'NOT_SPECIFIED']
+
+
+def loadRecords(path, limit=None):
+    """Return the captured records, ordered by start time."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    records.sort(key=lambda record: record['t'])
+    return records[:limit] if limit else records
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+class Resolver(object):
+    """Maps reference tokens in captured bodies onto target entities."""
+
+    def __init__(self, pools, run_id):
+        self.pools = pools
+        self.run_id = run_id
+
+    def resolve(self, value):
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        if isinstance(value, dict):
+            return dict((name, self.resolve(item))
+                        for name, item in value.items())
+        if not isinstance(value, basestring) or not value.startswith('@'):
+            return value
+        kind, _, digest = value[1:].partition(':')
+        if kind == 'req':
+            # a retry in the capture is a retry here; other runs differ
+            return '%s-%s' % (self.run_id, digest)
+        pool = self.pools.get(kind)
+        if not pool:
+            return value
+        return pool[int(digest, 16) % len(pool)]
+
+
+class TestbedTarget(object):
+    """Runs ConferenceApi in process on testbed stubs."""
+
+    def __init__(self, conferences):
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        tb = testbed.Testbed()
+        tb.activate()
+        tb.init_datastore_v3_stub()
+        tb.init_memcache_stub()
+        tb.init_taskqueue_stub(root_path=ROOT)
+        tb.init_app_identity_stub()
+        tb.init_urlfetch_stub()
+        tb.init_mail_stub()
+        tb.init_user_stub()
+        self.testbed = tb
+
+        import endpoints
+        from google.appengine.api import users
+        from protorpc import protojson
+        from protorpc import remote
+        import conference
+        self._local = threading.local()
+        self._users = users
+        self._protojson = protojson
+        self._remote = remote
+        self._conference = conference
+
+        # Endpoints reads the caller from os.environ, which the worker
+        # threads share; give each thread its own user instead
+        endpoints.get_current_user = lambda: getattr(self._local, 'user',
+                                                     None)
+        self._seed(ndb, conferences)
+
+    def _seed(self, ndb, conferences):
+        from models import Conference, Profile, Session, Speaker
+        today = datetime.date.today()
+        speakers = [Speaker(id='speaker%d@example.com' % i,
+                            name='Speaker %d' % i,
+                            email='speaker%d@example.com' % i,
+                            field=[TOPICS[i % len(TOPICS)]])
+                    for i in range(max(1, conferences // 2))]
+        entities = list(speakers)
+        for i in range(conferences):
+            organizer = 'organizer%d@example.com' % (i % 10)
+            p_key = ndb.Key(Profile, organizer)
+            entities.append(Profile(key=p_key, displayName=organizer,
+                                    mainEmail=organizer))
+            start = today + datetime.timedelta(days=i % 120)
+            conf = Conference(
+                parent=p_key, id=i + 1, name='Conference %d' % i,
+                organizerUserId=organizer, city=CITIES[i % len(CITIES)],
+                topics=[TOPICS[i % len(TOPICS)]], startDate=start,
+                month=start.month,
+                endDate=start + datetime.timedelta(days=2),
+                maxAttendees=100, seatsAvailable=100)
+            entities.append(conf)
+            for j in range(SESSIONS_PER_CONFERENCE):
+                speaker = speakers[(i + j) % len(speakers)]
+                entities.append(Session(
+                    parent=conf.key, name='Session %d.%d' % (i, j),
+                    highlights=[TOPICS[j % len(TOPICS)]],
+                    speaker=speaker.email, duration=1.0,
+                    typeOfSession=SESSION_TYPES[j % len(SESSION_TYPES)],
+                    date=start, startTime=datetime.time(9 + 2 * j)))
+        ndb.put_multi(entities)
+
+    def call(self, method, body, user_hash):
+        """Return (HTTP status, response dict or None)."""
+        api = self._conference.ConferenceApi()
+        self._local.user = self._users.User(
+            '%s@replay.example.com' % user_hash) if user_hash else None
+        func = getattr(api, method, None)
+        if func is None or not hasattr(func, 'remote'):
+            return 404, None
+        try:
+            request = self._protojson.decode_message(
+                func.remote.request_type, json.dumps(body))
+            response = func(request)
+        except self._remote.ApplicationError as e:
+            return getattr(e, 'http_status', 400), None
+        except Exception:
+            return 500, None
+        return 200, json.loads(self._protojson.encode_message(response))
+
+    def close(self):
+        self.testbed.deactivate()
+
+
+class HttpTarget(object):
+    """Posts to the Endpoints backend (/_ah/spi/) of a dev server."""
+
+    def __init__(self, base_url, bearer=None):
+        self.base_url = base_url.rstrip('/')
+        self.bearer = bearer
+
+    def call(self, method, body, user_hash):
+        try:
+            from urllib2 import HTTPError, Request, urlopen
+        except ImportError:
+            from urllib.error import HTTPError
+            from urllib.request import Request, urlopen
+        request = Request(
+            '%s/_ah/spi/ConferenceApi.%s' % (self.base_url, method),
+            json.dumps(body).encode('utf-8'),
+            {'Content-Type': 'application/json'})
+        if self.bearer:
+            request.add_header('Authorization', 'Bearer ' + self.bearer)
+        try:
+            response = urlopen(request)
+            return response.getcode(), json.loads(response.read() or '{}')
+        except HTTPError as e:
+            return e.code, None
+        except IOError:
+            return 599, None
+
+    def close(self):
+        pass
+
+
+def discoverPools(target):
+    """Return {kind: [websafe key or email]} found through the API."""
+    status, confs = target.call('queryConferences', {'includePast': True}, '')
+    conf_keys = [conf['websafeKey']
+                 for conf in (confs or {}).get('items', [])][:POOL_LIMIT]
+    session_keys = []
+    for wsck in conf_keys:
+        if len(session_keys) >= POOL_LIMIT:
+            break
+        status, sessions = target.call('getConferenceSessions',
+                                       {'websafeConferenceKey': wsck}, '')
+        session_keys += [session['websafeKey']
+                         for session in (sessions or {}).get('items', [])]
+    status, speakers = target.call('querySpeakers', {}, '')
+    emails = [speaker['email']
+              for speaker in (speakers or {}).get('items', [])][:POOL_LIMIT]
+    return {'Conference': conf_keys, 'Session': session_keys[:POOL_LIMIT],
+            'Speaker': emails}
+
+
+def replay(target, records, resolver, speedup, concurrency):
+    """Replay records; return [(method, status, latency ms, lag ms)]."""
+    pending = queue.Queue(maxsize=concurrency * 4)
+    results = []
+    results_lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            record, due = item
+            started = time.time()
+            status, _ = target.call(record['m'], resolver.resolve(record['b']),
+                                    record.get('u'))
+            latency = (time.time() - started) * 1000
+            with results_lock:
+                results.append((record['m'], status, latency,
+                                max(0.0, started - due) * 1000))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    first = records[0]['t'] if records else 0
+    start = time.time()
+    for record in records:
+        due = start + ((record['t'] - first) / speedup if speedup else 0)
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        pending.put((record, due))
+    for _ in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start
+
+
+def report(results, elapsed, records):
+    """Print throughput, latency percentiles and error rates per method."""
+    captured = {}
+    for record in records:
+        captured.setdefault(record['m'], []).append(record.get('d', 0.0))
+    by_method = {}
+    for method, status, latency, lag in results:
+        by_method.setdefault(method, []).append((status, latency))
+    rows = sorted(by_method.items()) + [('ALL', [(status, latency)
+                                                 for _, status, latency, _
+                                                 in results])]
+    print('%d calls in %.1fs: %.1f calls/s' % (
+        len(results), elapsed, len(results) / max(elapsed, 0.001)))
+    print('%-30s %7s %7s %8s %8s %8s %8s %10s' % (
+        'method', 'calls', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'prod p50'))
+    for method, calls in rows:
+        latencies = sorted(latency for _, latency in calls)
+        errors = sum(1 for status, _ in calls if status >= 400)
+        prod = sorted(captured.get(method, []) if method != 'ALL' else
+                      [record.get('d', 0.0) for record in records])
+        print('%-30s %7d %6.1f%% %8.1f %8.1f %8.1f %8.1f %10.1f' % (
+            method, len(calls), 100.0 * errors / len(calls),
+            percentile(latencies, 50), percentile(latencies, 90),
+            percentile(latencies, 99), latencies[-1] if latencies else 0.0,
+            percentile(prod, 50)))
+    statuses = {}
+    for _, status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print('statuses: %s' % ', '.join('%d: %d' % item
+                                     for item in sorted(statuses.items())))
+    # a high lag means the target (or this client) could not keep up
+    lags = sorted(lag for _, _, _, lag in results)
+    print('schedule lag: p50 %.1fms, p99 %.1fms' % (
+        percentile(lags, 50), percentile(lags, 99)))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] CAPTURE.jsonl')
+    parser.add_option('--target', default='testbed',
+                      help='"testbed" or a dev server URL')
+    parser.add_option('--speedup', type='float', default=1.0,
+                      help='divide captured gaps by this; 0 = no gaps')
+    parser.add_option('--concurrency', type='int', default=4)
+    parser.add_option('--limit', type='int', default=0,
+                      help='replay only the first N calls')
+    parser.add_option('--conferences', type='int', default=200,
+                      help='synthetic conferences seeded on the testbed')
+    parser.add_option('--bearer', help='OAuth token for a dev server')
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected one capture file')
+
+    records = loadRecords(args[0], opts.limit or None)
+    if opts.target == 'testbed':
+        target = TestbedTarget(opts.conferences)
+    else:
+        target = HttpTarget(opts.target, opts.bearer)
+    try:
+        pools = discoverPools(target)
+        print('mapping references onto %s' % ', '.join(
+            '%d %s' % (len(keys), kind) for kind, keys in sorted(pools.items())))
+        resolver = Resolver(pools, 'replay%d' % int(time.time()))
+        results, elapsed = replay(target, records, resolver, opts.speedup,
+                                  max(1, opts.concurrency))
+        report(results, elapsed, records)
+    finally:
+        target.close()
+
+
+if __name__ == '__main__':
+    main()
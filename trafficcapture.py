@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""trafficcapture.py
+
+Sampled capture of production Endpoints traffic, for replay by
+tools/replay_traffic.py.
+
+CaptureMiddleware is installed by appengine_config.py when
+CAPTURE_SAMPLE_RATE is set. For a sampled call to /_ah/spi/ it records
+one compact JSON object:
+
+    {"t": start (unix secs), "m": API method, "u": user hash,
+     "b": sanitized request body, "s": HTTP status, "d": duration (ms)}
+
+Bodies are sanitized before they are stored:
+- entity keys and speaker emails become stable reference tokens
+  ("@Conference:1a2b3c4d"), so the replayer maps each one onto a local
+  entity and keeps the production access skew;
+- names, descriptions and other free text are reduced to their length;
+- cursors and sync tokens are dropped.
+
+Each instance buffers records and saves them as TrafficCaptureChunk
+entities every CAPTURE_FLUSH_RECORDS records or CAPTURE_FLUSH_SECS
+seconds. /admin/traffic_capture exports them as JSON lines.
+
+"""
+
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.ext import ndb
+
+from models import TrafficCaptureChunk
+from settings import CAPTURE_FLUSH_RECORDS
+from settings import CAPTURE_FLUSH_SECS
+from settings import CAPTURE_SAMPLE_RATE
+
+SPI_PREFIX = '/_ah/spi/'
+# request fields holding entity keys (websafe) or speaker emails
+KEY_FIELDS = frozenset(['websafeConferenceKey', 'websafeKey', 'sessionKey',
+                        'keys'])
+SPEAKER_FIELDS = frozenset(['speaker', 'email'])
+# methods whose MultiGetForm.keys are speaker emails, not entity keys
+SPEAKER_KEYS_METHODS = frozenset(['getSpeakersByEmails'])
+# free text that may identify people; only its length is kept
+REDACTED_FIELDS = frozenset(['name', 'description', 'displayName', 'company',
+                             'sex', 'namePrefix'])
+# continuation state that is meaningless outside production
+DROPPED_FIELDS = frozenset(['cursor', 'syncToken'])
+
+_lock = threading.Lock()
+_buffer = []
+_last_flush = [time.time()]
+
+
+def _digest(value):
+    salt = app_identity.get_application_id()
+    return hashlib.sha1((u'%s|%s' % (salt, value)).encode('utf-8')).hexdigest()
+
+
+def _keyToken(websafe_key):
+    try:
+        kind = ndb.Key(urlsafe=websafe_key).kind()
+    except Exception:
+        kind = 'Invalid'
+    return '@%s:%s' % (kind, _digest(websafe_key)[:8])
+
+
+def _sanitizeValue(name, value):
+    if isinstance(value, list):
+        return [_sanitizeValue(name, item) for item in value]
+    if isinstance(value, dict):
+        return sanitize(value)
+    if not isinstance(value, basestring):
+        return value
+    if name in KEY_FIELDS:
+        return _keyToken(value)
+    if name in SPEAKER_FIELDS:
+        return '@Speaker:%s' % _digest(value.lower())[:8]
+    if name == 'requestId':
+        return '@req:%s' % _digest(value)[:8]
+    if name in REDACTED_FIELDS:
+        return 'x' * len(value)
+    return value
+
+
+def sanitize(body, method=None):
+    """Return a copy of a request body that is safe to store."""
+    clean = {}
+    for name, value in body.items():
+        if name in DROPPED_FIELDS:
+            continue
+        field = name
+        if name == 'value' and isinstance(body.get('field'), basestring):
+            # a query filter: its value is sanitized like the field
+            # it filters on (querySpeakers' email, name, ...)
+            field = body['field']
+        elif name == 'keys' and method in SPEAKER_KEYS_METHODS:
+            field = 'email'
+        clean[name] = _sanitizeValue(field, value)
+    return clean
+
+
+def _userHash():
+    """Hash of the caller, from what Endpoints auth left in os.environ."""
+    email = (os.environ.get('ENDPOINTS_AUTH_EMAIL') or
+             os.environ.get('OAUTH_EMAIL'))
+    if email:
+        return _digest(email.lower())[:12]
+    auth = os.environ.get('HTTP_AUTHORIZATION')
+    # an unresolved token is still one client session
+    return 't' + _digest(auth)[:11] if auth else ''
+
+
+def _append(record):
+    with _lock:
+        _buffer.append(record)
+        now = time.time()
+        if len(_buffer) < CAPTURE_FLUSH_RECORDS and \
+                now - _last_flush[0] < CAPTURE_FLUSH_SECS:
+            return
+        records = list(_buffer)
+        del _buffer[:]
+        _last_flush[0] = now
+    TrafficCaptureChunk(records=records).put()
+
+
+class CaptureMiddleware(object):
+    """WSGI middleware logging a sample of Endpoints requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(SPI_PREFIX) or \
+                random.random() >= CAPTURE_SAMPLE_RATE:
+            return self.app(environ, start_response)
+
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length else ''
+        environ['wsgi.input'] = io.BytesIO(body)
+        status = []
+
+        def capturingStartResponse(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(' ', 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        start = time.time()
+        # the SPI layer builds the whole response before returning it
+        response = list(self.app(environ, capturingStartResponse))
+        elapsed = time.time() - start
+        method = path[len(SPI_PREFIX):].rsplit('.', 1)[-1]
+        try:
+            request = sanitize(json.loads(body), method) if body else {}
+        except (ValueError, AttributeError):
+            request = {}
+        _append({
+            't': round(start, 3),
+            'm': method,
+            'u': _userHash(),
+            'b': request,
+            's': status[0] if status else 500,
+            'd': round(elapsed * 1000, 1),
+        })
+        return response
+
+
+def exportRecords():
+    """Yield captured records, oldest chunk first, as JSON lines."""
+    for chunk in TrafficCaptureChunk.query().order(
+            TrafficCaptureChunk.createdAt):
+        for record in chunk.records:
+            yield json.dumps(record, sort_keys=True, separators=(',', ':'))
+
+
+def resetCapture():
+    """Delete every captured chunk."""
+    ndb.delete_multi(TrafficCaptureChunk.query().fetch(keys_only=True))
@@ -3,8 +3,23 @@ import os
 import time
 import uuid
 
+from google.appengine.api import oauth
 from google.appengine.api import urlfetch
 from models import Profile
+from settings import ADMIN_EMAILS
+
+EMAIL_SCOPE = 'https://www.googleapis.com/auth/userinfo.email'
+
+def isAdmin(user):
+    """True for ADMIN_EMAILS users and, when the call carries an OAuth
+    access token, for the project's admins."""
+    if user.email() in ADMIN_EMAILS:
+        return True
+    try:
+        return oauth.is_current_user_admin(EMAIL_SCOPE)
+    except oauth.Error:
+        # ID token callers have no OAuth grant to check
+        return False
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""waitlist.py
+
+FIFO waitlist and admission control for conference registration.
+
+Users who try to register for a sold-out conference, or who arrive
+faster than REGISTRATION_RATE_PER_SEC during a launch spike, get a
+WaitlistEntry under the Conference. A task worker admits waiters in
+order, WAITLIST_ADMIT_BATCH at a time, each batch in one cross-group
+transaction. Unregistering from a conference triggers the worker, so the
+next waiter is promoted automatically.
+
+"""
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from facets import conferenceFacets
+from facets import enqueueFacetDelta
+from facets import facetDelta
+from homepage import invalidateHomePage
+from models import Profile
+from models import WaitlistEntry
+from sync import scopeChange
+from settings import REGISTRATION_RATE_PER_SEC
+from settings import WAITLIST_ADMIT_BATCH
+from settings import WAITLIST_BATCHES_PER_TASK
+
+
+def takeAdmissionToken(wsck, now=None):
+    """Return True if this registration fits the conference's rate budget."""
+    if not REGISTRATION_RATE_PER_SEC:
+        return True
+    second = int(now if now is not None else time.time())
+    used = memcache.incr('ADMISSION:%s:%d' % (wsck, second), initial_value=0)
+    # if memcache is unavailable, let the request through
+    return used is None or used <= REGISTRATION_RATE_PER_SEC
+
+
+def joinWaitlist(c_key, user_id):
+    """Add the user to the conference waitlist (idempotent).
+
+    Returns the user's 1-based position in the waitlist.
+    """
+    entry = WaitlistEntry.get_or_insert(user_id, parent=c_key)
+    return WaitlistEntry.query(
+        WaitlistEntry.createdAt < entry.createdAt,
+        ancestor=c_key).count(limit=10000) + 1
+
+
+def leaveWaitlist(c_key, user_id):
+    """Remove the user from the waitlist; True if they were on it."""
+    entry_key = ndb.Key(WaitlistEntry, user_id, parent=c_key)
+    if entry_key.get() is None:
+        return False
+    entry_key.delete()
+    return True
+
+
+def hasWaiters(c_key):
+    """Return True if anyone is waiting (usable inside a transaction)."""
+    return bool(WaitlistEntry.query(ancestor=c_key).get(keys_only=True))
+
+
+def scheduleWaitlistWorker(wsck, countdown=1, transactional=False):
+    """Queue a waitlist worker run for the conference.
+
+    Outside a transaction the task is named per conference and second so
+    a burst of throttled registrations triggers a single run.
+    """
+    params = {'wsck': wsck}
+    if transactional:
+        taskqueue.add(url='/tasks/process_waitlist', params=params,
+                      transactional=True)
+        return
+    name = 'waitlist-%s-%d' % (hashlib.md5(wsck).hexdigest(),
+                               int(time.time()))
+    try:
+        taskqueue.add(url='/tasks/process_waitlist', params=params,
+                      name=name, countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional(xg=True)
+def _admitBatch(c_key, entry_keys):
+    """Admit waiters in order while seats last.
+
+    Returns the number of seats left (0 stops the worker).
+    """
+    conf = c_key.get()
+    if conf is None:
+        ndb.delete_multi(entry_keys)
+        return 0
+    wsck = c_key.urlsafe()
+    old_facets = conferenceFacets(conf)
+    profiles = ndb.get_multi([ndb.Key(Profile, key.id()) for key in entry_keys])
+    admitted, done = [], []
+    for entry_key, prof in zip(entry_keys, profiles):
+        if prof is None:
+            # the waiter's Profile is missing; create it the way
+            # ConferenceApi does (user ids are emails)
+            prof = Profile(key=ndb.Key(Profile, entry_key.id()),
+                           displayName=entry_key.id(),
+                           mainEmail=entry_key.id())
+        if wsck not in prof.conferenceKeysToAttend:
+            if conf.seatsAvailable <= 0:
+                break
+            prof.conferenceKeysToAttend.append(wsck)
+            conf.seatsAvailable -= 1
+            admitted.append(prof)
+        done.append(entry_key)
+    if admitted:
+        ndb.put_multi(admitted + [conf] + [
+            scopeChange(prof.key, c_key) for prof in admitted])
+        enqueueFacetDelta(facetDelta(old_facets, conferenceFacets(conf)))
+    ndb.delete_multi(done)
+    return conf.seatsAvailable
+
+
+def processWaitlist(wsck):
+    """Admit waiters for a conference in FIFO batches.
+
+    Returns the number of batches processed; chains another task if work
+    remains after WAITLIST_BATCHES_PER_TASK batches.
+    """
+    c_key = ndb.Key(urlsafe=wsck)
+    for batch in range(WAITLIST_BATCHES_PER_TASK):
+        entry_keys = WaitlistEntry.query(ancestor=c_key).order(
+            WaitlistEntry.createdAt).fetch(WAITLIST_ADMIT_BATCH, keys_only=True)
+        if not entry_keys:
+            return batch
+        seats = _admitBatch(c_key, entry_keys)
+        # seat counts may have moved
+        invalidateHomePage()
+        if seats <= 0:
+            return batch + 1
+    scheduleWaitlistWorker(wsck, countdown=0)
+    return WAITLIST_BATCHES_PER_TASK